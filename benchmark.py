@@ -0,0 +1,1040 @@
+"""Офлайн-бенчмарк бота: настоящие хендлеры и фоновые задачи main.py на синтетических обновлениях.
+
+Telegram подменяется записывающим FakeBot, OpenWeather — локальным HTTP-сервером с готовыми
+ответами /weather и /forecast. БД создаётся во временном каталоге.
+
+    python benchmark.py                       # все сценарии
+    python benchmark.py --users 500 --owm-latency 0.05
+    python benchmark.py --json result.json    # сохранить результат
+    python benchmark.py --baseline result.json --tolerance 0.2   # сравнить с сохранённым, код 1 при регрессии
+
+Для каждого сценария печатается: обновлений в секунду, p50/p99 задержки обработки одного обновления,
+число запросов к OpenWeather и к Telegram на обновление. Каждый сценарий прогоняется дважды:
+cold — города встречаются впервые, warm — те же запросы ещё раз (кэш и geocode уже заполнены).
+Ограничения скорости (квота OpenWeather, темп очереди отправки) в бенчмарке сняты.
+
+Сценарии слоя хранения:
+    db           новое соединение на запрос против общего соединения под конкурентными обновлениями
+    indexes      горячие запросы к подпискам на миллионе строк: по индексам и полным просмотром
+    startup      запуск бота и первый тик диспетчера при 100 тыс. подписок
+    persistence  SQLitePersistence против PicklePersistence: задержка сохранения и RSS
+                 (каждый вариант — в отдельном процессе)
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import itertools
+import tempfile
+import zlib
+import random
+import math
+import httpx
+import pickle
+import sqlite3
+import contextlib
+from collections import Counter
+from urllib.parse import urlsplit, parse_qs
+
+# Настройки main.py читаются при импорте, поэтому окружение задаём заранее
+os.environ.setdefault('OPENWEATHER_API_KEY', 'benchmark')
+os.environ['OWM_QUOTA_PER_MINUTE'] = str(10 ** 9)
+os.environ['OWM_QUOTA_PER_DAY'] = str(10 ** 9)
+
+from telegram import Update
+from telegram.ext import ExtBot
+
+# --- Заглушка OpenWeather ---
+class FakeOpenWeather:
+    """Локальный HTTP-сервер с готовыми ответами OpenWeather; считает запросы по путям и принятые соединения.
+
+    Режим сбоев (см. set_faults): доля ответов 503 и доля «зависших» ответов, которые приходят через stall секунд.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.connections = 0
+        self.errors = 0
+        self.stalls = 0
+        self.set_faults()
+        self._server = None
+        self.port = None
+
+    def set_faults(self, error_rate: float = 0.0, stall_rate: float = 0.0, stall: float = 0.0):
+        self.error_rate = error_rate
+        self.stall_rate = stall_rate
+        self.stall = stall
+        self._rng = random.Random(1)
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, '127.0.0.1', 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    @staticmethod
+    def _coords(city: str) -> tuple[float, float]:
+        digest = zlib.crc32(city.casefold().encode())
+        return 40 + digest % 2000 / 100, 30 + digest // 2000 % 4000 / 100
+
+    def _payload(self, path: str, params: dict) -> dict:
+        now = int(time.time())
+        if 'q' in params:
+            name = params['q'].strip().title()
+            lat, lon = self._coords(name)
+        else:
+            name = 'Бенчмарк'
+            lat, lon = float(params['lat']), float(params['lon'])
+        # Дождь в половине мест, чтобы оповещения реально отправлялись
+        rainy = int(lat * 100 + lon * 100) % 2 == 0
+        if path.endswith('/weather'):
+            return {
+                'name': name, 'coord': {'lat': lat, 'lon': lon}, 'timezone': 10800, 'dt': now,
+                'main': {'temp': 12.3, 'feels_like': 10.1, 'humidity': 71, 'pressure': 1012},
+                'weather': [{'id': 803, 'main': 'Clouds', 'description': 'облачно с прояснениями'}],
+                'wind': {'speed': 3.4}, 'sys': {'sunrise': now - 20000, 'sunset': now + 20000},
+            }
+        if path.endswith('/forecast'):
+            return forecast_payload(now, rainy, name, lat, lon)
+        return {'cod': '404', 'message': 'not found'}
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, target, _ = request_line.decode('latin-1').split(' ', 2)
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                url = urlsplit(target)
+                self.calls[url.path] += 1
+                params = {name: values[0] for name, values in parse_qs(url.query).items()}
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                fault = self._rng.random()
+                if fault < self.error_rate:
+                    self.errors += 1
+                    payload, status = {'cod': 503, 'message': 'Service Unavailable'}, '503 Service Unavailable'
+                else:
+                    if fault < self.error_rate + self.stall_rate:
+                        self.stalls += 1
+                        await asyncio.sleep(self.stall)
+                    payload = self._payload(url.path, params)
+                    status = '404 Not Found' if payload.get('cod') == '404' else '200 OK'
+                body = json.dumps(payload, ensure_ascii=False).encode()
+                writer.write(
+                    f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n'.encode() + body
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+def forecast_payload(now: int, rainy: bool, name: str = 'Бенчмарк', lat: float = 55.75, lon: float = 37.62) -> dict:
+    """Ответ /forecast: 40 шагов по 3 часа; если rainy — дождь в первые часы и далее через шаг."""
+    steps = []
+    for i in range(40):
+        rain = rainy and i % 2 == 0 or i % 7 == 3
+        steps.append({
+            'dt': now + i * 10800,
+            'main': {'temp': 10 + i % 8 + 0.37, 'feels_like': 9 + i % 8, 'humidity': 60 + i % 30, 'pressure': 1012},
+            'weather': [{'id': 500 if rain else 803, 'main': 'Rain' if rain else 'Clouds',
+                         'description': 'небольшой дождь' if rain else 'облачно с прояснениями', 'icon': '10d'}],
+            'wind': {'speed': 3.1, 'deg': 200}, 'clouds': {'all': 75}, 'visibility': 10000, 'pop': 0.4,
+            'dt_txt': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(now + i * 10800)),
+        })
+    return {'cod': '200', 'message': 0, 'cnt': 40, 'list': steps,
+            'city': {'id': 1, 'name': name, 'coord': {'lat': lat, 'lon': lon}, 'timezone': 10800}}
+
+# --- Подменный Telegram Bot ---
+class FakeBot(ExtBot):
+    """Bot, который не ходит в сеть: запоминает вызовы Bot API и возвращает правдоподобные ответы."""
+
+    def __init__(self):
+        super().__init__(token='0:benchmark')
+        with self._unfrozen():
+            self.calls = Counter()
+            self._message_ids = itertools.count(1)
+
+    async def _do_post(self, endpoint: str, data: dict, **kwargs):
+        self.calls[endpoint] += 1
+        if endpoint == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'MeteoBot', 'username': 'meteo_benchmark_bot'}
+        if endpoint in ('sendMessage', 'editMessageText'):
+            return {
+                'message_id': next(self._message_ids), 'date': int(time.time()),
+                'chat': {'id': int(data.get('chat_id') or 0), 'type': 'private'}, 'text': data.get('text', ''),
+            }
+        return True
+
+# --- Синтетические обновления ---
+class UpdateFactory:
+    def __init__(self, bot: FakeBot):
+        self.bot = bot
+        self._update_ids = itertools.count(1)
+
+    def _message(self, user_id: int, **fields) -> dict:
+        return {
+            'message_id': next(self._update_ids), 'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'},
+            **fields,
+        }
+
+    def _update(self, **fields) -> Update:
+        return Update.de_json({'update_id': next(self._update_ids), **fields}, self.bot)
+
+    def command(self, user_id: int, command: str) -> Update:
+        entities = [{'type': 'bot_command', 'offset': 0, 'length': len(command.split()[0])}]
+        return self._update(message=self._message(user_id, text=command, entities=entities))
+
+    def text(self, user_id: int, text: str) -> Update:
+        return self._update(message=self._message(user_id, text=text))
+
+    def location(self, user_id: int, latitude: float, longitude: float) -> Update:
+        return self._update(message=self._message(user_id, location={'latitude': latitude, 'longitude': longitude}))
+
+    def callback(self, user_id: int, data: str) -> Update:
+        return self._update(callback_query={
+            'id': str(next(self._update_ids)), 'chat_instance': str(user_id), 'data': data,
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'},
+            'message': self._message(1, text='menu') | {'chat': {'id': user_id, 'type': 'private'}},
+        })
+
+def build_scenarios(updates: UpdateFactory, users: int, cities: int) -> dict:
+    """Сценарий -> функция, возвращающая для каждого пользователя последовательность обновлений."""
+    def city(name: str, user_id: int) -> str:
+        return f'{name}-город-{user_id % cities}'
+
+    return {
+        'start': lambda user_id: [updates.command(user_id, '/start')],
+        'weather': lambda user_id: [updates.callback(user_id, 'ask_city_weather'), updates.text(user_id, city('weather', user_id))],
+        'forecast': lambda user_id: [updates.callback(user_id, 'ask_city_forecast'), updates.text(user_id, city('forecast', user_id))],
+        'hourly': lambda user_id: [updates.callback(user_id, 'ask_city_hourly'), updates.text(user_id, city('hourly', user_id))],
+        # Соседи в пределах ~1.5 км друг от друга: должны получать погоду из общего кэша
+        'location': lambda user_id: [updates.location(user_id, 55 + user_id % cities / 10 + user_id % 5 * 0.003, 37.5 + user_id % 3 * 0.004)],
+        'favorites': lambda user_id: [updates.callback(user_id, 'show_favorite_cities'),
+                                      updates.callback(user_id, f"weather_fav_{city('favorites', user_id)}")],
+    }
+
+# --- Замеры ---
+def percentile(values: list[float], share: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))] if ordered else 0.0
+
+class Recorder:
+    def __init__(self, owm: FakeOpenWeather, bot: FakeBot):
+        self.owm = owm
+        self.bot = bot
+        self.results = {}
+
+    def snapshot(self) -> tuple[int, int]:
+        return sum(self.owm.calls.values()), sum(self.bot.calls.values())
+
+    def record(self, name: str, count: int, elapsed: float, latencies: list[float], before: tuple[int, int]):
+        owm_calls, bot_calls = (after - start for after, start in zip(self.snapshot(), before))
+        self.results[name] = {
+            'updates': count,
+            'per_second': round(count / elapsed, 1) if elapsed else 0.0,
+            'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+            'owm_per_update': round(owm_calls / count, 3) if count else 0.0,
+            'bot_per_update': round(bot_calls / count, 3) if count else 0.0,
+        }
+
+    def report(self):
+        print(f"{'сценарий':<22}{'обновл.':>9}{'в сек':>10}{'p50 мс':>10}{'p99 мс':>10}{'OWM/обн':>9}{'TG/обн':>8}")
+        for name, result in self.results.items():
+            print(f"{name:<22}{result['updates']:>9}{result['per_second']:>10}{result['p50_ms']:>10}"
+                  f"{result['p99_ms']:>10}{result['owm_per_update']:>9}{result['bot_per_update']:>8}")
+
+async def run_scenario(application, recorder: Recorder, name: str, sequence, users: int, concurrency: int):
+    """Прогоняет сценарий: обновления одного пользователя — по порядку, разные пользователи — параллельно."""
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_user(user_id: int):
+        async with semaphore:
+            for update in sequence(user_id):
+                started = time.perf_counter()
+                await application.process_update(update)
+                latencies.append(time.perf_counter() - started)
+
+    before = recorder.snapshot()
+    started = time.perf_counter()
+    await asyncio.gather(*(run_user(user_id) for user_id in range(1, users + 1)))
+    recorder.record(name, len(latencies), time.perf_counter() - started, latencies, before)
+
+async def run_flood(application, recorder: Recorder, updates: UpdateFactory, users: int, taps: int):
+    """Флуд с настоящими лимитами: каждый пользователь без пауз жмёт кнопки, половина нажатий повторяет
+    предыдущее, и каждое обновление доставляется дважды."""
+    import main
+
+    main.update_guard = main.UpdateGuard(main.RATE_LIMIT_PER_SECOND, main.RATE_LIMIT_BURST, main.CALLBACK_REPEAT_WINDOW)
+    buttons = ('show_favorite_cities', 'show_favorite_cities', 'ask_city_weather', 'ask_city_weather')
+    sequence = []
+    for tap in range(taps):
+        for user_id in range(1, users + 1):
+            update = updates.callback(user_id, buttons[tap % len(buttons)])
+            sequence += [update, update]
+    latencies = []
+    before = recorder.snapshot()
+    started = time.perf_counter()
+    for update in sequence:
+        step_started = time.perf_counter()
+        await application.process_update(update)
+        latencies.append(time.perf_counter() - step_started)
+    recorder.record('flood', len(sequence), time.perf_counter() - started, latencies, before)
+    print(f"Защита от флуда: {main.update_guard.stats()}")
+    main.update_guard = main.UpdateGuard(10 ** 9, 10 ** 9, 0)
+
+async def run_send(recorder: Recorder, messages: int, chats: int, retry_after: int):
+    """Очередь отправки с настоящими лимитами (SEND_GLOBAL_RATE, SEND_PER_CHAT_INTERVAL) против фейкового Bot,
+    который на одном сообщении отвечает RetryAfter. Проверяет темп по секундам, интервал в каждом чате
+    и то, что во время паузы ничего не отправлялось."""
+    import main
+    from telegram.error import RetryAfter
+
+    bot = FakeBot()
+    loop = asyncio.get_running_loop()
+    sent = []  # (время, chat_id)
+    pauses = []  # (время ответа RetryAfter, время окончания паузы)
+    post = bot._do_post
+
+    async def limited_post(endpoint: str, data: dict, **kwargs):
+        if endpoint == 'sendMessage':
+            if len(sent) == messages // 4 and not pauses:
+                pauses.append((loop.time(), loop.time() + retry_after))
+                raise RetryAfter(retry_after)
+            sent.append((loop.time(), int(data['chat_id'])))
+        return await post(endpoint, data, **kwargs)
+
+    with bot._unfrozen():
+        bot._do_post = limited_post
+    queue = main.SendQueue(main.SEND_GLOBAL_RATE, main.SEND_PER_CHAT_INTERVAL, main.SEND_WORKERS)
+    queue.start(bot)
+    try:
+        before = recorder.snapshot()
+        started = time.perf_counter()
+        # Каждое пятое сообщение уходит в один из трёх «горячих» чатов — упирается в интервал чата,
+        # остальные разбросаны по chats чатам и упираются в общий лимит
+        futures = [queue.send(1 + i % 3 if i % 5 == 0 else 1 + i % chats, f'сообщение {i}')
+                   for i in range(messages)]
+        latencies = []
+        for future in asyncio.as_completed(futures):
+            await future
+            latencies.append(time.perf_counter() - started)
+        recorder.record('send/limits', messages, time.perf_counter() - started, latencies, before)
+    finally:
+        await queue.stop()
+
+    times = [at for at, _ in sent]
+    start = times[0]
+    per_second = Counter(int(at - start) for at in times)
+    # Самое плотное окно в одну секунду (скользящее, а не по целым секундам)
+    window = max(sum(1 for other in times[i:] if other - at < 1) for i, at in enumerate(times))
+    last = {}
+    spacing = 0
+    for at, chat_id in sent:
+        # Допуск 20 мс: время снимается в Bot уже после сборки запроса, и эта задержка немного гуляет
+        if chat_id in last and at - last[chat_id] < main.SEND_PER_CHAT_INTERVAL - 0.02:
+            spacing += 1
+        last[chat_id] = at
+    paused_at, resumed_at = pauses[0]
+    during_pause = sum(1 for at in times if paused_at < at < resumed_at - 0.005)
+    print(f"Отправка: по секундам {[per_second[second] for second in range(max(per_second) + 1)]}")
+    print(f"Отправка: лимит {main.SEND_GLOBAL_RATE:g}/с, плотнейшая секунда {window}, нарушений интервала в чате "
+          f"{spacing}, RetryAfter {retry_after} с — отправлено во время паузы {during_pause}, повторов {queue.retried}")
+    assert window <= main.SEND_GLOBAL_RATE + 1, f'{window} сообщений за секунду при лимите {main.SEND_GLOBAL_RATE:g}'
+    assert spacing == 0, f'{spacing} сообщений в чат чаще SEND_PER_CHAT_INTERVAL'
+    assert during_pause == 0, f'{during_pause} сообщений отправлено во время RetryAfter'
+    assert len(sent) == messages, f'доставлено {len(sent)} из {messages}'
+
+async def run_job(recorder: Recorder, name: str, job, messages: int):
+    """Прогоняет фоновую задачу; «обновление» здесь — одно сообщение подписчику."""
+    import main
+
+    before = recorder.snapshot()
+    started = time.perf_counter()
+    await job(None)
+    await main.send_queue._queue.join()
+    elapsed = time.perf_counter() - started
+    recorder.record(name, messages, elapsed, [elapsed], before)
+
+def deep_size(value) -> int:
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(deep_size(k) + deep_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(deep_size(item) for item in value)
+    return sys.getsizeof(value)
+
+def run_model(recorder: Recorder, iterations: int):
+    """Стоимость разбора /forecast в Forecast и построения из него всех трёх представлений."""
+    import main
+
+    now = int(time.time())
+    payload = json.loads(json.dumps(forecast_payload(now, True)))
+    forecast = main.Forecast.from_payload(payload)
+    steps = {
+        'model/parse': lambda: main.Forecast.from_payload(payload),
+        'model/daily': lambda: forecast.daily(5),
+        'model/hourly': lambda: forecast.hours(8),
+        'model/rain': lambda: forecast.has_rain(now, now + main.RAIN_LOOKAHEAD_HOURS * 3600),
+    }
+    for name, step in steps.items():
+        latencies = []
+        before = recorder.snapshot()
+        started = time.perf_counter()
+        for _ in range(iterations):
+            step_started = time.perf_counter()
+            step()
+            latencies.append(time.perf_counter() - step_started)
+        recorder.record(name, iterations, time.perf_counter() - started, latencies, before)
+    model_size = sum(sys.getsizeof(getattr(forecast, slot)) for slot in main.Forecast.__slots__) + sys.getsizeof(forecast)
+    model_size += sum(sys.getsizeof(label) for label in forecast.labels)
+    print(f"Прогноз в памяти: ответ API {deep_size(payload)} байт, Forecast {model_size} байт")
+
+def run_spatial(recorder: Recorder, points: int, iterations: int):
+    """SpatialIndex на points точках: вставка и поиск ближайшей (половина запросов — рядом с известной точкой)."""
+    import main
+
+    rng = random.Random(1)
+    coords = [(rng.uniform(-60, 70), rng.uniform(-180, 180)) for _ in range(points)]
+    index = main.SpatialIndex(main.LOCATION_SNAP_KM)
+    latencies = []
+    before = recorder.snapshot()
+    started = time.perf_counter()
+    for key, (lat, lon) in enumerate(coords):
+        step_started = time.perf_counter()
+        index.add(key, lat, lon, key)
+        latencies.append(time.perf_counter() - step_started)
+    recorder.record('spatial/add', points, time.perf_counter() - started, latencies, before)
+
+    queries = []
+    for i in range(iterations):
+        if i % 2:
+            queries.append((rng.uniform(-60, 70), rng.uniform(-180, 180)))
+        else:
+            lat, lon = coords[rng.randrange(points)]
+            queries.append((lat + rng.uniform(-0.02, 0.02), lon + rng.uniform(-0.02, 0.02)))
+    latencies, found = [], 0
+    before = recorder.snapshot()
+    started = time.perf_counter()
+    for lat, lon in queries:
+        step_started = time.perf_counter()
+        found += index.nearest(lat, lon, main.LOCATION_SNAP_KM) is not None
+        latencies.append(time.perf_counter() - step_started)
+    recorder.record('spatial/nearest', iterations, time.perf_counter() - started, latencies, before)
+    print(f"Пространственный индекс: {points} точек в {len(index._cells)} ячейках, найдено соседей для {found} из {iterations} запросов")
+
+async def run_history(recorder: Recorder, places: int, days: int, iterations: int):
+    """История погоды: наблюдения каждые 10 минут за days суток по places местам — запись, упаковка
+    и чтение диапазонов за сутки (сырые точки), за месяц (в основном средние за час) и «вчера в это время»."""
+    import main
+
+    history = main.WeatherHistory()
+    now = int(time.time())
+    start = now - days * 86400
+    rng = random.Random(1)
+    coords = [(rng.uniform(40, 65), rng.uniform(20, 60)) for _ in range(places)]
+    observations = [
+        {'coord': {'lat': lat, 'lon': lon}, 'dt': ts, 'main': {'temp': 10 + 8 * math.sin(ts / 13751), 'humidity': 70, 'pressure': 1012},
+         'wind': {'speed': 3.4}, 'weather': [{'id': 803}]}
+        for ts in range(start, now, 600) for lat, lon in coords
+    ]
+    latencies = []
+    before = recorder.snapshot()
+    started = time.perf_counter()
+    for number, data in enumerate(observations, 1):
+        step_started = time.perf_counter()
+        history.record(data)
+        latencies.append(time.perf_counter() - step_started)
+        if number % main.HISTORY_FLUSH_BATCH == 0:
+            await asyncio.sleep(0)  # запись пачки запускается в фоне, как в боте
+    await history.flush()
+    await main.db.run(lambda conn: None)  # дожидаемся фоновых записей: поток БД один
+    recorder.record('history/write', len(observations), time.perf_counter() - started, latencies, before)
+
+    before = recorder.snapshot()
+    started = time.perf_counter()
+    stats = await history.compact(now)
+    elapsed = time.perf_counter() - started
+    recorder.record('history/compact', len(observations), elapsed, [elapsed], before)
+
+    places_keys = [main.place_key(lat, lon) for lat, lon in coords]
+    scans = {
+        'history/day': lambda place, ts: history.series(place, ts - 86400, ts),
+        'history/month': lambda place, ts: history.series(place, ts - 30 * 86400, ts),
+        'history/yesterday': lambda place, ts: history.nearest(place, ts - 86400, main.HISTORY_MATCH_WINDOW),
+    }
+    for name, scan in scans.items():
+        latencies, found = [], 0
+        before = recorder.snapshot()
+        started = time.perf_counter()
+        for _ in range(iterations):
+            ts = now - rng.randrange(min(days - 30, main.HISTORY_RAW_DAYS) * 86400) if name == 'history/month' else now - rng.randrange(86400)
+            step_started = time.perf_counter()
+            found += bool(await scan(rng.choice(places_keys), ts))
+            latencies.append(time.perf_counter() - step_started)
+        recorder.record(name, iterations, time.perf_counter() - started, latencies, before)
+    rows, size = await main.db.fetchone('SELECT COUNT(*), SUM(LENGTH(data)) FROM weather_history')
+    print(f"История погоды: {len(observations)} наблюдений -> {rows} строк, {size} байт "
+          f"({size / len(observations):.1f} байт на наблюдение), упаковка {stats}")
+
+@contextlib.asynccontextmanager
+async def separate_db(workdir: str, name: str):
+    """Временно переключает main на отдельную БД, чтобы объёмные сценарии не влияли на остальные."""
+    import main
+
+    saved = main.DB_PATH, main.db
+    main.DB_PATH = os.path.join(workdir, name)
+    main.db = main.Database(main.DB_PATH)
+    main.init_db()
+    try:
+        yield
+    finally:
+        await main.db.close()
+        main.DB_PATH, main.db = saved
+
+def subscription_rows(count: int, start_id: int, now: int):
+    """Синтетические подписки: четыре на пользователя, три ежедневные и оповещение о дожде,
+    время отправки равномерно распределено по ближайшим суткам, каждая десятая подписка отключена."""
+    days = json.dumps(list(range(7)))
+    for i in range(start_id, start_id + count):
+        next_run = now + i * 86400 // count % 86400
+        active = i % 10 != 0
+        if i % 4 == 3:
+            yield i // 4 + 1, f'город-{i % 500}', None, None, 'alert_rain', active, None, None
+        else:
+            local = time.gmtime(next_run + 10800)
+            yield (i // 4 + 1, f'город-{i % 500}', f'{local.tm_hour:02d}:{local.tm_min:02d}', days, 'daily',
+                   active, next_run, None if active else now - 86400 * (i % 60))
+
+async def seed_bulk_subscriptions(count: int, now: int):
+    import main
+
+    def insert(conn):
+        with conn:
+            conn.executemany(
+                'INSERT INTO subscriptions (user_id, city, time, days, forecast_type, is_active, next_run_utc, deactivated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                subscription_rows(count, 0, now)
+            )
+        conn.execute('ANALYZE')
+    await main.db.run(insert)
+
+async def run_http(recorder: Recorder, owm: FakeOpenWeather, concurrency: int, iterations: int):
+    """Запросы к заглушке OpenWeather: новый AsyncClient на каждый запрос (как было до общего клиента)
+    против общего клиента с keep-alive. Считаются и соединения, принятые заглушкой."""
+    import main
+
+    params = {'lat': 55.75, 'lon': 37.62, 'appid': 'benchmark', 'units': 'metric', 'lang': 'ru'}
+
+    async def per_request():
+        async with httpx.AsyncClient(base_url=main.OWM_BASE_URL) as client:
+            response = await client.get('/data/2.5/weather', params=params)
+            response.raise_for_status()
+
+    async def shared():
+        response = await main.get_http_client().get('/data/2.5/weather', params=params)
+        response.raise_for_status()
+
+    # Создание клиента (с SSL-контекстом) само по себе долгое, поэтому у первого варианта повторов меньше
+    for name, fetch, repeats in (('http/client-per-request', per_request, max(1, iterations // 20)),
+                                 ('http/shared-client', shared, iterations)):
+        latencies = []
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def request():
+            async with semaphore:
+                step_started = time.perf_counter()
+                await fetch()
+                latencies.append(time.perf_counter() - step_started)
+
+        connections = owm.connections
+        before = recorder.snapshot()
+        started = time.perf_counter()
+        await asyncio.gather(*(request() for _ in range(repeats)))
+        recorder.record(name, repeats, time.perf_counter() - started, latencies, before)
+        print(f"{name}: {owm.connections - connections} соединений на {repeats} запросов")
+
+async def run_faults(recorder: Recorder, owm: FakeOpenWeather, cities: int, requests: int, concurrency: int):
+    """Сбои OpenWeather: полный отказ (503) и зависания при устаревшем кэше, нестабильный API без кэша
+    и восстановление. Показывает размыкание owm_breaker, отдачу устаревших данных и хвост задержек."""
+    import main
+
+    def expire_cache():
+        # Записи истекли, но ещё годятся как устаревшие (в пределах OWM_STALE_TTL)
+        now = asyncio.get_running_loop().time()
+        for key, entry in list(main.weather_cache._data.items()):
+            main.weather_cache._data[key] = (now - 1, *entry[1:])
+
+    async def phase(name: str, city_names: list[str]):
+        latencies, texts = [], Counter()
+        semaphore = asyncio.Semaphore(concurrency)
+        stale, errors, stalls = main.weather_cache.stale_served, owm.errors, owm.stalls
+
+        async def request(number: int):
+            async with semaphore:
+                step_started = time.perf_counter()
+                text = await main.get_weather(city_names[number % len(city_names)], main.OPENWEATHER_API_KEY)
+                latencies.append(time.perf_counter() - step_started)
+                texts['недоступно' if text == main.WEATHER_UNAVAILABLE_TEXT else 'ошибка' if not text.startswith('Погода') else 'ответ'] += 1
+
+        before = recorder.snapshot()
+        started = time.perf_counter()
+        await asyncio.gather(*(request(number) for number in range(requests)))
+        recorder.record(name, requests, time.perf_counter() - started, latencies, before)
+        print(f"{name}: {dict(texts)}, из них устаревших {main.weather_cache.stale_served - stale}; "
+              f"ответов 503 {owm.errors - errors}, зависаний {owm.stalls - stalls}; цепь {main.owm_breaker.stats()}")
+
+    saved_breaker = main.owm_breaker
+    # Короткая пауза размыкания, чтобы фаза восстановления не ждала OWM_BREAKER_RESET
+    main.owm_breaker = main.CircuitBreaker(main.OWM_BREAKER_THRESHOLD, 1.0)
+    known = [f'сбой-город-{i}' for i in range(cities)]
+    try:
+        await phase('faults/warm', known)
+        expire_cache()
+        owm.set_faults(error_rate=1.0)
+        await phase('faults/outage', known)
+        expire_cache()
+        owm.set_faults(stall_rate=1.0, stall=main.OWM_STALE_DEADLINE + 1)
+        main.owm_breaker = main.CircuitBreaker(main.OWM_BREAKER_THRESHOLD, 1.0)
+        await phase('faults/stall', known)
+        owm.set_faults(error_rate=0.2, stall_rate=0.05, stall=1.0)
+        await phase('faults/flaky-cold', [f'нестабильный-город-{i}' for i in range(cities)])
+        owm.set_faults()
+        await asyncio.sleep(main.owm_breaker.reset_timeout)
+        expire_cache()
+        await phase('faults/recovery', known)
+    finally:
+        owm.set_faults()
+        main.owm_breaker = saved_breaker
+
+async def run_db(recorder: Recorder, users: int, concurrency: int, iterations: int):
+    """Запросы меню избранного и подписок под конкурентными обновлениями: новое соединение на каждый
+    запрос прямо в цикле событий (как было до общего соединения) против общего соединения в потоке БД.
+    Заодно измеряется, на сколько запросы задерживают цикл событий."""
+    import main
+
+    def per_call(user_id: int):
+        with sqlite3.connect(main.DB_PATH) as conn:
+            [row[0] for row in conn.execute(
+                'SELECT city_name FROM favorite_cities WHERE user_id = ? ORDER BY city_name', (user_id,))]
+        with sqlite3.connect(main.DB_PATH) as conn:
+            conn.row_factory = sqlite3.Row
+            [dict(row) for row in conn.execute('SELECT * FROM subscriptions WHERE user_id = ? AND is_active = 1', (user_id,))]
+
+    async def per_call_update(user_id: int):
+        per_call(user_id)
+
+    async def pooled_update(user_id: int):
+        await main.get_favorite_cities(user_id)
+        await main.get_user_subscriptions(user_id)
+
+    async def watch_lag(lags: list[float]):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lags.append(time.perf_counter() - started - 0.001)
+
+    rng = random.Random(1)
+    user_ids = [rng.randint(1, users) for _ in range(iterations)]
+    for name, handle in (('db/connect-per-call', per_call_update), ('db/pooled', pooled_update)):
+        latencies, lags = [], []
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run_update(user_id: int):
+            async with semaphore:
+                step_started = time.perf_counter()
+                await handle(user_id)
+                latencies.append(time.perf_counter() - step_started)
+
+        watcher = asyncio.create_task(watch_lag(lags))
+        await asyncio.sleep(0)
+        before = recorder.snapshot()
+        started = time.perf_counter()
+        await asyncio.gather(*(run_update(user_id) for user_id in user_ids))
+        recorder.record(name, iterations, time.perf_counter() - started, latencies, before)
+        await asyncio.sleep(0.005)  # даём наблюдателю записать последнюю задержку
+        watcher.cancel()
+        print(f"{name}: задержка цикла событий p99 {percentile(lags, 0.99) * 1000:.2f} мс, max {max(lags, default=0) * 1000:.2f} мс")
+
+async def run_indexes(recorder: Recorder, workdir: str, rows: int, iterations: int):
+    """Горячие запросы к subscriptions на rows строках: по индексам и полным просмотром (NOT INDEXED)."""
+    import main
+
+    now = int(time.time())
+    async with separate_db(workdir, 'indexes.db'):
+        started = time.perf_counter()
+        await seed_bulk_subscriptions(rows, now)
+        print(f"Индексы: {rows} подписок записаны за {time.perf_counter() - started:.1f} с")
+        rng = random.Random(1)
+        users = rows // 4
+        queries = {
+            'index/user': lambda hint: main.db.fetchall(
+                f'SELECT * FROM subscriptions {hint} WHERE user_id = ? AND is_active = 1', (rng.randint(1, users),)),
+            'index/due': lambda hint: main.db.fetchall(
+                'SELECT id, user_id, city, time, days, timezone, next_run_utc FROM subscriptions '
+                f"{hint} WHERE is_active = 1 AND forecast_type = 'daily' AND next_run_utc <= ? AND (next_run_utc, id) > (?, ?) "
+                'ORDER BY next_run_utc, id LIMIT ?', (now + 60, 0, 0, main.DISPATCH_PAGE)),
+        }
+        for name, query in queries.items():
+            # Полный просмотр миллиона строк долгий, поэтому повторов у него меньше
+            for suffix, hint, repeats in (('', '', iterations), ('/scan', 'NOT INDEXED', max(1, iterations // 500))):
+                latencies, found = [], 0
+                before = recorder.snapshot()
+                started = time.perf_counter()
+                for _ in range(repeats):
+                    step_started = time.perf_counter()
+                    found += len(await query(hint))
+                    latencies.append(time.perf_counter() - step_started)
+                recorder.record(name + suffix, repeats, time.perf_counter() - started, latencies, before)
+            print(f"{name}: в среднем {found / repeats:.0f} строк на запрос")
+        size = os.path.getsize(main.DB_PATH)
+        print(f"Индексы: БД {size / 2 ** 20:.1f} МБ, {size / rows:.0f} байт на подписку")
+
+async def run_startup(recorder: Recorder, workdir: str, subscriptions: int):
+    """Запуск бота на БД с subscriptions подписками: миграции, сборка Application, post_init и первый
+    тик диспетчера. Для сравнения — загрузка всех активных подписок, как делал старый запуск."""
+    import main
+
+    now = int(time.time())
+    async with separate_db(workdir, 'startup.db'):
+        await seed_bulk_subscriptions(subscriptions, now - 30)
+        saved_queue = main.send_queue
+        main.send_queue = main.SendQueue(rate=10 ** 9, per_chat_interval=0, workers=main.SEND_WORKERS)
+        bot = FakeBot()
+        try:
+            before = recorder.snapshot()
+            started = time.perf_counter()
+            main.init_db()
+            application = main.build_application(main.SQLitePersistence(), bot=bot)
+            await application.initialize()
+            await main.post_init(application)
+            elapsed = time.perf_counter() - started
+            recorder.record('startup/init', 1, elapsed, [elapsed], before)
+
+            before = recorder.snapshot()
+            started = time.perf_counter()
+            await main.dispatch_daily_subscriptions(None)
+            await main.send_queue._queue.join()
+            elapsed = time.perf_counter() - started
+            recorder.record('startup/first-tick', 1, elapsed, [elapsed], before)
+            await application.shutdown()
+        finally:
+            await main.send_queue.stop()
+            main.send_queue = saved_queue
+
+        before = recorder.snapshot()
+        started = time.perf_counter()
+        loaded = len(await main.get_active_subscriptions('daily'))
+        elapsed = time.perf_counter() - started
+        recorder.record('startup/load-all', 1, elapsed, [elapsed], before)
+        print(f"Запуск: {subscriptions} подписок, первый тик отправил {bot.calls['sendMessage']} сообщений, "
+              f"загрузка всех ({loaded} ежедневных) заняла бы {elapsed * 1000:.0f} мс")
+
+def rss_mb() -> float:
+    # Текущий RSS (Linux): ru_maxrss не подходит — пиковое значение наследуется от родителя через exec
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+async def persistence_child(kind: str, workdir: str, users: int, dirty: int, cycles: int):
+    """Выполняется в отдельном процессе, чтобы RSS относился только к одному виду persistence.
+    Загрузка при старте, затем cycles циклов сохранения, в каждом изменились данные dirty пользователей."""
+    import main
+    from telegram.ext import PicklePersistence
+
+    bot = FakeBot()
+    rss_before = rss_mb()
+    if kind == 'pickle':
+        path = os.path.join(workdir, 'persistence.pickle')
+        persistence = PicklePersistence(filepath=path)
+    else:
+        path = main.DB_PATH = os.path.join(workdir, 'persistence.db')
+        main.db = main.Database(path)
+        persistence = main.SQLitePersistence()
+    persistence.set_bot(bot)
+
+    started = time.perf_counter()
+    user_data = await persistence.get_user_data()
+    await persistence.get_conversations('feedback')
+    load = time.perf_counter() - started
+
+    rng = random.Random(1)
+    latencies = []
+    for _ in range(cycles):
+        changed = rng.sample(range(1, users + 1), dirty)
+        for user_id in changed:
+            data = user_data.setdefault(user_id, {})
+            # Обновление пользователя: persistence сначала подгружает его данные, потом хендлер их меняет
+            await persistence.refresh_user_data(user_id, data)
+            user_data[user_id] = dict(data, next_action=rng.choice(('get_weather', 'get_forecast', 'get_hourly')))
+        # Так сохраняет Application.update_persistence: update_user_data по каждому изменённому пользователю
+        started = time.perf_counter()
+        await asyncio.gather(*(persistence.update_user_data(user_id, user_data[user_id]) for user_id in changed))
+        latencies.append(time.perf_counter() - started)
+    rss = rss_mb() - rss_before
+    if kind == 'sqlite':
+        await main.db.close()
+    print(json.dumps({'load': load, 'latencies': latencies, 'rss_mb': rss, 'size': os.path.getsize(path)}))
+
+async def run_persistence(recorder: Recorder, workdir: str, users: int, dirty: int, cycles: int):
+    """SQLitePersistence против PicklePersistence на users пользователях: задержка цикла сохранения и RSS."""
+    import main
+
+    workdir = os.path.join(workdir, 'persistence')
+    os.makedirs(workdir)
+    data = {
+        'user_data': {user_id: {'next_action': 'get_weather'} for user_id in range(1, users + 1)},
+        'chat_data': {}, 'bot_data': {}, 'callback_data': None,
+        'conversations': {'feedback': {(user_id, user_id): 0 for user_id in range(1, users + 1, 10)}},
+    }
+    path = os.path.join(workdir, 'persistence.pickle')
+    with open(path, 'wb') as f:
+        pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+    async with separate_db(workdir, 'persistence.db'):
+        await main.SQLitePersistence().import_pickle(path)
+
+    for kind in ('pickle', 'sqlite'):
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), '--persistence-child', kind, workdir,
+            '--persistence-users', str(users), '--persistence-dirty', str(dirty), '--persistence-cycles', str(cycles),
+            stdout=asyncio.subprocess.PIPE,
+        )
+        output, _ = await process.communicate()
+        result = json.loads(output.decode().strip().splitlines()[-1])
+        before = recorder.snapshot()
+        recorder.record(f'persistence/{kind}', cycles, sum(result['latencies']), result['latencies'], before)
+        print(f"persistence/{kind}: загрузка {result['load'] * 1000:.0f} мс, RSS +{result['rss_mb']:.1f} МБ, "
+              f"файл {result['size'] / 2 ** 20:.1f} МБ ({users} пользователей, {dirty} изменённых за цикл)")
+
+async def workers_child(path: str, ticks: int):
+    """Выполняется в отдельном процессе режима MULTI_WORKER (WORKER_ID задаёт родитель): по сигналу
+    родителя делает ticks тиков диспетчера ежедневных подписок и печатает, кому ушли сообщения."""
+    import main
+
+    main.DB_PATH = path
+    main.db = main.Database(path)
+    bot = FakeBot()
+    sent = []
+    post = bot._do_post
+
+    async def record_post(endpoint: str, data: dict, **kwargs):
+        if endpoint == 'sendMessage':
+            sent.append(int(data['chat_id']))
+        return await post(endpoint, data, **kwargs)
+
+    with bot._unfrozen():
+        bot._do_post = record_post
+    main.send_queue = main.SendQueue(rate=10 ** 9, per_chat_interval=0, workers=main.SEND_WORKERS)
+    main.send_queue.start(bot)
+    print('ready', flush=True)
+    await asyncio.to_thread(sys.stdin.readline)
+
+    started = time.perf_counter()
+    for _ in range(ticks):
+        await main.dispatch_daily_subscriptions(None)
+    await main.send_queue._queue.join()
+    elapsed = time.perf_counter() - started
+    await main.send_queue.stop()
+    await main.close_http_client()
+    await main.db.close()
+    print(json.dumps({'sent': sent, 'elapsed': elapsed}))
+
+async def run_workers(recorder: Recorder, workdir: str, workers: int, subscriptions: int):
+    """Несколько процессов MULTI_WORKER с общей БД одновременно разбирают одни и те же наступившие
+    ежедневные подписки. Каждая должна быть отправлена ровно один раз: ни дублей, ни пропусков."""
+    import main
+
+    minute = (int(time.time()) - 1) // 60 * 60
+    days = json.dumps(list(range(7)))
+    async with separate_db(workdir, 'workers.db'):
+        # По одной подписке на пользователя: все наступили в одну минуту
+        await main.db.executemany(
+            'INSERT INTO subscriptions (user_id, city, time, days, forecast_type, next_run_utc) VALUES (?, ?, ?, ?, ?, ?)',
+            [(user_id, f'workers-город-{user_id % 50}', '09:00', days, 'daily', minute)
+             for user_id in range(1, subscriptions + 1)]
+        )
+        path = main.DB_PATH
+
+    processes = [
+        await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), '--workers-child', path,
+            # Маленькие страницы: процессы чередуются на одних и тех же подписках, а не разбирают всё первым
+            env=dict(os.environ, MULTI_WORKER='1', WORKER_ID=f'benchmark-{n}', DISPATCH_PAGE='20'),
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+        )
+        for n in range(workers)
+    ]
+    # Стартуем одновременно, когда все процессы импортировали бота и открыли БД
+    for process in processes:
+        assert (await process.stdout.readline()).strip() == b'ready'
+    before = recorder.snapshot()
+    started = time.perf_counter()
+    for process in processes:
+        process.stdin.write(b'\n')
+    outputs = await asyncio.gather(*(process.communicate() for process in processes))
+    elapsed = time.perf_counter() - started
+    results = [json.loads(output.decode().strip().splitlines()[-1]) for output, _ in outputs]
+    recorder.record('workers/daily', subscriptions, elapsed, [result['elapsed'] for result in results], before)
+
+    sends = Counter((chat_id, minute) for result in results for chat_id in result['sent'])
+    duplicates = sum(count - 1 for count in sends.values())
+    missing = subscriptions - len(sends)
+    print(f"workers: {workers} процессов, {subscriptions} подписок, отправлено по процессам "
+          f"{[len(result['sent']) for result in results]}, дублей {duplicates}, пропусков {missing}")
+    assert duplicates == 0, f'{duplicates} повторных sendMessage на одного пользователя в одну минуту'
+    assert missing == 0, f'{missing} подписок не отправлено ни одним процессом'
+
+async def seed_subscriptions(users: int, cities: int) -> tuple[int, int]:
+    import main
+
+    days = json.dumps(list(range(7)))
+    for user_id in range(1, users + 1):
+        await main.add_favorite_city(user_id, f'favorites-город-{user_id % cities}')
+        await main.add_subscription(user_id, {'city': f'daily-город-{user_id % cities}', 'forecast_type': 'daily',
+                                              'time': '09:00', 'days': days})
+        await main.add_subscription(user_id, {'city': f'rain-город-{user_id % cities}', 'forecast_type': 'alert_rain'})
+    # Все ежедневные подписки «наступили» только что
+    await main.db.execute("UPDATE subscriptions SET next_run_utc = ? WHERE forecast_type = 'daily'", (int(time.time()) - 1,))
+    return users, users
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Регрессии относительно сохранённого прогона: пропускная способность, p99 и число запросов к API."""
+    problems = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if result['per_second'] < base['per_second'] * (1 - tolerance):
+            problems.append(f"{name}: {result['per_second']}/с против {base['per_second']}/с")
+        if result['p99_ms'] > base['p99_ms'] * (1 + tolerance) and result['p99_ms'] - base['p99_ms'] > 1:
+            problems.append(f"{name}: p99 {result['p99_ms']} мс против {base['p99_ms']} мс")
+        if result['owm_per_update'] > base['owm_per_update'] + 1e-9:
+            problems.append(f"{name}: {result['owm_per_update']} запросов к OpenWeather на обновление против {base['owm_per_update']}")
+    return problems
+
+async def run(args) -> dict:
+    owm = FakeOpenWeather(args.owm_latency)
+    await owm.start()
+    os.environ['OWM_BASE_URL'] = f'http://127.0.0.1:{owm.port}'
+    import main
+
+    workdir = tempfile.mkdtemp(prefix='weather-bench-')
+    main.DB_PATH = os.path.join(workdir, 'weather_bot.db')
+    main.db = main.Database(main.DB_PATH)
+    main.init_db()
+
+    bot = FakeBot()
+    application = main.build_application(main.SQLitePersistence(), bot=bot)
+    await application.initialize()
+    # Темп отправки Telegram в бенчмарке не ограничиваем — измеряется сам бот
+    main.send_queue = main.SendQueue(rate=10 ** 9, per_chat_interval=0, workers=main.SEND_WORKERS)
+    main.send_queue.start(bot)
+
+    # Пользователи сценариев шлют обновления подряд без пауз — лимиты проверяются отдельно в сценарии flood
+    main.update_guard = main.UpdateGuard(10 ** 9, 10 ** 9, 0)
+
+    recorder = Recorder(owm, bot)
+    updates = UpdateFactory(bot)
+    scenarios = build_scenarios(updates, args.users, args.cities)
+    daily, rain = await seed_subscriptions(args.users, args.cities)
+    try:
+        for name, sequence in scenarios.items():
+            if args.only and name not in args.only:
+                continue
+            for phase in ('cold', 'warm'):
+                await run_scenario(application, recorder, f'{name}/{phase}', sequence, args.users, args.concurrency)
+        if not args.only or 'flood' in args.only:
+            await run_flood(application, recorder, updates, args.users, 20)
+        if not args.only or 'send' in args.only:
+            await run_send(recorder, args.send_messages, args.send_chats, 2)
+        if not args.only or 'history' in args.only:
+            await run_history(recorder, args.history_places, args.history_days, args.iterations)
+        if not args.only or 'faults' in args.only:
+            await run_faults(recorder, owm, args.cities, args.users, args.concurrency)
+        if not args.only or 'http' in args.only:
+            await run_http(recorder, owm, args.concurrency, args.iterations)
+        if not args.only or 'db' in args.only:
+            await run_db(recorder, args.users, args.concurrency, args.iterations)
+        if not args.only or 'indexes' in args.only:
+            await run_indexes(recorder, workdir, args.index_rows, args.iterations)
+        if not args.only or 'startup' in args.only:
+            await run_startup(recorder, workdir, args.startup_subscriptions)
+        if not args.only or 'persistence' in args.only:
+            await run_persistence(recorder, workdir, args.persistence_users, args.persistence_dirty, args.persistence_cycles)
+        if not args.only or 'workers' in args.only:
+            await run_workers(recorder, workdir, args.workers, args.workers_subscriptions)
+        if not args.only or 'model' in args.only:
+            run_model(recorder, args.iterations)
+        if not args.only or 'spatial' in args.only:
+            run_spatial(recorder, args.spatial_points, args.iterations)
+        if not args.only or 'jobs' in args.only:
+            await run_job(recorder, 'job/daily', main.dispatch_daily_subscriptions, daily)
+            await run_job(recorder, 'job/rain', main.check_rain_alerts, rain)
+    finally:
+        await main.send_queue.stop()
+        await application.shutdown()
+        await main.close_http_client()
+        await main.db.close()
+        await owm.stop()
+
+    recorder.report()
+    print(f"Telegram: {dict(bot.calls)}")
+    print(f"OpenWeather: {dict(owm.calls)}")
+    return recorder.results
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--users', type=int, default=200, help='пользователей в каждом сценарии')
+    parser.add_argument('--cities', type=int, default=20, help='разных городов в каждом сценарии')
+    parser.add_argument('--concurrency', type=int, default=64, help='одновременно обрабатываемых пользователей')
+    parser.add_argument('--owm-latency', type=float, default=0.0, help='задержка ответа заглушки OpenWeather, с')
+    parser.add_argument('--only', nargs='*', help='сценарии: start weather forecast hourly location favorites flood send model spatial history faults http db indexes startup persistence workers jobs')
+    parser.add_argument('--send-messages', type=int, default=200, help='сообщений в сценарии send')
+    parser.add_argument('--send-chats', type=int, default=100, help='разных чатов в сценарии send')
+    parser.add_argument('--spatial-points', type=int, default=100000, help='точек в сценарии spatial')
+    parser.add_argument('--history-places', type=int, default=50, help='мест в сценарии history')
+    parser.add_argument('--history-days', type=int, default=40, help='суток наблюдений в сценарии history')
+    parser.add_argument('--index-rows', type=int, default=1000000, help='подписок в сценарии indexes')
+    parser.add_argument('--startup-subscriptions', type=int, default=100000, help='подписок в сценарии startup')
+    parser.add_argument('--persistence-users', type=int, default=100000, help='пользователей в сценарии persistence')
+    parser.add_argument('--persistence-dirty', type=int, default=20, help='изменённых пользователей за цикл сохранения')
+    parser.add_argument('--persistence-cycles', type=int, default=5, help='циклов сохранения в сценарии persistence')
+    parser.add_argument('--persistence-child', nargs=2, metavar=('KIND', 'DIR'), help=argparse.SUPPRESS)
+    parser.add_argument('--workers', type=int, default=4, help='процессов в сценарии workers')
+    parser.add_argument('--workers-subscriptions', type=int, default=400, help='подписок в сценарии workers')
+    parser.add_argument('--workers-child', metavar='DB', help=argparse.SUPPRESS)
+    parser.add_argument('--iterations', type=int, default=5000, help='повторов в сценариях model, spatial, history, http, db и indexes')
+    parser.add_argument('--json', help='сохранить результат в файл')
+    parser.add_argument('--baseline', help='сравнить с результатом из файла')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='допустимое ухудшение относительно baseline')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.persistence_child:
+        asyncio.run(persistence_child(*args.persistence_child, args.persistence_users, args.persistence_dirty, args.persistence_cycles))
+        sys.exit(0)
+    if args.workers_child:
+        asyncio.run(workers_child(args.workers_child, 2))
+        sys.exit(0)
+    results = asyncio.run(run(args))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            problems = compare(results, json.load(f), args.tolerance)
+        for problem in problems:
+            print(f'РЕГРЕССИЯ: {problem}')
+        sys.exit(1 if problems else 0)
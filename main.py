@@ -1,19 +1,36 @@
 import os
+import sys
 import httpx
 import sqlite3
 import json
+import pickle
+import hmac
+import secrets
+import socket
+import signal
 import pytz
 import types
-from datetime import datetime, time as dt_time
+from datetime import datetime, timedelta
 import asyncio
 import logging
 import warnings
+import itertools
+import math
+import random
+import contextvars
+from array import array
+import functools
+import bisect
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, Counter, deque
 from telegram.warnings import PTBUserWarning
 
 warnings.filterwarnings("ignore", category=PTBUserWarning)
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ParseMode
+from telegram.error import RetryAfter
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -22,7 +39,10 @@ from telegram.ext import (
     MessageHandler,
     filters,
     ConversationHandler,
-    PicklePersistence,
+    BasePersistence,
+    PersistenceInput,
+    TypeHandler,
+    ApplicationHandlerStop,
 )
 from dotenv import load_dotenv
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
@@ -34,8 +54,156 @@ PERSISTENCE_PATH = os.path.join(SCRIPT_DIR, 'bot_persistence.pickle')
 load_dotenv()
 TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 OPENWEATHER_API_KEY = os.getenv('OPENWEATHER_API_KEY')
+# Дополнительные ключи через запятую: запросы распределяются между ними с учётом квоты каждого
+OPENWEATHER_API_KEYS = [key.strip() for key in (os.getenv('OPENWEATHER_API_KEYS') or OPENWEATHER_API_KEY or '').split(',') if key.strip()]
 ADMIN_CHAT_ID = os.getenv('ADMIN_CHAT_ID')
 
+# --- Настройки HTTP-клиента OpenWeather ---
+OWM_BASE_URL = os.getenv('OWM_BASE_URL', 'https://api.openweathermap.org')
+OWM_TIMEOUT = float(os.getenv('OWM_TIMEOUT', '10'))
+OWM_CONNECT_TIMEOUT = float(os.getenv('OWM_CONNECT_TIMEOUT', '5'))
+OWM_MAX_CONNECTIONS = int(os.getenv('OWM_MAX_CONNECTIONS', '100'))
+OWM_MAX_KEEPALIVE = int(os.getenv('OWM_MAX_KEEPALIVE', '20'))
+OWM_KEEPALIVE_EXPIRY = float(os.getenv('OWM_KEEPALIVE_EXPIRY', '60'))
+
+# --- Настройки кэша ответов OpenWeather ---
+OWM_CACHE_SIZE = int(os.getenv('OWM_CACHE_SIZE', '5000'))
+# Время жизни записи (сек) для каждого эндпоинта; данные OpenWeather обновляются примерно раз в 10 минут
+OWM_CACHE_TTL = {
+    '/data/2.5/weather': 600,
+    '/data/2.5/forecast': 1800,
+}
+# Сколько секунд после истечения TTL запись ещё можно отдать как устаревшую, если API недоступен
+OWM_STALE_TTL = int(os.getenv('OWM_STALE_TTL', '3600'))
+# Сколько ждать обновления устаревшей записи, прежде чем отдать её как есть (обновление продолжается в фоне)
+OWM_STALE_DEADLINE = float(os.getenv('OWM_STALE_DEADLINE', '2'))
+
+# --- Настройки защиты от сбоев OpenWeather ---
+OWM_RETRIES = int(os.getenv('OWM_RETRIES', '2'))
+OWM_BACKOFF_BASE = float(os.getenv('OWM_BACKOFF_BASE', '0.5'))
+OWM_BACKOFF_MAX = float(os.getenv('OWM_BACKOFF_MAX', '5'))
+OWM_BREAKER_THRESHOLD = int(os.getenv('OWM_BREAKER_THRESHOLD', '5'))  # ошибок подряд до размыкания
+OWM_BREAKER_RESET = float(os.getenv('OWM_BREAKER_RESET', '30'))  # секунд до пробного запроса
+
+# --- Настройки квоты OpenWeather (на один ключ) ---
+# Квота считается в памяти каждого процесса. В режиме MULTI_WORKER задавайте лимиты в расчёте на процесс:
+# лимит ключа, делённый на число процессов, иначе суммарно процессы превысят его во столько же раз
+OWM_QUOTA_PER_MINUTE = int(os.getenv('OWM_QUOTA_PER_MINUTE', '60'))
+OWM_QUOTA_PER_DAY = int(os.getenv('OWM_QUOTA_PER_DAY', '30000'))
+# Фоновые задачи могут занять только эту долю квоты, остаток резервируется для запросов пользователей
+OWM_BACKGROUND_SHARE = float(os.getenv('OWM_BACKGROUND_SHARE', '0.8'))
+OWM_QUOTA_MAX_WAIT = float(os.getenv('OWM_QUOTA_MAX_WAIT', '120'))  # сколько фоновый запрос может ждать квоту
+WEATHER_UNAVAILABLE_TEXT = 'Сервис погоды временно недоступен. Пожалуйста, попробуйте через пару минут.'
+
+# --- Настройки рассылки ежедневных прогнозов ---
+DEFAULT_TIMEZONE = os.getenv('DEFAULT_TIMEZONE', 'Europe/Moscow')
+DISPATCH_CONCURRENCY = int(os.getenv('DISPATCH_CONCURRENCY', '20'))
+DISPATCH_MAX_CATCHUP = int(os.getenv('DISPATCH_MAX_CATCHUP', '5'))  # минут, которые можно догнать после задержки
+DISPATCH_PAGE = int(os.getenv('DISPATCH_PAGE', '1000'))  # подписок, читаемых из БД за раз
+
+# --- Настройки очереди исходящих сообщений ---
+# Telegram допускает ~30 сообщений в секунду на бота и ~1 в секунду в один чат;
+# часть глобального лимита оставляем для прямых ответов на действия пользователей
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', '25'))
+SEND_PER_CHAT_INTERVAL = float(os.getenv('SEND_PER_CHAT_INTERVAL', '1'))
+SEND_WORKERS = int(os.getenv('SEND_WORKERS', '8'))
+# Сколько секунд при остановке досылать очередь (Heroku ждёт 30 секунд после SIGTERM, потом убивает процесс)
+SEND_DRAIN_TIMEOUT = float(os.getenv('SEND_DRAIN_TIMEOUT', '20'))
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BROADCAST = 1
+PRIORITY_BULK = 2  # рассылки администратора уступают плановым прогнозам
+
+# --- Настройки рассылок администратора ---
+BROADCAST_PAGE = int(os.getenv('BROADCAST_PAGE', '200'))  # получателей, читаемых из БД за раз
+BROADCAST_CHECKPOINT_EVERY = 25  # сообщений между сохранениями прогресса (не больше стольких повторов после сбоя)
+BROADCAST_LEASE = 120  # секунд, после которых рассылку упавшего процесса подхватывает другой
+
+# --- Настройки обслуживания БД ---
+SUBSCRIPTION_RETENTION_DAYS = int(os.getenv('SUBSCRIPTION_RETENTION_DAYS', '30'))
+
+# --- Настройки оповещений о дожде ---
+RAIN_CHECK_INTERVAL = int(os.getenv('RAIN_CHECK_INTERVAL', '900'))
+RAIN_ALERT_COOLDOWN = int(os.getenv('RAIN_ALERT_COOLDOWN', '3600'))
+RAIN_LOOKAHEAD_HOURS = 4
+
+# --- Настройки прогрева кэша ---
+# Погода для городов, чьи подписки наступают в ближайшие WARMUP_LEAD_MINUTES минут, заранее загружается в кэш;
+# перед пиком рассылки (не меньше WARMUP_PEAK_SUBSCRIPTIONS таких подписок) — и для популярных городов.
+# WARMUP_LEAD_MINUTES должен быть меньше времени жизни кэша
+WARMUP_INTERVAL = int(os.getenv('WARMUP_INTERVAL', '60'))
+WARMUP_LEAD_MINUTES = int(os.getenv('WARMUP_LEAD_MINUTES', '5'))
+WARMUP_RATE = float(os.getenv('WARMUP_RATE', '2'))  # запросов к API в секунду
+WARMUP_POPULAR = int(os.getenv('WARMUP_POPULAR', '10'))
+WARMUP_PEAK_SUBSCRIPTIONS = int(os.getenv('WARMUP_PEAK_SUBSCRIPTIONS', '50'))
+WARMUP_QUOTA_SHARE = 0.5  # доля оставшейся фоновой квоты минуты, которую может занять прогрев
+WARMUP_POPULAR_HALF_LIFE = 3600  # за это время вес прошлых запросов города уменьшается вдвое
+
+# --- Настройки кэша меню и готовых текстов ---
+# Персональные меню сбрасываются при записи избранного и подписок этим процессом; в режиме MULTI_WORKER
+# записи могут прийти через другой процесс, поэтому там меню всегда строятся заново
+MENU_CACHE_SIZE = 0 if os.getenv('MULTI_WORKER') == '1' else int(os.getenv('MENU_CACHE_SIZE', '10000'))
+RENDER_CACHE_SIZE = int(os.getenv('RENDER_CACHE_SIZE', '2000'))
+
+# --- Настройки защиты от флуда ---
+# У каждого пользователя ведро на RATE_LIMIT_BURST обновлений, пополняемое на RATE_LIMIT_PER_SECOND в секунду;
+# повторное нажатие той же кнопки в течение CALLBACK_REPEAT_WINDOW секунд схлопывается в первое.
+# В режиме MULTI_WORKER ограничение действует в пределах одного процесса
+RATE_LIMIT_BURST = float(os.getenv('RATE_LIMIT_BURST', '8'))
+RATE_LIMIT_PER_SECOND = float(os.getenv('RATE_LIMIT_PER_SECOND', '1'))
+CALLBACK_REPEAT_WINDOW = float(os.getenv('CALLBACK_REPEAT_WINDOW', '2'))
+UPDATE_DEDUP_SIZE = 10000  # последних update_id, по которым отсеиваются повторные доставки
+
+# --- Настройки истории погоды ---
+# Полученная текущая погода копится в weather_observations и раз в час упаковывается по суткам в weather_history:
+# сырые точки хранятся HISTORY_RAW_DAYS дней, затем прореживаются до средних за час и удаляются
+# через HISTORY_RETENTION_DAYS дней
+HISTORY_RAW_DAYS = int(os.getenv('HISTORY_RAW_DAYS', '7'))
+HISTORY_RETENTION_DAYS = int(os.getenv('HISTORY_RETENTION_DAYS', '365'))
+HISTORY_FLUSH_INTERVAL = 60  # секунд между записями накопленных наблюдений в БД
+HISTORY_FLUSH_BATCH = 200  # столько наблюдений записываются сразу, не дожидаясь интервала
+HISTORY_PENDING_MAX = 10000  # при недоступной БД в памяти остаются только последние наблюдения
+HISTORY_MATCH_WINDOW = 5400  # «вчера в это время» — ближайшее наблюдение в пределах ±1.5 часа
+
+# --- Настройки погоды по геолокации ---
+# Геолокация в пределах LOCATION_SNAP_KM от известного города или от недавнего запроса другого
+# пользователя получает погоду для той же точки — из общего кэша, без обращения к API
+LOCATION_SNAP_KM = float(os.getenv('LOCATION_SNAP_KM', '3'))
+LOCATION_INDEX_SIZE = int(os.getenv('LOCATION_INDEX_SIZE', '10000'))
+
+# --- Настройки режима получения обновлений ---
+# Если задан WEBHOOK_URL, бот принимает обновления через вебхук, иначе работает через long polling
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('PORT', '8080'))
+WEBHOOK_MAX_BODY = 1024 * 1024
+# Медленные и зависшие клиенты не должны держать соединения вечно: сколько ждать заголовков и тела запроса,
+# сколько держать открытым простаивающее keep-alive соединение и сколько соединений принимать одновременно
+WEBHOOK_READ_TIMEOUT = float(os.getenv('WEBHOOK_READ_TIMEOUT', '10'))
+WEBHOOK_IDLE_TIMEOUT = float(os.getenv('WEBHOOK_IDLE_TIMEOUT', '60'))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '200'))
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '64'))
+
+# --- Настройки работы в несколько процессов ---
+# В режиме MULTI_WORKER несколько процессов бота (в режиме вебхука) используют общую weather_bot.db
+# и делят плановую рассылку через таблицу job_claims, чтобы каждая порция отправлялась ровно одним процессом.
+# Обновления одного пользователя могут попасть в разные процессы, поэтому user_data, chat_data и состояния
+# диалогов читаются из БД перед каждым обновлением и записываются сразу после него (см. SharedStateApplication).
+# Нужны WEBHOOK_URL и общий для всех процессов WEBHOOK_SECRET
+MULTI_WORKER = os.getenv('MULTI_WORKER') == '1'
+WORKER_ID = os.getenv('WORKER_ID') or f'{socket.gethostname()}:{os.getpid()}'
+JOB_CLAIM_RETENTION = 2 * 86400  # секунд
+
+# --- Настройки логирования и метрик ---
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# Метрики собираются только при METRICS_ENABLED=1 и отдаются на GET /metrics: в режиме вебхука — тем же
+# HTTP-сервером, в режиме polling — отдельным сервером на METRICS_PORT
+METRICS_ENABLED = os.getenv('METRICS_ENABLED') == '1'
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9090'))
+
+logger = logging.getLogger('weather_bot')
+
 # --- Состояния для ConversationHandler ---
 (
     SELECTING_ACTION, 
@@ -45,103 +213,1778 @@ ADMIN_CHAT_ID = os.getenv('ADMIN_CHAT_ID')
     AWAITING_FEEDBACK,
 ) = range(5)
 
+# --- Метрики ---
+class Metrics:
+    """Счётчики и гистограммы в текстовом формате Prometheus; при выключенных метриках вызовы ничего не делают."""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self._counters = {}  # (имя, метки) -> значение
+        self._histograms = {}  # (имя, метки) -> [число наблюдений по корзинам, сумма, количество]
+        self._collectors = []  # функции, возвращающие [(имя, тип, метки, значение)] в момент сбора
+
+    def inc(self, name: str, value: float = 1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = [[0] * (len(self.BUCKETS) + 1), 0.0, 0]
+        histogram[0][bisect.bisect_left(self.BUCKETS, value)] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+    def collector(self, fn):
+        """Регистрирует функцию, снимающую значения (размеры очередей, счётчики кэша) при каждом сборе."""
+        self._collectors.append(fn)
+        return fn
+
+    @staticmethod
+    def _labels(labels) -> str:
+        if not labels:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+        return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+    def render(self) -> str:
+        samples = [(name, 'counter', labels, value) for (name, labels), value in self._counters.items()]
+        for collect in self._collectors:
+            samples += [(name, kind, tuple(sorted(labels.items())), value) for name, kind, labels, value in collect()]
+        lines, typed = [], set()
+        for name, kind, labels, value in sorted(samples, key=lambda sample: (sample[0], sample[2])):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} {kind}')
+            lines.append(f'{name}{self._labels(labels)} {value}')
+        for (name, labels), (buckets, total, count) in sorted(self._histograms.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} histogram')
+            cumulative = 0
+            for bound, observed in zip((*self.BUCKETS, '+Inf'), buckets):
+                cumulative += observed
+                lines.append(f'{name}_bucket{self._labels((*labels, ("le", bound)))} {cumulative}')
+            lines.append(f'{name}_sum{self._labels(labels)} {total}')
+            lines.append(f'{name}_count{self._labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics(METRICS_ENABLED)
+
+def timed_callback(callback):
+    """Оборачивает колбэк хендлера замером времени выполнения."""
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except ApplicationHandlerStop:
+            # Не ошибка: так guard_updates и другие хендлеры останавливают дальнейшую обработку обновления
+            raise
+        except Exception:
+            metrics.inc('weatherbot_handler_errors_total', handler=name)
+            raise
+        finally:
+            metrics.observe('weatherbot_handler_seconds', time.perf_counter() - started, handler=name)
+    return wrapper
+
+def instrument_handlers(handlers, seen=None):
+    """Подключает timed_callback ко всем хендлерам, включая вложенные в ConversationHandler."""
+    seen = set() if seen is None else seen
+    for handler in handlers:
+        if id(handler) in seen:
+            continue
+        seen.add(id(handler))
+        if isinstance(handler, ConversationHandler):
+            instrument_handlers(handler.entry_points, seen)
+            for state_handlers in handler.states.values():
+                instrument_handlers(state_handlers, seen)
+            instrument_handlers(handler.fallbacks, seen)
+        else:
+            handler.callback = timed_callback(handler.callback)
+
 # --- Инициализация базы данных ---
+# Миграции схемы: номер миграции = индекс в списке + 1, текущая версия хранится в PRAGMA user_version.
+# Уже выпущенные миграции не меняются — изменения схемы добавляются новым элементом в конец.
+# Поэтому миграции не зависят ни от настроек окружения, ни от функций бота, которые могут измениться позже.
+
+def migrate_next_runs(conn: sqlite3.Connection):
+    """Миграция 6: время следующей отправки для существующих ежедневных подписок.
+    Все они на этот момент в поясе 'Europe/Moscow' (значение столбца timezone по умолчанию)."""
+    tz = pytz.timezone('Europe/Moscow')
+    now = datetime.now(tz)
+    rows = conn.execute(
+        "SELECT id, time, days FROM subscriptions WHERE forecast_type = 'daily' AND is_active = 1"
+    ).fetchall()
+    updates = []
+    for sub_id, time_str, days in rows:
+        try:
+            hour, minute = map(int, time_str.split(':'))
+            allowed_days = json.loads(days or '[]')
+            next_run = None
+            for offset in range(8):
+                day = now.date() + timedelta(days=offset)
+                # 0 — воскресенье, 6 — суббота, как в JobQueue.run_daily
+                if (day.weekday() + 1) % 7 not in allowed_days:
+                    continue
+                local = tz.normalize(tz.localize(datetime(day.year, day.month, day.day, hour, minute)))
+                if local > now:
+                    next_run = int(local.timestamp())
+                    break
+        except (ValueError, TypeError, AttributeError):
+            logger.warning('Invalid subscription schedule skipped: sub_id=%s time=%r days=%r', sub_id, time_str, days)
+            continue
+        updates.append((next_run, sub_id))
+    conn.executemany('UPDATE subscriptions SET next_run_utc = ? WHERE id = ?', updates)
+
+MIGRATIONS = [
+    # 1: исходная схема
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS user_preferences (
+            user_id INTEGER PRIMARY KEY, default_city TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS favorite_cities (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, city_name TEXT, UNIQUE(user_id, city_name)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            city TEXT NOT NULL,
+            time TEXT, -- Может быть NULL для оповещений типа 'alert_rain'
+            days TEXT, -- JSON list of ints 0-6. Может быть NULL для 'alert_rain'
+            forecast_type TEXT NOT NULL, -- 'daily' или 'alert_rain'
+            is_active BOOLEAN DEFAULT 1
+        )
+        ''',
+        # Справочник геокодирования: каждое нормализованное написание города (включая синонимы)
+        # хранится отдельной строкой и указывает на одни и те же координаты
+        '''
+        CREATE TABLE IF NOT EXISTS geocode (
+            name TEXT PRIMARY KEY, -- нормализованное название или синоним
+            canonical_name TEXT NOT NULL,
+            lat REAL NOT NULL,
+            lon REAL NOT NULL,
+            tz_offset INTEGER, -- смещение от UTC в секундах
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_subscriptions_time_days ON subscriptions (time, days)',
+    ],
+    # 2: частичные индексы по активным подпискам и время удаления для последующей очистки
+    [
+        'DROP INDEX IF EXISTS idx_subscriptions_time_days',
+        # Покрывающий индекс для диспетчера и выборок по типу подписки
+        'CREATE INDEX idx_subscriptions_due ON subscriptions (forecast_type, time, days, user_id, city) WHERE is_active = 1',
+        'CREATE INDEX idx_subscriptions_user_active ON subscriptions (user_id) WHERE is_active = 1',
+        'ALTER TABLE subscriptions ADD COLUMN deactivated_at INTEGER',  # unix-время отключения подписки
+    ],
+    # 3: состояние оповещений о дожде (паузы между повторными оповещениями)
+    [
+        '''
+        CREATE TABLE rain_alert_state (
+            sub_id INTEGER PRIMARY KEY,
+            cooldown_until INTEGER NOT NULL -- unix-время, до которого оповещение не повторяется
+        )
+        ''',
+    ],
+    # 4: состояние бота (user_data, chat_data, bot_data, диалоги) вместо pickle-файла
+    [
+        '''
+        CREATE TABLE persistence (
+            kind TEXT NOT NULL, -- 'user', 'chat', 'bot', 'callback' или 'conversation:<имя>'
+            key TEXT NOT NULL,
+            data BLOB NOT NULL, -- pickle
+            PRIMARY KEY (kind, key)
+        ) WITHOUT ROWID
+        ''',
+    ],
+    # 5: захваченные процессами порции плановой работы
+    [
+        '''
+        CREATE TABLE job_claims (
+            key TEXT PRIMARY KEY, -- например 'daily:2024-05-01T09:00:москва'
+            owner TEXT NOT NULL,
+            claimed_at INTEGER NOT NULL
+        ) WITHOUT ROWID
+        ''',
+        'CREATE INDEX idx_job_claims_claimed_at ON job_claims (claimed_at)',
+    ],
+    # 6: часовой пояс пользователя и заранее вычисленное время следующей отправки
+    [
+        "ALTER TABLE subscriptions ADD COLUMN timezone TEXT NOT NULL DEFAULT 'Europe/Moscow'",
+        'ALTER TABLE subscriptions ADD COLUMN next_run_utc INTEGER',  # unix-время
+        'ALTER TABLE user_preferences ADD COLUMN timezone TEXT',
+        'CREATE INDEX idx_subscriptions_next_run ON subscriptions (forecast_type, next_run_utc) WHERE is_active = 1',
+        migrate_next_runs,
+    ],
+    # 7: рассылки администратора с контрольной точкой для продолжения после перезапуска
+    [
+        '''
+        CREATE TABLE broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            city TEXT, -- нормализованное название: рассылка подписчикам города; NULL — всем пользователям
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running', -- 'running', 'done' или 'cancelled'
+            last_user_id INTEGER NOT NULL DEFAULT 0, -- всем получателям с user_id <= этого сообщение уже отправлено
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            owner TEXT, -- процесс, который ведёт рассылку
+            lease_until INTEGER, -- unix-время, до которого рассылку не подхватывает другой процесс
+            created_at INTEGER NOT NULL,
+            finished_at INTEGER
+        )
+        ''',
+        "CREATE INDEX idx_broadcasts_running ON broadcasts (id) WHERE status = 'running'",
+    ],
+    # 8: история погоды — свежие наблюдения построчно и упакованные по суткам столбцы (см. WeatherHistory)
+    [
+        '''
+        CREATE TABLE weather_observations (
+            place TEXT NOT NULL, -- координаты с точностью до 0.01°, см. place_key
+            ts INTEGER NOT NULL, -- unix-время наблюдения
+            temp INTEGER NOT NULL, -- десятые доли °C
+            humidity INTEGER NOT NULL, -- %
+            pressure INTEGER NOT NULL, -- гПа
+            wind INTEGER NOT NULL, -- десятые доли м/с
+            code INTEGER NOT NULL, -- код погоды OpenWeather
+            PRIMARY KEY (place, ts)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE weather_history (
+            place TEXT NOT NULL,
+            resolution INTEGER NOT NULL, -- 0 — все наблюдения, 3600 — средние за час
+            day INTEGER NOT NULL, -- начало суток UTC, unix-время
+            count INTEGER NOT NULL,
+            data BLOB NOT NULL, -- столбцы HISTORY_TYPECODES подряд, см. pack_points
+            PRIMARY KEY (place, resolution, day)
+        )
+        ''',
+        'CREATE INDEX idx_weather_history_age ON weather_history (resolution, day)',
+    ],
+]
+
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS user_preferences (
-        user_id INTEGER PRIMARY KEY, default_city TEXT
+    conn = sqlite3.connect(DB_PATH, isolation_level=None)
+    # WAL сохраняется в самом файле БД: читатели не блокируются записью
+    conn.execute('PRAGMA journal_mode = WAL')
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+        conn.execute('BEGIN')
+        try:
+            for statement in statements:
+                if callable(statement):
+                    statement(conn)
+                else:
+                    conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {number}')
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        logger.info('DB migrated: version=%s', number)
+    conn.close()
+
+# --- Соединение с БД ---
+class WriteResult:
+    """Итог изменяющего запроса. Курсор из потока БД не отдаётся: при его уничтожении в другом потоке
+    сбрасывается закэшированный запрос, которым в это время может пользоваться поток БД."""
+
+    __slots__ = ('rowcount', 'lastrowid')
+
+    def __init__(self, cursor: sqlite3.Cursor):
+        self.rowcount = cursor.rowcount
+        self.lastrowid = cursor.lastrowid
+
+class Database:
+    """Одно долгоживущее соединение с SQLite, все запросы выполняются в отдельном потоке."""
+
+    PRAGMAS = (
+        'PRAGMA journal_mode = WAL',
+        'PRAGMA synchronous = NORMAL',
+        'PRAGMA temp_store = MEMORY',
+        'PRAGMA cache_size = -16000',  # ~16 МБ
+        'PRAGMA mmap_size = 134217728',
+        'PRAGMA busy_timeout = 5000',
+        'PRAGMA foreign_keys = ON',
     )
-    ''')
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS favorite_cities (
-        id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, city_name TEXT, UNIQUE(user_id, city_name)
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+        # Один поток: соединение sqlite3 не потокобезопасно, а запись в SQLite всё равно последовательная
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite')
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+        conn.create_function('normalize_city', 1, normalize_city, deterministic=True)
+        return conn
+
+    def _call(self, fn, *args):
+        if self._conn is None:
+            self._conn = self._connect()
+        return fn(self._conn, *args)
+
+    async def run(self, fn, *args):
+        """Выполняет fn(conn, *args) в потоке БД."""
+        if not metrics.enabled:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, self._call, fn, *args)
+        # Время считается вместе с ожиданием в очереди потока БД — именно его видит вызывающий код
+        started = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, self._call, fn, *args)
+        finally:
+            metrics.observe('weatherbot_db_query_seconds', time.perf_counter() - started, op=fn.__name__.lstrip('_'))
+
+    async def execute(self, sql: str, params=()) -> WriteResult:
+        def _execute(conn):
+            with conn:
+                return WriteResult(conn.execute(sql, params))
+        return await self.run(_execute)
+
+    async def executemany(self, sql: str, seq_of_params) -> WriteResult:
+        def _executemany(conn):
+            with conn:
+                return WriteResult(conn.executemany(sql, seq_of_params))
+        return await self.run(_executemany)
+
+    async def fetchone(self, sql: str, params=()) -> sqlite3.Row | None:
+        def _fetchone(conn):
+            return conn.execute(sql, params).fetchone()
+        return await self.run(_fetchone)
+
+    async def fetchall(self, sql: str, params=()) -> list[sqlite3.Row]:
+        def _fetchall(conn):
+            return conn.execute(sql, params).fetchall()
+        return await self.run(_fetchall)
+
+    async def close(self):
+        def _close(conn):
+            conn.close()
+            self._conn = None
+        if self._conn is not None:
+            await self.run(_close)
+
+db = Database(DB_PATH)
+
+# --- Функции для работы с БД (Пользователи и Избранное) ---
+async def set_user_default_city(user_id: int, city: str):
+    await db.execute('INSERT OR REPLACE INTO user_preferences (user_id, default_city) VALUES (?, ?)', (user_id, city))
+
+async def get_user_default_city(user_id: int) -> str | None:
+    row = await db.fetchone('SELECT default_city FROM user_preferences WHERE user_id = ?', (user_id,))
+    return row[0] if row else None
+
+async def add_favorite_city(user_id: int, city: str) -> bool:
+    try:
+        await db.execute('INSERT INTO favorite_cities (user_id, city_name) VALUES (?, ?)', (user_id, city))
+        user_menus.invalidate(user_id)
+        return True
+    except sqlite3.IntegrityError:
+        return False
+
+async def get_favorite_cities(user_id: int) -> list[str]:
+    rows = await db.fetchall('SELECT city_name FROM favorite_cities WHERE user_id = ? ORDER BY city_name', (user_id,))
+    return [row[0] for row in rows]
+
+async def get_user_timezone(user_id: int) -> str:
+    row = await db.fetchone('SELECT timezone FROM user_preferences WHERE user_id = ?', (user_id,))
+    return (row[0] if row else None) or DEFAULT_TIMEZONE
+
+async def set_user_timezone(user_id: int, tz_name: str):
+    """Сохраняет часовой пояс пользователя и пересчитывает время отправки его ежедневных подписок."""
+    now = datetime.now().timestamp()
+
+    def update(conn):
+        with conn:
+            conn.execute(
+                'INSERT INTO user_preferences (user_id, timezone) VALUES (?, ?) '
+                'ON CONFLICT(user_id) DO UPDATE SET timezone = excluded.timezone',
+                (user_id, tz_name)
+            )
+            rows = conn.execute(
+                "SELECT id, time, days FROM subscriptions WHERE user_id = ? AND is_active = 1 AND forecast_type = 'daily'",
+                (user_id,)
+            ).fetchall()
+            conn.executemany(
+                'UPDATE subscriptions SET timezone = ?, next_run_utc = ? WHERE id = ?',
+                [(tz_name, compute_next_run(row['time'], row['days'], tz_name, now), row['id']) for row in rows]
+            )
+    await db.run(update)
+
+# --- Функции для работы с БД (Подписки) ---
+def compute_next_run(time_str: str, days: str | None, tz_name: str, after: float) -> int | None:
+    """Ближайшее после after время отправки (unix) для времени time_str в часовом поясе tz_name."""
+    tz = pytz.timezone(tz_name)
+    hour, minute = map(int, time_str.split(':'))
+    allowed_days = json.loads(days or '[]')
+    local_date = datetime.fromtimestamp(after, tz).date()
+    for offset in range(8):
+        day = local_date + timedelta(days=offset)
+        # Дни недели хранятся в формате JobQueue.run_daily: 0 — воскресенье, 6 — суббота
+        if (day.weekday() + 1) % 7 not in allowed_days:
+            continue
+        # normalize сдвигает время, попавшее в «пропущенный» час при переходе на летнее время
+        local = tz.normalize(tz.localize(datetime(day.year, day.month, day.day, hour, minute)))
+        if local.timestamp() > after:
+            return int(local.timestamp())
+    return None
+
+async def add_subscription(user_id: int, sub_data: dict) -> int:
+    tz_name = sub_data.get('timezone') or await get_user_timezone(user_id)
+    next_run = None
+    if sub_data['forecast_type'] == 'daily':
+        next_run = compute_next_run(sub_data['time'], sub_data.get('days'), tz_name, datetime.now().timestamp())
+    result = await db.execute(
+        'INSERT INTO subscriptions (user_id, city, time, days, forecast_type, timezone, next_run_utc) VALUES (?, ?, ?, ?, ?, ?, ?)',
+        (user_id, sub_data['city'], sub_data.get('time'), sub_data.get('days'), sub_data['forecast_type'], tz_name, next_run)
     )
-    ''')
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS subscriptions (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        city TEXT NOT NULL,
-        time TEXT, -- Может быть NULL для оповещений типа 'alert_rain'
-        days TEXT, -- JSON list of ints 0-6. Может быть NULL для 'alert_rain'
-        forecast_type TEXT NOT NULL, -- 'daily' или 'alert_rain'
-        is_active BOOLEAN DEFAULT 1
+    user_menus.invalidate(user_id)
+    return result.lastrowid
+
+async def get_user_subscriptions(user_id: int) -> list[dict]:
+    rows = await db.fetchall('SELECT * FROM subscriptions WHERE user_id = ? AND is_active = 1', (user_id,))
+    return [dict(row) for row in rows]
+
+async def get_active_subscriptions(forecast_type: str) -> list[dict]:
+    rows = await db.fetchall('SELECT * FROM subscriptions WHERE is_active = 1 AND forecast_type = ?', (forecast_type,))
+    return [dict(row) for row in rows]
+
+async def get_upcoming_daily_cities(until: int) -> list[tuple[str, int, int]]:
+    """Города ежедневных подписок, наступающих не позже until: (город, ближайшее время отправки, число подписок)."""
+    rows = await db.fetchall(
+        'SELECT city, MIN(next_run_utc) AS first_run, COUNT(*) AS count FROM subscriptions '
+        "WHERE is_active = 1 AND forecast_type = 'daily' AND next_run_utc <= ? GROUP BY city ORDER BY first_run",
+        (until,)
     )
-    ''')
-    conn.commit()
-    conn.close()
+    return [(row['city'], row['first_run'], row['count']) for row in rows]
+
+async def get_due_daily_subscriptions(until: int, after: tuple[int, int] = (0, 0), limit: int = DISPATCH_PAGE) -> list[dict]:
+    """Наступившие подписки по порядку (next_run_utc, id), начиная после after — страницами по limit."""
+    rows = await db.fetchall(
+        'SELECT id, user_id, city, time, days, timezone, next_run_utc FROM subscriptions '
+        "WHERE is_active = 1 AND forecast_type = 'daily' AND next_run_utc <= ? AND (next_run_utc, id) > (?, ?) "
+        'ORDER BY next_run_utc, id LIMIT ?',
+        (until, *after, limit)
+    )
+    return [dict(row) for row in rows]
 
-# --- Функции для работы с БД (Пользователи и Избранное) ---
-def set_user_default_city(user_id: int, city: str):
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute('INSERT OR REPLACE INTO user_preferences (user_id, default_city) VALUES (?, ?)', (user_id, city))
-        conn.commit()
-
-def get_user_default_city(user_id: int) -> str | None:
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT default_city FROM user_preferences WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
-        return result[0] if result else None
-
-def add_favorite_city(user_id: int, city: str):
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
+async def advance_daily_subscriptions(subs: list[dict], after: float):
+    """Переносит время следующей отправки доставленных (или пропущенных) подписок."""
+    await db.executemany(
+        'UPDATE subscriptions SET next_run_utc = ? WHERE id = ?',
+        [(compute_next_run(sub['time'], sub['days'], sub['timezone'], after), sub['id']) for sub in subs]
+    )
+
+async def delete_subscription(sub_id: int):
+    def _delete_subscription(conn):
+        with conn:
+            return conn.execute(
+                "UPDATE subscriptions SET is_active = 0, deactivated_at = CAST(strftime('%s', 'now') AS INTEGER) "
+                'WHERE id = ? RETURNING user_id',
+                (sub_id,)
+            ).fetchall()
+    for row in await db.run(_delete_subscription):
+        user_menus.invalidate(row[0])
+
+async def purge_inactive_subscriptions(older_than: int, batch_size: int = 10000) -> int:
+    """Физически удаляет подписки, отключённые раньше older_than (unix-время), небольшими порциями."""
+    total = 0
+    while True:
+        # Подписки без deactivated_at отключены до появления этой колонки и считаются старыми
+        result = await db.execute(
+            'DELETE FROM subscriptions WHERE id IN ('
+            ' SELECT id FROM subscriptions WHERE is_active = 0 AND (deactivated_at IS NULL OR deactivated_at < ?) LIMIT ?'
+            ')',
+            (older_than, batch_size)
+        )
+        total += result.rowcount
+        if result.rowcount < batch_size:
+            return total
+
+# --- Функции для работы с БД (Оповещения о дожде) ---
+async def get_rain_cooldowns(now: int) -> dict[int, int]:
+    rows = await db.fetchall('SELECT sub_id, cooldown_until FROM rain_alert_state WHERE cooldown_until > ?', (now,))
+    return {row[0]: row[1] for row in rows}
+
+async def save_rain_cooldowns(cooldowns: dict[int, int]):
+    await db.executemany(
+        'INSERT OR REPLACE INTO rain_alert_state (sub_id, cooldown_until) VALUES (?, ?)',
+        list(cooldowns.items())
+    )
+
+async def purge_rain_cooldowns(now: int) -> int:
+    result = await db.execute('DELETE FROM rain_alert_state WHERE cooldown_until <= ?', (now,))
+    return result.rowcount
+
+# --- Функции для работы с БД (Рассылки администратора) ---
+# Получатели читаются страницами по возрастанию user_id (keyset-пагинация), поэтому в памяти
+# одновременно только одна страница, а last_user_id служит и курсором, и контрольной точкой
+async def get_broadcast_recipients(city: str | None, after: int, limit: int) -> list[int]:
+    if city is None:
+        rows = await db.fetchall(
+            'SELECT user_id FROM user_preferences WHERE user_id > :after '
+            'UNION SELECT user_id FROM favorite_cities WHERE user_id > :after '
+            'UNION SELECT user_id FROM subscriptions WHERE is_active = 1 AND user_id > :after '
+            'ORDER BY user_id LIMIT :limit',
+            {'after': after, 'limit': limit}
+        )
+    else:
+        rows = await db.fetchall(
+            'SELECT DISTINCT user_id FROM subscriptions WHERE is_active = 1 AND user_id > ? AND normalize_city(city) = ? '
+            'ORDER BY user_id LIMIT ?',
+            (after, city, limit)
+        )
+    return [row[0] for row in rows]
+
+async def count_broadcast_recipients(city: str | None) -> int:
+    if city is None:
+        row = await db.fetchone(
+            'SELECT COUNT(*) FROM (SELECT user_id FROM user_preferences UNION SELECT user_id FROM favorite_cities '
+            'UNION SELECT user_id FROM subscriptions WHERE is_active = 1)'
+        )
+    else:
+        row = await db.fetchone(
+            'SELECT COUNT(DISTINCT user_id) FROM subscriptions WHERE is_active = 1 AND normalize_city(city) = ?', (city,)
+        )
+    return row[0]
+
+async def create_broadcast(city: str | None, text: str, now: int) -> int:
+    result = await db.execute(
+        'INSERT INTO broadcasts (city, text, owner, lease_until, created_at) VALUES (?, ?, ?, ?, ?)',
+        (city, text, WORKER_ID, now + BROADCAST_LEASE, now)
+    )
+    return result.lastrowid
+
+async def get_broadcast(broadcast_id: int) -> dict | None:
+    row = await db.fetchone('SELECT * FROM broadcasts WHERE id = ?', (broadcast_id,))
+    return dict(row) if row else None
+
+async def get_running_broadcasts() -> list[int]:
+    rows = await db.fetchall("SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id")
+    return [row[0] for row in rows]
+
+async def claim_broadcast(broadcast_id: int, now: int) -> bool:
+    """Забирает рассылку, если её никто не ведёт или аренда предыдущего процесса истекла."""
+    result = await db.execute(
+        "UPDATE broadcasts SET owner = ?, lease_until = ? WHERE id = ? AND status = 'running' "
+        'AND (owner IS NULL OR owner = ? OR lease_until < ?)',
+        (WORKER_ID, now + BROADCAST_LEASE, broadcast_id, WORKER_ID, now)
+    )
+    return result.rowcount == 1
+
+async def checkpoint_broadcast(broadcast_id: int, last_user_id: int, sent: int, failed: int, now: int) -> bool:
+    """Сохраняет прогресс и продлевает аренду; False — рассылку отменили или её забрал другой процесс."""
+    result = await db.execute(
+        'UPDATE broadcasts SET last_user_id = ?, sent = sent + ?, failed = failed + ?, lease_until = ? '
+        "WHERE id = ? AND owner = ? AND status = 'running'",
+        (last_user_id, sent, failed, now + BROADCAST_LEASE, broadcast_id, WORKER_ID)
+    )
+    return result.rowcount == 1
+
+async def renew_broadcast_lease(broadcast_id: int, now: int) -> bool:
+    result = await db.execute(
+        "UPDATE broadcasts SET lease_until = ? WHERE id = ? AND owner = ? AND status = 'running'",
+        (now + BROADCAST_LEASE, broadcast_id, WORKER_ID)
+    )
+    return result.rowcount == 1
+
+async def finish_broadcast(broadcast_id: int, now: int):
+    await db.execute(
+        "UPDATE broadcasts SET status = 'done', finished_at = ?, owner = NULL WHERE id = ? AND owner = ?",
+        (now, broadcast_id, WORKER_ID)
+    )
+
+async def cancel_broadcast(broadcast_id: int, now: int) -> bool:
+    result = await db.execute(
+        "UPDATE broadcasts SET status = 'cancelled', finished_at = ? WHERE id = ? AND status = 'running'",
+        (now, broadcast_id)
+    )
+    return result.rowcount == 1
+
+async def release_broadcasts():
+    """При остановке отдаёт свои рассылки, чтобы после перезапуска их сразу подхватили."""
+    await db.execute("UPDATE broadcasts SET owner = NULL WHERE owner = ? AND status = 'running'", (WORKER_ID,))
+
+# --- Распределение плановой работы между процессами ---
+class LocalClaimStore:
+    """Один процесс: вся плановая работа принадлежит ему."""
+
+    async def claim_many(self, keys: list[str]) -> set[str]:
+        return set(keys)
+
+    async def purge(self, older_than: int) -> int:
+        return 0
+
+    async def release(self, keys: set[str]):
+        pass
+
+class SQLiteClaimStore:
+    """Общая для процессов таблица job_claims: порцию работы получает тот, кто первым вставил её ключ."""
+
+    def __init__(self, owner: str):
+        self.owner = owner
+
+    async def claim_many(self, keys: list[str]) -> set[str]:
+        if not keys:
+            return set()
+        now = int(datetime.now().timestamp())
+
+        def claim(conn):
+            with conn:
+                conn.executemany(
+                    'INSERT OR IGNORE INTO job_claims (key, owner, claimed_at) VALUES (?, ?, ?)',
+                    [(key, self.owner, now) for key in keys]
+                )
+                placeholders = ','.join('?' * len(keys))
+                rows = conn.execute(
+                    f'SELECT key FROM job_claims WHERE owner = ? AND key IN ({placeholders})', (self.owner, *keys)
+                ).fetchall()
+            return {row[0] for row in rows}
+        return await db.run(claim)
+
+    async def purge(self, older_than: int) -> int:
+        result = await db.execute('DELETE FROM job_claims WHERE claimed_at < ?', (older_than,))
+        return result.rowcount
+
+    async def release(self, keys: set[str]):
+        """Отдаёт свои порции работы, чтобы их снова мог захватить любой процесс."""
+        await db.executemany('DELETE FROM job_claims WHERE key = ? AND owner = ?', [(key, self.owner) for key in keys])
+
+claim_store = SQLiteClaimStore(WORKER_ID) if MULTI_WORKER else LocalClaimStore()
+
+# --- Хранение состояния бота в БД ---
+class SQLitePersistence(BasePersistence):
+    """Persistence для python-telegram-bot поверх weather_bot.db.
+
+    В отличие от PicklePersistence записываются только изменившиеся ключи, одной транзакцией
+    на цикл сохранения, а user_data и chat_data читаются из БД при первом обращении к пользователю или чату.
+    С shared=True (режим MULTI_WORKER) данные перечитываются при каждом обращении: их мог изменить другой процесс.
+    """
+
+    def __init__(self, update_interval: float = 60, shared: bool = False):
+        # bot_data бот не использует; в общем режиме её запись после каждого обновления была бы лишней
+        super().__init__(store_data=PersistenceInput(bot_data=not shared), update_interval=update_interval)
+        self.shared = shared
+        self._loaded_users = set()
+        self._loaded_chats = set()
+        self._pending = {}  # (kind, key) -> pickle или None, если запись нужно удалить
+        self._batch: asyncio.Task | None = None
+
+    async def _write(self, kind: str, key, data):
+        self._pending[(kind, str(key))] = None if data is None else pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        if self._batch is None:
+            self._batch = asyncio.ensure_future(self._write_batch())
+        await asyncio.shield(self._batch)
+
+    async def _write_batch(self):
+        # Даём остальным update_* из того же цикла сохранения попасть в этот же пакет
+        await asyncio.sleep(0)
+        pending, self._pending, self._batch = self._pending, {}, None
+
+        def write(conn):
+            with conn:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO persistence (kind, key, data) VALUES (?, ?, ?)',
+                    [(kind, key, data) for (kind, key), data in pending.items() if data is not None]
+                )
+                conn.executemany(
+                    'DELETE FROM persistence WHERE kind = ? AND key = ?',
+                    [(kind, key) for (kind, key), data in pending.items() if data is None]
+                )
+        await db.run(write)
+
+    async def _read(self, kind: str, key):
+        row = await db.fetchone('SELECT data FROM persistence WHERE kind = ? AND key = ?', (kind, str(key)))
+        return pickle.loads(row[0]) if row else None
+
+    async def import_pickle(self, path: str):
+        """Однократно переносит данные из файла PicklePersistence, если таблица persistence ещё пуста."""
+        if not os.path.exists(path) or await db.fetchone('SELECT 1 FROM persistence LIMIT 1'):
+            return
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+        for user_id, user_data in (data.get('user_data') or {}).items():
+            self._pending[('user', str(user_id))] = pickle.dumps(user_data, pickle.HIGHEST_PROTOCOL)
+        for chat_id, chat_data in (data.get('chat_data') or {}).items():
+            self._pending[('chat', str(chat_id))] = pickle.dumps(chat_data, pickle.HIGHEST_PROTOCOL)
+        for name, conversations in (data.get('conversations') or {}).items():
+            for key, state in conversations.items():
+                if state is not None:
+                    self._pending[(f'conversation:{name}', json.dumps(key))] = pickle.dumps(state)
+        if data.get('bot_data'):
+            self._pending[('bot', '')] = pickle.dumps(data['bot_data'], pickle.HIGHEST_PROTOCOL)
+        imported = len(self._pending)
+        await self.flush()
+        logger.info('Imported persistence data: path=%s keys=%s', path, imported)
+
+    async def get_user_data(self) -> dict:
+        return {}
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return await self._read('bot', '') or {}
+
+    async def get_callback_data(self):
+        return await self._read('callback', '')
+
+    async def get_conversations(self, name: str) -> dict:
+        rows = await db.fetchall('SELECT key, data FROM persistence WHERE kind = ?', (f'conversation:{name}',))
+        return {tuple(json.loads(row[0])): pickle.loads(row[1]) for row in rows}
+
+    async def get_conversation_state(self, name: str, key: tuple):
+        return await self._read(f'conversation:{name}', json.dumps(key))
+
+    async def update_conversation(self, name: str, key: tuple, new_state):
+        await self._write(f'conversation:{name}', json.dumps(key), new_state)
+
+    async def update_user_data(self, user_id: int, data: dict):
+        await self._write('user', user_id, data or None)
+
+    async def update_chat_data(self, chat_id: int, data: dict):
+        await self._write('chat', chat_id, data or None)
+
+    async def update_bot_data(self, data: dict):
+        await self._write('bot', '', data or None)
+
+    async def update_callback_data(self, data):
+        await self._write('callback', '', data)
+
+    async def drop_user_data(self, user_id: int):
+        self._loaded_users.discard(user_id)
+        await self._write('user', user_id, None)
+
+    async def drop_chat_data(self, chat_id: int):
+        self._loaded_chats.discard(chat_id)
+        await self._write('chat', chat_id, None)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        if self.shared or user_id not in self._loaded_users:
+            self._loaded_users.add(user_id)
+            stored = await self._read('user', user_id) or {}
+            if self.shared:
+                user_data.clear()
+            user_data.update(stored)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        if self.shared or chat_id not in self._loaded_chats:
+            self._loaded_chats.add(chat_id)
+            stored = await self._read('chat', chat_id) or {}
+            if self.shared:
+                chat_data.clear()
+            chat_data.update(stored)
+
+    async def refresh_bot_data(self, bot_data: dict):
+        pass
+
+    async def flush(self):
+        if self._batch is not None:
+            await self._batch
+        if self._pending:
+            self._batch = asyncio.ensure_future(self._write_batch())
+            await self._batch
+
+# --- Общий HTTP-клиент для OpenWeather ---
+# Один клиент на всё приложение: соединения с api.openweathermap.org
+# переиспользуются (keep-alive), а не открываются заново на каждый запрос.
+http_client: httpx.AsyncClient | None = None
+
+def get_http_client() -> httpx.AsyncClient:
+    global http_client
+    if http_client is None or http_client.is_closed:
+        http_client = httpx.AsyncClient(
+            base_url=OWM_BASE_URL,
+            limits=httpx.Limits(
+                max_connections=OWM_MAX_CONNECTIONS,
+                max_keepalive_connections=OWM_MAX_KEEPALIVE,
+                keepalive_expiry=OWM_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(OWM_TIMEOUT, connect=OWM_CONNECT_TIMEOUT),
+        )
+    return http_client
+
+async def close_http_client():
+    global http_client
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+
+# --- Защита от сбоев OpenWeather ---
+class WeatherUnavailableError(Exception):
+    """Запрос к OpenWeather не выполнялся, чтобы не нагружать API."""
+
+class CircuitOpenError(WeatherUnavailableError):
+    """Запрос к OpenWeather не выполнялся: после серии ошибок цепь разомкнута."""
+
+class QuotaExceededError(WeatherUnavailableError):
+    """Запрос к OpenWeather не выполнялся: квота всех ключей на текущую минуту или сутки исчерпана."""
+
+class CircuitBreaker:
+    """Размыкается после failure_threshold ошибок подряд и reset_timeout секунд не пропускает запросы,
+    затем пропускает один пробный: успех замыкает цепь, ошибка снова размыкает."""
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: float | None = None
+        self._probe_started: float | None = None
+        self.trips = 0
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        return 'half-open' if self._probe_started is not None else 'open'
+
+    def before_call(self):
+        if self.opened_at is None:
+            return
+        now = asyncio.get_running_loop().time()
+        probe_running = self._probe_started is not None and now - self._probe_started < self.reset_timeout
+        if now - self.opened_at < self.reset_timeout or probe_running:
+            self.rejected += 1
+            raise CircuitOpenError('OpenWeather temporarily unavailable')
+        self._probe_started = now
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probe_started = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self._probe_started is not None or (self.opened_at is None and self.failures >= self.failure_threshold):
+            self.trips += 1
+            self.opened_at = asyncio.get_running_loop().time()
+            self._probe_started = None
+
+    def stats(self) -> dict:
+        return {'state': self.state, 'failures': self.failures, 'trips': self.trips, 'rejected': self.rejected}
+
+owm_breaker = CircuitBreaker(OWM_BREAKER_THRESHOLD, OWM_BREAKER_RESET)
+
+# --- Квота OpenWeather ---
+# Источник запроса ('interactive', 'daily', 'rain', ...) задаётся в начале фоновой задачи
+# и наследуется всеми запросами к API, сделанными из неё
+owm_source = contextvars.ContextVar('owm_source', default='interactive')
+
+class ApiQuota:
+    """Учёт обращений к OpenWeather по эндпоинтам и источникам запросов и ограничение по ключам.
+
+    Лимиты OpenWeather действуют на ключ целиком, сколько бы эндпоинтов он ни вызывал, поэтому
+    ограничение общее на ключ, а счётчики по эндпоинтам нужны только для статистики.
+    Сутки считаются по UTC, как и у OpenWeather.
+    """
+
+    def __init__(self, keys: list[str], per_minute: int, per_day: int, background_share: float):
+        self.per_minute = per_minute
+        self.per_day = per_day
+        self.background_share = background_share
+        self._usage = {key: [0, 0, 0, 0] for key in keys}  # key -> [минута, вызовов за минуту, день, вызовов за день]
+        self.calls = Counter()  # (эндпоинт, источник) -> число вызовов
+        self.rejected = Counter()  # источник -> число отказов
+
+    def _share(self, source: str) -> float:
+        return 1 if source == 'interactive' else self.background_share
+
+    @staticmethod
+    def _window() -> tuple[int, int]:
+        """Номера текущей минуты и текущих суток UTC."""
+        now = int(datetime.now().timestamp())
+        return now // 60, now // 86400
+
+    def _pick(self, source: str) -> str | None:
+        minute, day = self._window()
+        share = self._share(source)
+        best = None
+        for key, usage in self._usage.items():
+            if usage[0] != minute:
+                usage[0], usage[1] = minute, 0
+            if usage[2] != day:
+                usage[2], usage[3] = day, 0
+            if usage[1] < self.per_minute * share and usage[3] < self.per_day * share:
+                if best is None or usage[1] < self._usage[best][1]:
+                    best = key
+        return best
+
+    async def acquire(self, endpoint: str, default_key: str) -> str:
+        """Возвращает ключ для очередного вызова; фоновые запросы ждут следующей минуты, пользовательские — нет."""
+        if not self._usage:
+            return default_key
+        source = owm_source.get()
+        waited = 0.0
+        while True:
+            key = self._pick(source)
+            if key is not None:
+                self._usage[key][1] += 1
+                self._usage[key][3] += 1
+                self.calls[(endpoint, source)] += 1
+                return key
+            delay = 60 - datetime.now().timestamp() % 60 + random.uniform(0, 1)
+            if source == 'interactive' or waited + delay > OWM_QUOTA_MAX_WAIT:
+                self.rejected[source] += 1
+                raise QuotaExceededError(f'OpenWeather quota exhausted for {source} requests')
+            waited += delay
+            await asyncio.sleep(delay)
+
+    def available(self, source: str) -> int:
+        """Сколько ещё вызовов источник может сделать в текущую минуту по всем ключам."""
+        minute, day = self._window()
+        share = self._share(source)
+        if not self._usage:
+            return int(self.per_minute * share)
+        total = 0
+        for usage in self._usage.values():
+            minute_used = usage[1] if usage[0] == minute else 0
+            day_used = usage[3] if usage[2] == day else 0
+            total += max(0, min(self.per_minute * share - minute_used, self.per_day * share - day_used))
+        return int(total)
+
+    def used(self, source: str) -> int:
+        return sum(count for (_, call_source), count in self.calls.items() if call_source == source)
+
+    def exhaust(self, key: str):
+        """API ответило 429 — до конца минуты этот ключ не используем."""
+        if key in self._usage:
+            self._usage[key][1] = self.per_minute
+
+    def stats(self) -> dict:
+        stats = {'keys': len(self._usage), 'minute_used': sum(usage[1] for usage in self._usage.values()),
+                 'day_used': sum(usage[3] for usage in self._usage.values())}
+        stats.update({f'{endpoint.rsplit("/", 1)[-1]}/{source}': count for (endpoint, source), count in sorted(self.calls.items())})
+        stats.update({f'rejected/{source}': count for source, count in self.rejected.items()})
+        return stats
+
+owm_quota = ApiQuota(OPENWEATHER_API_KEYS, OWM_QUOTA_PER_MINUTE, OWM_QUOTA_PER_DAY, OWM_BACKGROUND_SHARE)
+
+def mark_stale(value, since: float):
+    """Копия значения из кэша с пометкой времени получения (словарь ответа API или разобранная модель)."""
+    if isinstance(value, dict):
+        return dict(value, _stale_since=since)
+    return value.stale_copy(since)
+
+def stale_note(data) -> str:
+    since = data.get('_stale_since') if isinstance(data, dict) else data.stale_since
+    if since is None:
+        return ''
+    return f"\n\n⚠️ Сервис погоды не отвечает, показаны данные на {datetime.fromtimestamp(since):%H:%M}."
+
+# --- Кэш ответов OpenWeather ---
+class TTLCache:
+    """LRU-кэш с временем жизни записей и объединением одновременных запросов по одному ключу.
+
+    Истёкшая запись хранится ещё stale_ttl секунд: если обновить её за stale_deadline не удалось,
+    отдаётся устаревшее значение с пометкой (см. mark_stale), а обновление продолжается в фоне.
+    """
+
+    def __init__(self, maxsize: int, stale_ttl: float = 0, stale_deadline: float = 0):
+        self.maxsize = maxsize
+        self.stale_ttl = stale_ttl
+        self.stale_deadline = stale_deadline
+        self._data = OrderedDict()  # key -> (expires_at, stale_until, fetched_at, value)
+        self._inflight = {}  # key -> (asyncio.Task, источник запроса, см. owm_source)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.coalesced = 0
+        self.stale_served = 0
+        self.prefetched = 0
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None or entry[0] < asyncio.get_running_loop().time():
+            return None
+        self._data.move_to_end(key)
+        return entry[3]
+
+    def set(self, key, value, ttl: float):
+        expires_at = asyncio.get_running_loop().time() + ttl
+        self._data[key] = (expires_at, expires_at + self.stale_ttl, datetime.now().timestamp(), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    async def get_or_fetch(self, key, ttl: float, fetch):
+        now = asyncio.get_running_loop().time()
+        entry = self._data.get(key)
+        if entry is not None and entry[0] >= now:
+            self.hits += 1
+            self._data.move_to_end(key)
+            return entry[3]
+        if entry is not None and entry[1] < now:
+            del self._data[key]
+            entry = None
+
+        # Если такой же запрос уже выполняется, ждём его результат вместо нового обращения к API
+        if self._joinable(key) is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+        task = self._start_fetch(key, ttl, fetch)
+        if entry is None:
+            return await asyncio.shield(task)
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), self.stale_deadline)
+        except (asyncio.TimeoutError, httpx.HTTPError, WeatherUnavailableError):
+            self.stale_served += 1
+            return mark_stale(entry[3], entry[2])
+
+    def expires_in(self, key) -> float:
+        """Сколько секунд запись ещё будет свежей (0, если её нет или она истекла)."""
+        entry = self._data.get(key)
+        return max(0.0, entry[0] - asyncio.get_running_loop().time()) if entry is not None else 0.0
+
+    async def refresh(self, key, ttl: float, fetch):
+        """Загружает значение заново, даже если запись ещё свежая (прогрев перед пиком)."""
+        self.prefetched += 1
+        return await asyncio.shield(self._start_fetch(key, ttl, fetch))
+
+    def _joinable(self, key) -> asyncio.Task | None:
+        """Выполняющийся запрос, к которому можно присоединиться. Пользовательский запрос не ждёт фоновый:
+        тот может стоять в очереди за квотой до OWM_QUOTA_MAX_WAIT, а пользовательские запросы идут первыми."""
+        inflight = self._inflight.get(key)
+        if inflight is None or (owm_source.get() == 'interactive' and inflight[1] != 'interactive'):
+            return None
+        return inflight[0]
+
+    def _start_fetch(self, key, ttl: float, fetch) -> asyncio.Task:
+        task = self._joinable(key)
+        if task is None:
+            # Задача копирует контекст, поэтому квоту запрашивает с источником того, кто её запустил
+            task = asyncio.ensure_future(fetch())
+            self._inflight[key] = (task, owm_source.get())
+            task.add_done_callback(lambda t: self._on_fetched(key, ttl, t))
+        return task
+
+    def _on_fetched(self, key, ttl: float, task: asyncio.Task):
+        # Параллельно с фоновым запросом мог начаться пользовательский — запись в _inflight уже его
+        if self._inflight.get(key, (None,))[0] is task:
+            del self._inflight[key]
+        if task.cancelled() or task.exception() is not None:
+            return
+        self.set(key, task.result(), ttl)
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'stale_served': self.stale_served,
+            'prefetched': self.prefetched,
+            'evictions': self.evictions,
+        }
+
+weather_cache = TTLCache(OWM_CACHE_SIZE, OWM_STALE_TTL, OWM_STALE_DEADLINE)
+
+def normalize_city(city: str) -> str:
+    return ' '.join(city.split()).casefold()
+
+def owm_cache_key(path: str, params: dict) -> tuple:
+    key = []
+    for name, value in sorted(params.items()):
+        if name == 'q':
+            value = normalize_city(value)
+        elif name in ('lat', 'lon'):
+            value = round(float(value), 2)
+        key.append((name, value))
+    return (path, *key)
+
+async def owm_request(path: str, api_key: str, **params) -> dict:
+    params.update(units='metric', lang='ru')
+    for attempt in range(OWM_RETRIES + 1):
+        owm_breaker.before_call()
+        params['appid'] = await owm_quota.acquire(path, api_key)
+        retry_after = 0.0
+        started = time.perf_counter()
+        try:
+            try:
+                response = await get_http_client().get(path, params=params)
+            except httpx.TransportError:
+                metrics.observe('weatherbot_owm_request_seconds', time.perf_counter() - started, endpoint=path, status='error')
+                raise
+            metrics.observe('weatherbot_owm_request_seconds', time.perf_counter() - started, endpoint=path, status=str(response.status_code))
+            if response.status_code == 429:
+                owm_quota.exhaust(params['appid'])
+            if response.status_code == 429 or response.status_code >= 500:
+                retry_after = float(response.headers.get('Retry-After') or 0)
+                response.raise_for_status()
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            owm_breaker.record_failure()
+            # Ретраи с «полным» джиттером; Retry-After от API соблюдаем, а слишком долгое ожидание не делаем вовсе
+            delay = max(random.uniform(0, min(OWM_BACKOFF_MAX, OWM_BACKOFF_BASE * 2 ** attempt)), retry_after)
+            if attempt == OWM_RETRIES or delay > OWM_BACKOFF_MAX:
+                raise
+            await asyncio.sleep(delay)
+            continue
+        owm_breaker.record_success()
+        # Остальные ошибки (например, 404 для неизвестного города) не повторяем
+        response.raise_for_status()
+        return response.json()
+
+async def owm_get(path: str, api_key: str, parse=None, **params):
+    """Запрос к OpenWeather через кэш; parse превращает ответ в модель до сохранения в кэш.
+
+    Один и тот же path всегда должен запрашиваться с одним и тем же parse — ключ кэша его не учитывает.
+    """
+    async def fetch():
+        data = await owm_request(path, api_key, **params)
+        return parse(data) if parse is not None else data
+
+    ttl = OWM_CACHE_TTL.get(path)
+    if not ttl:
+        return await fetch()
+    return await weather_cache.get_or_fetch(owm_cache_key(path, params), ttl, fetch)
+
+async def owm_prefetch(path: str, api_key: str, fresh_for: float, parse=None, **params) -> bool:
+    """Обновляет кэш, если запись не доживёт ещё fresh_for секунд; возвращает, был ли запрос к API."""
+    key = owm_cache_key(path, params)
+    if weather_cache.expires_in(key) >= fresh_for:
+        return False
+
+    async def fetch():
+        data = await owm_request(path, api_key, **params)
+        return parse(data) if parse is not None else data
+
+    await weather_cache.refresh(key, OWM_CACHE_TTL[path], fetch)
+    return True
+
+# --- Очередь исходящих сообщений ---
+class SendQueue:
+    """Очередь отправки с приоритетами и равномерной скоростью в пределах лимитов Telegram."""
+
+    def __init__(self, rate: float, per_chat_interval: float, workers: int):
+        self.rate = rate
+        self.per_chat_interval = per_chat_interval
+        self.workers = workers
+        self.bot = None
+        self._queue = asyncio.PriorityQueue()
+        self._seq = itertools.count()
+        self._tasks = []
+        self._next_global = 0.0
+        self._next_chat = {}  # chat_id -> время, раньше которого в чат писать нельзя
+        self._paused_until = 0.0
+        self._sent_times = deque(maxlen=10000)
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    def start(self, bot):
+        self.bot = bot
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def drain(self, timeout: float) -> bool:
+        """Ждёт отправки всего, что уже в очереди, не дольше timeout секунд; True — очередь опустела."""
         try:
-            cursor.execute('INSERT INTO favorite_cities (user_id, city_name) VALUES (?, ?)', (user_id, city))
-            conn.commit()
+            await asyncio.wait_for(self._queue.join(), timeout)
             return True
-        except sqlite3.IntegrityError:
+        except asyncio.TimeoutError:
             return False
 
-def get_favorite_cities(user_id: int) -> list[str]:
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT city_name FROM favorite_cities WHERE user_id = ? ORDER BY city_name', (user_id,))
-        return [row[0] for row in cursor.fetchall()]
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def send(self, chat_id: int | str, text: str, priority: int = PRIORITY_BROADCAST, **kwargs) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((priority, next(self._seq), chat_id, text, kwargs, future))
+        return future
+
+    def _reserve(self, chat_id) -> float:
+        """Занимает ближайший свободный слот отправки и возвращает, сколько секунд его ждать."""
+        now = asyncio.get_running_loop().time()
+        global_slot = max(now, self._paused_until, self._next_global)
+        chat_slot = self._next_chat.get(chat_id, 0.0)
+        send_at = max(global_slot, chat_slot)
+        self._next_global = global_slot + 1 / self.rate
+        self._next_chat[chat_id] = send_at + self.per_chat_interval
+        if len(self._next_chat) > 10000:
+            self._next_chat = {chat: at for chat, at in self._next_chat.items() if at > now}
+        return send_at - now
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._queue.get()
+            priority, seq, chat_id, text, kwargs, future = item
+            try:
+                if future.done():
+                    continue
+                delay = self._reserve(chat_id)
+                while delay > 0:
+                    await asyncio.sleep(delay)
+                    # Пока ждали слот, другой воркер мог получить RetryAfter — занимаем слот после паузы
+                    delay = self._reserve(chat_id) if self._paused_until > loop.time() else 0
+                message = await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+            except RetryAfter as e:
+                # Telegram просит подождать: приостанавливаем всю очередь и возвращаем сообщение на его место
+                self.retried += 1
+                self._paused_until = max(self._paused_until, loop.time() + float(e.retry_after))
+                self._queue.put_nowait(item)
+            except asyncio.CancelledError:
+                if not future.done():
+                    future.cancel()
+                raise
+            except Exception as e:
+                self.failed += 1
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                self.sent += 1
+                self._sent_times.append(loop.time())
+                if not future.done():
+                    future.set_result(message)
+            finally:
+                self._queue.task_done()
+
+    def stats(self) -> dict:
+        now = asyncio.get_running_loop().time()
+        sent_last_minute = sum(1 for at in self._sent_times if at > now - 60)
+        return {
+            'queued': self._queue.qsize(),
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'per_second_1m': round(sent_last_minute / 60, 2),
+        }
+
+send_queue = SendQueue(SEND_GLOBAL_RATE, SEND_PER_CHAT_INTERVAL, SEND_WORKERS)
+
+# --- Функции для работы с БД (Геокодирование) ---
+async def get_geocode(name: str) -> dict | None:
+    row = await db.fetchone('SELECT canonical_name, lat, lon, tz_offset FROM geocode WHERE name = ?', (normalize_city(name),))
+    return dict(row) if row else None
+
+async def save_geocode(aliases: list[str], canonical_name: str, lat: float, lon: float, tz_offset: int | None):
+    names = {normalize_city(alias) for alias in aliases}
+    await db.executemany(
+        'INSERT OR REPLACE INTO geocode (name, canonical_name, lat, lon, tz_offset) VALUES (?, ?, ?, ?, ?)',
+        [(name, canonical_name, lat, lon, tz_offset) for name in names]
+    )
 
-# --- Функции для работы с БД (Подписки) ---
-def add_subscription(user_id: int, sub_data: dict) -> int:
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            'INSERT INTO subscriptions (user_id, city, time, days, forecast_type) VALUES (?, ?, ?, ?, ?)',
-            (user_id, sub_data['city'], sub_data.get('time'), sub_data.get('days'), sub_data['forecast_type'])
+# --- Геокодирование городов ---
+# Координаты города запрашиваются у API только при первом обращении,
+# дальше берутся из памяти или из таблицы geocode.
+_geocode_memo: dict[str, dict] = {}
+
+async def lookup_location(city: str) -> dict | None:
+    key = normalize_city(city)
+    location = _geocode_memo.get(key)
+    if location is None:
+        location = await get_geocode(key)
+        if location is not None:
+            _geocode_memo[key] = location
+    return location
+
+async def resolve_city(city: str, api_key: str, via_forecast: bool = False) -> dict:
+    """Координаты города. Неизвестный город геокодируется ответом того эндпоинта, который нужен
+    представлению (via_forecast — /forecast, иначе /weather): этот же ответ кладётся в кэш по координатам,
+    и отдельного запроса для геокодирования не требуется."""
+    location = await lookup_location(city)
+    if location is not None:
+        return location
+
+    if via_forecast:
+        path = '/data/2.5/forecast'
+        data = await owm_get(path, api_key, parse=Forecast.from_payload, q=city)
+        location = dict(data.place)
+    else:
+        path = '/data/2.5/weather'
+        data = await owm_get(path, api_key, parse=parse_current, q=city)
+        location = {
+            'canonical_name': data['name'],
+            'lat': data['coord']['lat'],
+            'lon': data['coord']['lon'],
+            'tz_offset': data.get('timezone'),
+        }
+    await save_geocode([city, location['canonical_name']], **location)
+    _geocode_memo[normalize_city(city)] = location
+    _geocode_memo[normalize_city(location['canonical_name'])] = location
+    city_index.add(normalize_city(location['canonical_name']), location['lat'], location['lon'], location)
+    weather_cache.set(owm_cache_key(path, {'lat': location['lat'], 'lon': location['lon']}), data, OWM_CACHE_TTL[path])
+    return location
+
+# --- Пространственный индекс ---
+class SpatialIndex:
+    """Точки на сетке из ячеек со стороной cell_km по широте: поиск ближайшей точки в радиусе
+    просматривает только ячейки, которые этот радиус задевает."""
+
+    KM_PER_DEGREE = 111.32
+
+    def __init__(self, cell_km: float, maxsize: int | None = None):
+        self.cell = cell_km / self.KM_PER_DEGREE  # размер ячейки в градусах
+        self.maxsize = maxsize
+        self._cells = {}  # (строка, столбец) -> [(lat, lon, value)]
+        self._points = OrderedDict()  # key -> (ячейка, точка); порядок — для вытеснения самых старых
+
+    def __len__(self) -> int:
+        return len(self._points)
+
+    def _cell_of(self, lat: float, lon: float) -> tuple[int, int]:
+        return math.floor(lat / self.cell), math.floor(lon / self.cell)
+
+    def add(self, key, lat: float, lon: float, value):
+        self.discard(key)
+        cell, point = self._cell_of(lat, lon), (lat, lon, value)
+        self._cells.setdefault(cell, []).append(point)
+        self._points[key] = (cell, point)
+        if self.maxsize is not None and len(self._points) > self.maxsize:
+            self.discard(next(iter(self._points)))
+
+    def discard(self, key):
+        entry = self._points.pop(key, None)
+        if entry is None:
+            return
+        cell, point = entry
+        bucket = self._cells[cell]
+        bucket.remove(point)
+        if not bucket:
+            del self._cells[cell]
+
+    def nearest(self, lat: float, lon: float, radius_km: float) -> tuple | None:
+        """(value, расстояние в км) ближайшей точки не дальше radius_km или None."""
+        row, col = self._cell_of(lat, lon)
+        cos_lat = max(math.cos(math.radians(lat)), 0.01)
+        radius = radius_km / self.KM_PER_DEGREE
+        rows = math.ceil(radius / self.cell)
+        cols = math.ceil(radius / (self.cell * cos_lat))
+        best, best_distance = None, radius * radius
+        for r in range(row - rows, row + rows + 1):
+            for c in range(col - cols, col + cols + 1):
+                for point_lat, point_lon, value in self._cells.get((r, c), ()):
+                    # На расстояниях в несколько километров равнопромежуточной проекции достаточно
+                    dy, dx = point_lat - lat, (point_lon - lon) * cos_lat
+                    distance = dy * dy + dx * dx
+                    if distance <= best_distance:
+                        best, best_distance = value, distance
+        if best is None:
+            return None
+        return best, math.sqrt(best_distance) * self.KM_PER_DEGREE
+
+# Города из таблицы geocode (загружаются при первом запросе) и точки недавних запросов по геолокации
+city_index = SpatialIndex(LOCATION_SNAP_KM)
+location_index = SpatialIndex(LOCATION_SNAP_KM, maxsize=LOCATION_INDEX_SIZE)
+_city_index_loaded = False
+
+async def nearest_city(lat: float, lon: float, radius_km: float = LOCATION_SNAP_KM) -> dict | None:
+    """Ближайший известный город в радиусе — по локальной таблице geocode, без обращения к API."""
+    global _city_index_loaded
+    if not _city_index_loaded:
+        rows = await db.fetchall('SELECT canonical_name, lat, lon, tz_offset FROM geocode GROUP BY canonical_name')
+        for row in rows:
+            city_index.add(normalize_city(row['canonical_name']), row['lat'], row['lon'], dict(row))
+        _city_index_loaded = True
+    found = city_index.nearest(lat, lon, radius_km)
+    return found[0] if found else None
+
+async def snap_location(lat: float, lon: float) -> dict:
+    """Место для погоды по геолокации: ближайший город или точка недавнего запроса в радиусе LOCATION_SNAP_KM.
+    Если рядом ничего нет, сами координаты становятся точкой, к которой привяжутся соседние запросы."""
+    place = await nearest_city(lat, lon)
+    if place is not None:
+        return place
+    found = location_index.nearest(lat, lon, LOCATION_SNAP_KM)
+    if found is not None:
+        return found[0]
+    place = {'canonical_name': None, 'lat': round(lat, 4), 'lon': round(lon, 4), 'tz_offset': None}
+    location_index.add((place['lat'], place['lon']), place['lat'], place['lon'], place)
+    return place
+
+# --- Разобранный прогноз /forecast ---
+class Forecast:
+    """Прогноз с шагом 3 часа в виде параллельных массивов вместо списка словарей из ответа API.
+
+    Разбирается один раз при получении и в таком виде хранится в кэше; из него строятся
+    прогноз на 5 дней, почасовой прогноз и проверка оповещений о дожде.
+    """
+
+    __slots__ = ('timestamps', 'temps', 'codes', 'label_ids', 'labels', 'place', 'stale_since')
+
+    STEP = 3 * 3600
+
+    def __init__(self, timestamps: array, temps: array, codes: array, label_ids: array, labels: tuple,
+                 place: dict, stale_since: float | None = None):
+        self.timestamps = timestamps  # unix-время начала шага
+        self.temps = temps  # °C
+        self.codes = codes  # коды погодных условий OpenWeather (5xx — дождь)
+        self.label_ids = label_ids  # индексы описаний в labels
+        self.labels = labels
+        self.place = place  # место из ответа API в формате resolve_city
+        self.stale_since = stale_since
+
+    @classmethod
+    def from_payload(cls, data: dict) -> 'Forecast':
+        if data.get('cod') != '200':
+            raise ValueError(data.get('message', 'Неизвестная ошибка'))
+        timestamps, temps, codes, label_ids = array('q'), array('d'), array('H'), array('H')
+        labels = {}
+        for item in data['list']:
+            weather = item['weather'][0]
+            timestamps.append(item['dt'])
+            temps.append(item['main']['temp'])
+            codes.append(weather.get('id', 0))
+            label_ids.append(labels.setdefault(weather['description'], len(labels)))
+        city = data.get('city') or {}
+        place = {
+            'canonical_name': city.get('name'),
+            'lat': city.get('coord', {}).get('lat'),
+            'lon': city.get('coord', {}).get('lon'),
+            'tz_offset': city.get('timezone'),
+        }
+        return cls(timestamps, temps, codes, label_ids, tuple(labels), place)
+
+    def stale_copy(self, since: float) -> 'Forecast':
+        return Forecast(self.timestamps, self.temps, self.codes, self.label_ids, self.labels, self.place, since)
+
+    def daily(self, days: int) -> list[tuple]:
+        """Сводка по дням за один проход: [(время первого шага дня, минимум, максимум, преобладающее описание)]."""
+        summary, day = [], None
+        for timestamp, temp, label in zip(self.timestamps, self.temps, self.label_ids):
+            key = time.localtime(timestamp)[:3]
+            if key != day:
+                if len(summary) == days:
+                    break
+                day, counts = key, {}
+                entry = [timestamp, temp, temp, label, 0]
+                summary.append(entry)
+            if temp < entry[1]:
+                entry[1] = temp
+            elif temp > entry[2]:
+                entry[2] = temp
+            count = counts[label] = counts.get(label, 0) + 1
+            if count > entry[4]:
+                entry[3], entry[4] = label, count
+        return [(timestamp, low, high, self.labels[label]) for timestamp, low, high, label, _ in summary]
+
+    def hours(self, count: int) -> list[tuple]:
+        """Первые count шагов: [(время, температура, описание)]."""
+        return [(timestamp, temp, self.labels[label])
+                for timestamp, temp, label in zip(self.timestamps[:count], self.temps[:count], self.label_ids[:count])]
+
+    def has_rain(self, start: float, end: float) -> bool:
+        """Есть ли дождь в шагах, пересекающихся с интервалом [start, end)."""
+        return any(
+            500 <= code < 600 and timestamp < end and timestamp + self.STEP > start
+            for timestamp, code in zip(self.timestamps, self.codes)
         )
-        conn.commit()
-        return cursor.lastrowid
-
-def get_user_subscriptions(user_id: int) -> list[dict]:
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM subscriptions WHERE user_id = ? AND is_active = 1', (user_id,))
-        return [dict(row) for row in cursor.fetchall()]
 
-def delete_subscription(sub_id: int):
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute('UPDATE subscriptions SET is_active = 0 WHERE id = ?', (sub_id,))
-        conn.commit()
+async def get_forecast_model(lat: float, lon: float, api_key: str) -> Forecast:
+    return await owm_get('/data/2.5/forecast', api_key, parse=Forecast.from_payload, lat=lat, lon=lon)
+
+# --- Популярные города ---
+class PopularCities:
+    """Счётчик запросов погоды по городам с затуханием, чтобы популярность отражала недавние запросы."""
+
+    def __init__(self, half_life: float, maxsize: int = 1000):
+        self.half_life = half_life
+        self.maxsize = maxsize
+        self._counts = Counter()
+        self._decayed_at = datetime.now().timestamp()
+
+    def add(self, city: str):
+        self._counts[city] += 1
+
+    def top(self, limit: int) -> list[str]:
+        now = datetime.now().timestamp()
+        if now - self._decayed_at >= self.half_life:
+            factor = 0.5 ** ((now - self._decayed_at) / self.half_life)
+            self._counts = Counter({city: count * factor for city, count in self._counts.items() if count * factor >= 0.5})
+            self._decayed_at = now
+        if len(self._counts) > self.maxsize:
+            self._counts = Counter(dict(self._counts.most_common(self.maxsize)))
+        return [city for city, _ in self._counts.most_common(limit)]
+
+popular_cities = PopularCities(WARMUP_POPULAR_HALF_LIFE)
+
+# --- История погоды ---
+# Наблюдение — кортеж целых (ts, temp, humidity, pressure, wind, code); температура и ветер в десятых долях.
+# В упакованных сутках каждое поле хранится отдельным столбцом: смещение от начала суток и значения
+# фиксированной ширины, всего 13 байт на наблюдение
+HISTORY_TYPECODES = ('I', 'h', 'B', 'H', 'H', 'H')
+
+def place_key(lat: float, lon: float) -> str:
+    return f'{lat:.2f},{lon:.2f}'
+
+def pack_points(day: int, points: list[tuple]) -> bytes:
+    columns = [array(typecode) for typecode in HISTORY_TYPECODES]
+    for point in points:
+        columns[0].append(point[0] - day)
+        for column, value in zip(columns[1:], point[1:]):
+            column.append(value)
+    if sys.byteorder == 'big':  # на диске — little-endian
+        for column in columns:
+            column.byteswap()
+    return b''.join(column.tobytes() for column in columns)
+
+def unpack_points(day: int, count: int, data: bytes) -> list[tuple]:
+    columns, offset = [], 0
+    for typecode in HISTORY_TYPECODES:
+        column = array(typecode)
+        size = column.itemsize * count
+        column.frombytes(data[offset:offset + size])
+        if sys.byteorder == 'big':
+            column.byteswap()
+        columns.append(column)
+        offset += size
+    return [(day + ts, *values) for ts, *values in zip(*columns)]
+
+def downsample_hourly(points: list[tuple]) -> list[tuple]:
+    """Средние значения за каждый час; код погоды — самый частый за час."""
+    hours = {}
+    for point in points:
+        hours.setdefault(point[0] - point[0] % 3600, []).append(point)
+    result = []
+    for hour, group in sorted(hours.items()):
+        count = len(group)
+        means = [round(sum(point[field] for point in group) / count) for field in range(1, 5)]
+        code = Counter(point[5] for point in group).most_common(1)[0][0]
+        result.append((hour, *means, code))
+    return result
+
+class WeatherHistory:
+    """История полученной текущей погоды по местам.
+
+    Наблюдения копятся в памяти и пачками дописываются в weather_observations. compact() упаковывает
+    прошедшие сутки в одну строку weather_history, прореживает старые сутки до средних за час и удаляет
+    то, что старше срока хранения. Чтение диапазона — одна выборка по первичному ключу из каждой таблицы.
+    """
+
+    def __init__(self):
+        self._pending = []
+        self._flush_task = None
+        self.recorded = 0
+        self.flush_errors = 0
+
+    def record(self, data: dict):
+        """Запоминает наблюдение из ответа /weather; вызывается один раз на каждый полученный ответ."""
+        try:
+            point = (
+                place_key(data['coord']['lat'], data['coord']['lon']), int(data['dt']),
+                round(data['main']['temp'] * 10), int(data['main'].get('humidity', 0)),
+                int(data['main'].get('pressure', 0)), round(data.get('wind', {}).get('speed', 0) * 10),
+                int(data['weather'][0].get('id', 0)),
+            )
+        except (KeyError, IndexError, TypeError, ValueError):
+            return
+        self._pending.append(point)
+        self.recorded += 1
+        if len(self._pending) >= HISTORY_FLUSH_BATCH and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self) -> int:
+        points, self._pending = self._pending, []
+        if not points:
+            return 0
+        try:
+            # Один и тот же ответ может прийти в несколько процессов — повтор по (place, ts) пропускается
+            await db.executemany('INSERT OR IGNORE INTO weather_observations VALUES (?, ?, ?, ?, ?, ?, ?)', points)
+        except Exception:
+            # Наблюдения возвращаются в очередь и записываются следующим сбросом
+            self.flush_errors += 1
+            self._pending[:0] = points
+            del self._pending[:max(0, len(self._pending) - HISTORY_PENDING_MAX)]
+            logger.exception('Weather history flush failed: points=%s pending=%s', len(points), len(self._pending))
+            return 0
+        return len(points)
+
+    async def close(self):
+        """Дожидается фоновой записи и сбрасывает остаток — при остановке бота."""
+        if self._flush_task is not None:
+            await self._flush_task
+        await self.flush()
+
+    async def series(self, place: str, start: int, end: int) -> list[tuple]:
+        """Наблюдения места за [start, end] по возрастанию времени; для старых суток — средние за час."""
+        def _history_series(conn):
+            points = []
+            for day, count, data in conn.execute(
+                'SELECT day, count, data FROM weather_history '
+                'WHERE place = ? AND resolution IN (0, 3600) AND day BETWEEN ? AND ? ORDER BY day',
+                (place, start - start % 86400, end)
+            ):
+                points += [point for point in unpack_points(day, count, data) if start <= point[0] <= end]
+            points += map(tuple, conn.execute(
+                'SELECT ts, temp, humidity, pressure, wind, code FROM weather_observations '
+                'WHERE place = ? AND ts BETWEEN ? AND ? ORDER BY ts',
+                (place, start, end)
+            ))
+            return points
+        return await db.run(_history_series)
+
+    async def nearest(self, place: str, ts: int, window: int) -> tuple | None:
+        points = await self.series(place, ts - window, ts + window)
+        return min(points, key=lambda point: abs(point[0] - ts)) if points else None
+
+    async def compact(self, now: int) -> dict:
+        today = now - now % 86400
+        raw_before = today - HISTORY_RAW_DAYS * 86400
+        keep_from = today - HISTORY_RETENTION_DAYS * 86400
+
+        def _compact_history(conn):
+            stats = {'packed': 0, 'downsampled': 0, 'expired': 0}
+            with conn:
+                rows = conn.execute(
+                    'SELECT place, ts, temp, humidity, pressure, wind, code FROM weather_observations '
+                    'WHERE ts < ? ORDER BY place, ts',
+                    (today,)
+                ).fetchall()
+                for (place, day), group in itertools.groupby(rows, key=lambda row: (row[0], row[1] - row[1] % 86400)):
+                    points = [tuple(row)[1:] for row in group]
+                    packed = conn.execute(
+                        'SELECT count, data FROM weather_history WHERE place = ? AND resolution = 0 AND day = ?',
+                        (place, day)
+                    ).fetchone()
+                    if packed is not None:  # запоздавшие наблюдения уже упакованных суток
+                        merged = {point[0]: point for point in unpack_points(day, packed[0], packed[1])}
+                        merged.update((point[0], point) for point in points)
+                        points = sorted(merged.values())
+                    conn.execute('INSERT OR REPLACE INTO weather_history VALUES (?, 0, ?, ?, ?)',
+                                 (place, day, len(points), pack_points(day, points)))
+                    stats['packed'] += 1
+                conn.execute('DELETE FROM weather_observations WHERE ts < ?', (today,))
+
+                for place, day, count, data in conn.execute(
+                    'SELECT place, day, count, data FROM weather_history WHERE resolution = 0 AND day < ?', (raw_before,)
+                ).fetchall():
+                    hourly = downsample_hourly(unpack_points(day, count, data))
+                    conn.execute('INSERT OR REPLACE INTO weather_history VALUES (?, 3600, ?, ?, ?)',
+                                 (place, day, len(hourly), pack_points(day, hourly)))
+                    stats['downsampled'] += 1
+                conn.execute('DELETE FROM weather_history WHERE resolution = 0 AND day < ?', (raw_before,))
+                stats['expired'] = conn.execute(
+                    'DELETE FROM weather_history WHERE resolution = 3600 AND day < ?', (keep_from,)
+                ).rowcount
+            return stats
+        return await db.run(_compact_history)
+
+    def stats(self) -> dict:
+        return {'recorded': self.recorded, 'pending': len(self._pending), 'flush_errors': self.flush_errors}
+
+weather_history = WeatherHistory()
+
+def parse_current(data: dict) -> dict:
+    """parse для /weather: ответ кэшируется как есть, а наблюдение попадает в историю."""
+    weather_history.record(data)
+    return data
+
+async def history_note(data: dict) -> str:
+    """Сравнение с погодой сутки назад по собственной истории, без запросов к API."""
+    if '_stale_since' in data or 'coord' not in data or 'dt' not in data:
+        return ''
+    point = await weather_history.nearest(place_key(data['coord']['lat'], data['coord']['lon']),
+                                          data['dt'] - 86400, HISTORY_MATCH_WINDOW)
+    if point is None:
+        return ''
+    yesterday = point[1] / 10
+    diff = data['main']['temp'] - yesterday
+    if abs(diff) < 0.5:
+        trend = 'сегодня так же'
+    else:
+        trend = f"сегодня на {abs(diff):.1f}°C {'теплее' if diff > 0 else 'холоднее'}"
+    return f'\n📅 Вчера в это время: {yesterday:.1f}°C, {trend}'
+
+# --- Снимок погоды для места ---
+class WeatherSnapshot:
+    """Погода в одном месте: текущая (/weather) и прогноз (/forecast).
+
+    Части запрашиваются только те, что нужны представлению, и берутся из общего кэша по координатам,
+    поэтому все представления места (текущая погода, почасовой и 5-дневный прогноз, проверка дождя)
+    за окно кэша обходятся не больше чем одним запросом каждого вида.
+    """
+
+    __slots__ = ('name', 'lat', 'lon', 'current', 'forecast')
+
+    def __init__(self, name: str | None, lat: float, lon: float, current: dict | None, forecast: Forecast | None):
+        self.name = name
+        self.lat = lat
+        self.lon = lon
+        self.current = current
+        self.forecast = forecast
+
+async def get_snapshot(api_key: str, *, city: str = None, lat: float = None, lon: float = None, name: str = None,
+                       current: bool = False, forecast: bool = False) -> WeatherSnapshot:
+    """Снимок по названию города или по координатам с частями current и/или forecast."""
+    if city is not None:
+        location = await resolve_city(city, api_key, via_forecast=forecast and not current)
+        lat, lon, name = location['lat'], location['lon'], location['canonical_name']
+        if owm_source.get() == 'interactive':
+            popular_cities.add(name)
+    current_data = forecast_data = None
+    if current and forecast:
+        current_data, forecast_data = await asyncio.gather(
+            owm_get('/data/2.5/weather', api_key, parse_current, lat=lat, lon=lon), get_forecast_model(lat, lon, api_key)
+        )
+    elif current:
+        # Без gather: из кэша ответ приходит без переключения задач
+        current_data = await owm_get('/data/2.5/weather', api_key, parse_current, lat=lat, lon=lon)
+    elif forecast:
+        forecast_data = await get_forecast_model(lat, lon, api_key)
+    if not name:
+        name = current_data.get('name') if current_data else forecast_data.place['canonical_name']
+    return WeatherSnapshot(name or 'Неизвестное место', lat, lon, current_data, forecast_data)
+
+# --- Представления погоды ---
+def render_current(snapshot: WeatherSnapshot) -> str:
+    data = snapshot.current
+    main_data = data['main']
+    weather_data = data['weather'][0]
+    wind_speed = data['wind']['speed']
+    sunrise = datetime.fromtimestamp(data['sys']['sunrise']).strftime('%H:%M')
+    sunset = datetime.fromtimestamp(data['sys']['sunset']).strftime('%H:%M')
+    return (
+        f'Погода в {snapshot.name}:\n'
+        f'🌡️ Температура: {main_data["temp"]:.1f}°C (ощущается как {main_data["feels_like"]:.1f}°C)\n'
+        f'📝 Описание: {weather_data["description"].capitalize()}\n'
+        f'💧 Влажность: {main_data["humidity"]}%\n'
+        f'💨 Скорость ветра: {wind_speed} м/с\n'
+        f'🌅 Восход: {sunrise} | 🌇 Закат: {sunset}'
+    ) + stale_note(data)
+
+def render_five_day(snapshot: WeatherSnapshot) -> str:
+    message = [f"Прогноз на 5 дней для {snapshot.name}:\n"]
+    for timestamp, low, high, desc in snapshot.forecast.daily(5):
+        day = datetime.fromtimestamp(timestamp)
+        message.append(f"{day:%A} ({day:%Y-%m-%d}): {low:.0f}°C...{high:.0f}°C, {desc.capitalize()}")
+    return '\n'.join(message) + stale_note(snapshot.forecast)
+
+def render_hourly(snapshot: WeatherSnapshot) -> str:
+    message = [f'Почасовой прогноз в {snapshot.name} на 24 часа:\n']
+    for timestamp, temp, description in snapshot.forecast.hours(8):
+        message.append(f"{datetime.fromtimestamp(timestamp):%H:%M}: {temp:.1f}°C, {description.capitalize()}")
+    return '\n'.join(message) + stale_note(snapshot.forecast)
 
 # --- Функции получения погоды ---
 async def get_weather(city: str, api_key: str) -> str:
-    url = f'https://api.openweathermap.org/data/2.5/weather?q={city}&appid={api_key}&units=metric&lang=ru'
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url)
-            response.raise_for_status()
-            geodata = response.json()
-        
-        if geodata.get('cod') != 200:
-            return f"Ошибка: {geodata.get('message', 'Неизвестная ошибка')}. Проверьте название города."
-
-        lat, lon = geodata['coord']['lat'], geodata['coord']['lon']
-        return await get_weather_by_coords(lat, lon, api_key, geodata['name'])
-
+        snapshot = await get_snapshot(api_key, city=city, current=True)
+        return await current_text(snapshot)
+    except (WeatherUnavailableError, httpx.TransportError):
+        return WEATHER_UNAVAILABLE_TEXT
     except httpx.HTTPStatusError as e:
         if e.response.status_code == 404:
             return f"Город '{city}' не найден. Пожалуйста, проверьте название."
@@ -150,32 +1993,13 @@ async def get_weather(city: str, api_key: str) -> str:
         return f'Произошла непредвиденная ошибка: {e}'
 
 async def get_forecast(city: str, api_key: str) -> str:
-    url = f'https://api.openweathermap.org/data/2.5/forecast?q={city}&appid={api_key}&units=metric&lang=ru'
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url)
-            response.raise_for_status()
-            data = response.json()
-
-        if data.get('cod') != '200':
-            return f"Ошибка: {data.get('message', 'Неизвестная ошибка')}"
-
-        forecast_by_day = {}
-        for item in data['list']:
-            date = datetime.fromtimestamp(item['dt']).strftime('%Y-%m-%d')
-            if date not in forecast_by_day:
-                forecast_by_day[date] = []
-            forecast_by_day[date].append(item)
-        
-        message = [f"Прогноз на 5 дней для {data['city']['name']}:\n"]
-        for i, (date, forecasts) in enumerate(forecast_by_day.items()):
-            if i >= 5: break
-            day_name = datetime.strptime(date, '%Y-%m-%d').strftime('%A').capitalize()
-            day_temps = [f['main']['temp'] for f in forecasts]
-            desc = max(set(f['weather'][0]['description'] for f in forecasts), key=[f['weather'][0]['description'] for f in forecasts].count)
-            message.append(f"{day_name} ({date}): {min(day_temps):.0f}°C...{max(day_temps):.0f}°C, {desc.capitalize()}")
-        
-        return '\n'.join(message)
+        snapshot = await get_snapshot(api_key, city=city, forecast=True)
+        return rendered_texts.render('five_day', snapshot, snapshot.forecast, render_five_day)
+    except (WeatherUnavailableError, httpx.TransportError):
+        return WEATHER_UNAVAILABLE_TEXT
+    except ValueError as e:
+        return f"Ошибка: {e}"
     except Exception as e:
         return f'Произошла ошибка: {e}'
 
@@ -186,124 +2010,394 @@ def get_uv_index_description(uv_index: float) -> str:
     if uv_index < 11: return f"{uv_index} (Очень высокий)"
     return f"{uv_index} (Экстремальный)"
 
-async def get_one_call_data(lat: float, lon: float, api_key: str) -> dict:
-    url = f'https://api.openweathermap.org/data/2.5/onecall?lat={lat}&lon={lon}&exclude=minutely,alerts&appid={api_key}&units=metric&lang=ru'
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url)
-        response.raise_for_status()
-        return response.json()
-
 async def get_weather_by_coords(latitude: float, longitude: float, api_key: str, city_name: str = None) -> str:
     try:
-        url = f'https://api.openweathermap.org/data/2.5/weather?lat={latitude}&lon={longitude}&appid={api_key}&units=metric&lang=ru'
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url)
-            response.raise_for_status()
-            data = response.json()
-            
-        if not city_name:
-            city_name = data.get('name', 'Неизвестное место')
-            
-        main_data = data['main']
-        weather_data = data['weather'][0]
-        wind_speed = data['wind']['speed']
-        sunrise = datetime.fromtimestamp(data['sys']['sunrise']).strftime('%H:%M')
-        sunset = datetime.fromtimestamp(data['sys']['sunset']).strftime('%H:%M')
-        
-        return (
-            f'Погода в {city_name}:\n'
-            f'🌡️ Температура: {main_data["temp"]:.1f}°C (ощущается как {main_data["feels_like"]:.1f}°C)\n'
-            f'📝 Описание: {weather_data["description"].capitalize()}\n'
-            f'💧 Влажность: {main_data["humidity"]}%\n'
-            f'💨 Скорость ветра: {wind_speed} м/с\n'
-            f'🌅 Восход: {sunrise} | 🌇 Закат: {sunset}'
-        )
+        snapshot = await get_snapshot(api_key, lat=latitude, lon=longitude, name=city_name, current=True)
+        return await current_text(snapshot)
+    except (WeatherUnavailableError, httpx.TransportError):
+        return WEATHER_UNAVAILABLE_TEXT
     except Exception as e:
         return f'Произошла ошибка при получении погоды. Пожалуйста, попробуйте позже.'
 
 async def get_hourly_forecast(city: str, api_key: str) -> str:
-    url = f'https://api.openweathermap.org/data/2.5/forecast?q={city}&appid={api_key}&units=metric&lang=ru'
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url)
-            response.raise_for_status()
-            data = response.json()
-
-        if data.get('cod') != '200':
-            return f"Ошибка: {data.get('message', 'Неизвестная ошибка')}"
-
-        city_name = data['city']['name']
-        message = [f'Почасовой прогноз в {city_name} на 24 часа:\n']
-
-        for item in data['list'][:8]: 
-            time_str = datetime.fromtimestamp(item['dt']).strftime('%H:%M')
-            temp = item['main']['temp']
-            description = item['weather'][0]['description']
-            message.append(f"{time_str}: {temp:.1f}°C, {description.capitalize()}")
-        
-        return '\n'.join(message)
+        snapshot = await get_snapshot(api_key, city=city, forecast=True)
+        return rendered_texts.render('hourly', snapshot, snapshot.forecast, render_hourly)
+    except (WeatherUnavailableError, httpx.TransportError):
+        return WEATHER_UNAVAILABLE_TEXT
+    except ValueError as e:
+        return f"Ошибка: {e}"
     except Exception as e:
         return f'Произошла ошибка: {e}'
 
-# --- Основные команды и обработчики ---
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    print("DEBUG: Start function called")
-    try:
-        print(f"DEBUG: Update object: {update}")
-        print(f"DEBUG: Update type: {type(update)}")
-        print(f"DEBUG: Update ID: {update.update_id}")
-        
-        if update.message:
-            print(f"DEBUG: Message from: {update.message.from_user.username or update.message.from_user.id}")
-        if update.callback_query:
-            print(f"DEBUG: Callback from: {update.callback_query.from_user.username or update.callback_query.from_user.id}")
-            print(f"DEBUG: Callback data: {update.callback_query.data}")
-
-        keyboard = [
-            [InlineKeyboardButton("Текущая погода", callback_data='ask_city_weather')],
-            [InlineKeyboardButton("Прогноз на 5 дней", callback_data='ask_city_forecast')],
-            [InlineKeyboardButton("Почасовой прогноз", callback_data='ask_city_hourly')],
-            [InlineKeyboardButton("📍 Погода по местоположению", callback_data='get_weather_by_location')],
-            [InlineKeyboardButton("Избранные города", callback_data='show_favorite_cities')],
-            [InlineKeyboardButton("⚙️ Управление подписками", callback_data='manage_subscriptions')],
-            [InlineKeyboardButton("✍️ Обратная связь", callback_data='feedback_start')],
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+# --- Защита от флуда ---
+class UserBudget:
+    __slots__ = ('tokens', 'updated_at', 'callback_data', 'callback_at', 'warned')
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.updated_at = now
+        self.callback_data = None
+        self.callback_at = 0.0
+        self.warned = False
+
+class UpdateGuard:
+    """Фильтр на входе диспетчера: повторно доставленные update_id, повторные нажатия одной кнопки
+    и превышение личного лимита отсеиваются до хендлеров, то есть до запросов к API и к Telegram."""
+
+    def __init__(self, rate: float, burst: float, callback_window: float, seen_size: int = UPDATE_DEDUP_SIZE):
+        self.rate = rate
+        self.burst = burst
+        self.callback_window = callback_window
+        # Через столько секунд простоя ведро снова полное, а окно повтора закрыто: состояние пользователя
+        # не отличается от нового, и его можно забыть
+        self.idle = max(burst / rate if rate else 0.0, callback_window)
+        self._users = OrderedDict()  # user_id -> UserBudget, от давно неактивных к недавним
+        self._seen = OrderedDict()  # update_id -> None
+        self.seen_size = seen_size
+        self.passed = 0
+        self.dropped = Counter()
+
+    def check(self, update: Update, now: float = None) -> str | None:
+        """Возвращает причину отсева или None, если обновление нужно обработать."""
+        if update.update_id in self._seen:
+            self.dropped['duplicate'] += 1
+            return 'duplicate'
+        self._seen[update.update_id] = None
+        if len(self._seen) > self.seen_size:
+            self._seen.popitem(last=False)
+
         user = update.effective_user
-        text = f'Привет, {user.first_name}! Я MeteoBot. Выбери, что тебя интересует:'
-        
-        print("DEBUG: Attempting to send message...")
-        if update.callback_query:
-            print("DEBUG: Editing message via callback")
-            await update.callback_query.edit_message_text(text, reply_markup=reply_markup)
+        if user is None:
+            self.passed += 1
+            return None
+        now = time.monotonic() if now is None else now
+        # Неактивные пользователи лежат в начале: удаляем их, пока не встретим активного
+        while self._users:
+            user_id, budget = next(iter(self._users.items()))
+            if now - budget.updated_at < self.idle:
+                break
+            del self._users[user_id]
+
+        budget = self._users.get(user.id)
+        if budget is None:
+            budget = self._users[user.id] = UserBudget(self.burst, now)
         else:
-            print("DEBUG: Sending new message")
-            await update.message.reply_text(text, reply_markup=reply_markup)
-        print("DEBUG: Message sent successfully")
-        
-    except Exception as e:
-        print(f"ERROR in start function: {str(e)}")
-        print(f"ERROR Type: {type(e).__name__}")
-        if hasattr(e, '__traceback__'):
-            import traceback
-            print("Traceback:")
-            traceback.print_exc()
-        raise
+            budget.tokens = min(self.burst, budget.tokens + (now - budget.updated_at) * self.rate)
+            budget.updated_at = now
+            self._users.move_to_end(user.id)
+
+        query = update.callback_query
+        if query is not None:
+            if query.data == budget.callback_data and now - budget.callback_at < self.callback_window:
+                self.dropped['repeated'] += 1
+                return 'repeated'
+            budget.callback_data, budget.callback_at = query.data, now
+
+        if budget.tokens < 1:
+            self.dropped['limited'] += 1
+            return 'limited'
+        budget.tokens -= 1
+        budget.warned = False
+        self.passed += 1
+        return None
+
+    def warn_once(self, user_id: int) -> bool:
+        """Предупреждать о лимите только первое отсеянное обновление подряд, чтобы не отвечать на флуд флудом."""
+        budget = self._users.get(user_id)
+        if budget is None or budget.warned:
+            return False
+        budget.warned = True
+        return True
+
+    def stats(self) -> dict:
+        return {'users': len(self._users), 'passed': self.passed, **{reason: self.dropped[reason]
+                for reason in ('duplicate', 'repeated', 'limited')}}
+
+update_guard = UpdateGuard(RATE_LIMIT_PER_SECOND, RATE_LIMIT_BURST, CALLBACK_REPEAT_WINDOW)
+
+async def guard_updates(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Хендлер группы -1: отсеянное обновление не доходит до остальных групп."""
+    if is_admin_chat(update):
+        return
+    reason = update_guard.check(update)
+    if reason is None:
+        return
+    query = update.callback_query
+    if reason == 'limited' and update_guard.warn_once(update.effective_user.id):
+        if query is not None:
+            await query.answer('Слишком много запросов, подождите немного.')
+        elif update.effective_message is not None:
+            await update.effective_message.reply_text('Слишком много запросов, подождите немного.')
+    elif query is not None and reason != 'duplicate':
+        # Без ответа кнопка в клиенте крутит индикатор загрузки
+        await query.answer()
+    raise ApplicationHandlerStop
+
+def is_admin_chat(update: Update) -> bool:
+    return bool(ADMIN_CHAT_ID) and update.effective_chat is not None and str(update.effective_chat.id) == str(ADMIN_CHAT_ID)
+
+# --- Готовые тексты прогнозов ---
+class RenderCache:
+    """Отформатированные тексты по (представление, место): пока в кэше погоды лежит тот же
+    ответ API, текст берётся готовым, а не форматируется заново для каждого получателя."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()  # (представление, название, lat, lon) -> (исходные данные, текст)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, view: str, snapshot: WeatherSnapshot, source) -> str | None:
+        key = (view, snapshot.name, snapshot.lat, snapshot.lon)
+        entry = self._data.get(key)
+        # Версия снимка — сам объект из кэша погоды: новый ответ API или устаревшая копия — другой объект
+        if entry is not None and entry[0] is source:
+            self.hits += 1
+            self._data.move_to_end(key)
+            return entry[1]
+        self.misses += 1
+        return None
+
+    def put(self, view: str, snapshot: WeatherSnapshot, source, text: str):
+        key = (view, snapshot.name, snapshot.lat, snapshot.lon)
+        self._data[key] = (source, text)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def render(self, view: str, snapshot: WeatherSnapshot, source, render) -> str:
+        text = self.get(view, snapshot, source)
+        if text is None:
+            text = render(snapshot)
+            self.put(view, snapshot, source, text)
+        return text
+
+    def stats(self) -> dict:
+        return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses}
+
+rendered_texts = RenderCache(RENDER_CACHE_SIZE)
+
+async def current_text(snapshot: WeatherSnapshot) -> str:
+    """Текущая погода со сравнением со вчерашним днём; история читается один раз на ответ API."""
+    text = rendered_texts.get('current', snapshot, snapshot.current)
+    if text is None:
+        text = render_current(snapshot) + await history_note(snapshot.current)
+        rendered_texts.put('current', snapshot, snapshot.current, text)
+    return text
+
+# --- Клавиатуры и меню ---
+# Неизменные клавиатуры создаются один раз при импорте; объекты telegram неизменяемы и безопасно переиспользуются
+BACK_TO_MAIN_BUTTON = InlineKeyboardButton("◀️ Назад", callback_data='back_to_main')
+BACK_TO_MAIN_MARKUP = InlineKeyboardMarkup([[BACK_TO_MAIN_BUTTON]])
+BACK_TO_MAIN_MENU_BUTTON = InlineKeyboardButton("◀️ Назад в главное меню", callback_data='back_to_main_menu')
+MAIN_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Текущая погода", callback_data='ask_city_weather')],
+    [InlineKeyboardButton("Прогноз на 5 дней", callback_data='ask_city_forecast')],
+    [InlineKeyboardButton("Почасовой прогноз", callback_data='ask_city_hourly')],
+    [InlineKeyboardButton("📍 Погода по местоположению", callback_data='get_weather_by_location')],
+    [InlineKeyboardButton("Избранные города", callback_data='show_favorite_cities')],
+    [InlineKeyboardButton("⚙️ Управление подписками", callback_data='manage_subscriptions')],
+    [InlineKeyboardButton("✍️ Обратная связь", callback_data='feedback_start')],
+])
+
+class UserMenuCache:
+    """Готовые персональные меню (текст и клавиатура) по пользователям, чтобы повторное открытие меню
+    не обращалось к БД. Сбрасываются при изменении избранного или подписок пользователя."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._menus = OrderedDict()  # user_id -> {название меню: (текст, клавиатура)}
+        self._generation = 0  # растёт при каждом сбросе: меню, построенное до сброса, не сохраняется
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, user_id: int, name: str, build) -> tuple[str, InlineKeyboardMarkup]:
+        menus = self._menus.get(user_id)
+        if menus is not None and name in menus:
+            self.hits += 1
+            self._menus.move_to_end(user_id)
+            return menus[name]
+        self.misses += 1
+        generation = self._generation
+        menu = await build(user_id)
+        if self.maxsize and generation == self._generation:
+            self._menus.setdefault(user_id, {})[name] = menu
+            self._menus.move_to_end(user_id)
+            while len(self._menus) > self.maxsize:
+                self._menus.popitem(last=False)
+        return menu
+
+    def invalidate(self, user_id: int):
+        self._generation += 1
+        self._menus.pop(user_id, None)
+
+    def stats(self) -> dict:
+        return {'users': len(self._menus), 'hits': self.hits, 'misses': self.misses}
+
+user_menus = UserMenuCache(MENU_CACHE_SIZE)
+
+def subscription_buttons(subscriptions: list[dict]) -> list[list[InlineKeyboardButton]]:
+    rows = []
+    for sub in subscriptions:
+        sub_type_rus = "Ежедневный прогноз" if sub['forecast_type'] == 'daily' else "Оповещение о дожде"
+        rows.append([InlineKeyboardButton(f"{sub['city']} ({sub_type_rus})", callback_data=f"sub_view_{sub['id']}")])
+    return rows
+
+async def build_favorites_menu(user_id: int) -> tuple[str, InlineKeyboardMarkup]:
+    fav_cities = await get_favorite_cities(user_id)
+    if not fav_cities:
+        return 'У вас нет избранных городов.', BACK_TO_MAIN_MARKUP
+    keyboard = [[InlineKeyboardButton(city, callback_data=f'weather_fav_{city}')] for city in fav_cities]
+    keyboard.append([BACK_TO_MAIN_BUTTON])
+    return 'Ваши избранные города:', InlineKeyboardMarkup(keyboard)
+
+async def build_subscriptions_menu(user_id: int) -> tuple[str, InlineKeyboardMarkup]:
+    subscriptions = await get_user_subscriptions(user_id)
+    text = "⚙️ Управление подписками"
+    if subscriptions:
+        text += "\n\nВаши активные подписки:"
+    else:
+        text += "\n\nУ вас пока нет активных подписок."
+    keyboard = subscription_buttons(subscriptions)
+    keyboard.append([InlineKeyboardButton("➕ Создать новую подписку", callback_data='sub_new')])
+    keyboard.append([BACK_TO_MAIN_MENU_BUTTON])
+    return text, InlineKeyboardMarkup(keyboard)
+
+async def build_manage_subscriptions_menu(user_id: int) -> tuple[str, InlineKeyboardMarkup]:
+    subscriptions = await get_user_subscriptions(user_id)
+    text = "⚙️ <b>Управление подписками</b>\n\nЗдесь вы можете добавлять, просматривать и удалять свои подписки."
+    keyboard = [
+        [InlineKeyboardButton("➕ Добавить ежедневный прогноз", callback_data='sub_add_daily')],
+        [InlineKeyboardButton("🚨 Добавить оповещение о дожде", callback_data='sub_add_rain_alert')],
+    ]
+    if subscriptions:
+        text += "\n\nВаши активные подписки:"
+    else:
+        text += "\n\nУ вас пока нет активных подписок."
+    keyboard += subscription_buttons(subscriptions)
+    keyboard.append([BACK_TO_MAIN_MENU_BUTTON])
+    return text, InlineKeyboardMarkup(keyboard)
+
+# --- Основные команды и обработчики ---
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.effective_user
+    logger.debug('start: update_id=%s user_id=%s callback_data=%s', update.update_id, user.id,
+                 update.callback_query.data if update.callback_query else None)
+    text = f'Привет, {user.first_name}! Я MeteoBot. Выбери, что тебя интересует:'
+    if update.callback_query:
+        await update.callback_query.edit_message_text(text, reply_markup=MAIN_MENU_MARKUP)
+    else:
+        await update.message.reply_text(text, reply_markup=MAIN_MENU_MARKUP)
 
 async def set_city(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not context.args:
         await update.message.reply_text('Пример: /setcity Москва')
         return
     city = ' '.join(context.args)
-    set_user_default_city(update.effective_user.id, city)
+    await set_user_default_city(update.effective_user.id, city)
     await update.message.reply_text(f'Город по умолчанию установлен: {city}.')
 
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_admin_chat(update):
+        return
+    lines = ['📊 Кэш OpenWeather:'] + [f'{name}: {value}' for name, value in weather_cache.stats().items()]
+    lines += ['', '📨 Очередь отправки:'] + [f'{name}: {value}' for name, value in send_queue.stats().items()]
+    lines += ['', '🔌 OpenWeather:'] + [f'{name}: {value}' for name, value in owm_breaker.stats().items()]
+    lines += ['', '🔑 Квота OpenWeather:'] + [f'{name}: {value}' for name, value in owm_quota.stats().items()]
+    lines += ['', '🛡 Входящие обновления:'] + [f'{name}: {value}' for name, value in update_guard.stats().items()]
+    lines += ['', '📅 История погоды:'] + [f'{name}: {value}' for name, value in weather_history.stats().items()]
+    lines += ['', '🧩 Готовые тексты:'] + [f'{name}: {value}' for name, value in rendered_texts.stats().items()]
+    lines += ['', '📋 Меню пользователей:'] + [f'{name}: {value}' for name, value in user_menus.stats().items()]
+    await update.message.reply_text('\n'.join(lines))
+
+@metrics.collector
+def collect_runtime_metrics() -> list[tuple]:
+    """Снимает для /metrics те же показатели, что показывает /stats."""
+    cache, queue = weather_cache.stats(), send_queue.stats()
+    samples = [('weatherbot_cache_entries', 'gauge', {}, cache['size'])]
+    samples += [('weatherbot_cache_events_total', 'counter', {'event': event}, cache[event])
+                for event in ('hits', 'misses', 'coalesced', 'stale_served', 'prefetched', 'evictions')]
+    samples += [('weatherbot_send_queue_depth', 'gauge', {}, queue['queued'])]
+    samples += [('weatherbot_send_messages_total', 'counter', {'result': result}, queue[result])
+                for result in ('sent', 'failed', 'retried')]
+    samples += [('weatherbot_owm_breaker_open', 'gauge', {}, int(owm_breaker.state != 'closed')),
+                ('weatherbot_owm_breaker_trips_total', 'counter', {}, owm_breaker.trips)]
+    samples += [('weatherbot_owm_quota_calls_total', 'counter', {'endpoint': endpoint, 'source': source}, count)
+                for (endpoint, source), count in owm_quota.calls.items()]
+    samples += [('weatherbot_owm_quota_rejected_total', 'counter', {'source': source}, count)
+                for source, count in owm_quota.rejected.items()]
+    samples += [('weatherbot_updates_passed_total', 'counter', {}, update_guard.passed)]
+    samples += [('weatherbot_updates_dropped_total', 'counter', {'reason': reason}, count)
+                for reason, count in update_guard.dropped.items()]
+    samples += [('weatherbot_history_observations_total', 'counter', {}, weather_history.recorded)]
+    texts, menus = rendered_texts.stats(), user_menus.stats()
+    samples += [('weatherbot_render_cache_events_total', 'counter', {'event': event}, texts[event])
+                for event in ('hits', 'misses')]
+    samples += [('weatherbot_menu_cache_events_total', 'counter', {'event': event}, menus[event])
+                for event in ('hits', 'misses')]
+    return samples
+
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_admin_chat(update):
+        return
+    # Текст берём целиком, а не из context.args, чтобы сохранить переносы строк. Команду отрезаем по её entity:
+    # после неё может стоять перевод строки, а не пробел (команда — ASCII, так что длина в UTF-16 совпадает)
+    command = update.message.entities[0]
+    text = update.message.text[command.offset + command.length:].strip()
+    city = None
+    first_line, _, _ = text.partition('\n')
+    if '|' in first_line:
+        city, _, text = text.partition('|')
+        city, text = normalize_city(city), text.strip()
+    if not text:
+        await update.message.reply_text(
+            'Пример: /broadcast Текст для всех пользователей\n'
+            'или: /broadcast Москва | Текст для подписчиков города'
+        )
+        return
+
+    recipients = await count_broadcast_recipients(city)
+    if not recipients:
+        await update.message.reply_text('Получателей нет.')
+        return
+    broadcast_id = await create_broadcast(city, text, int(datetime.now().timestamp()))
+    start_broadcast(broadcast_id)
+    await update.message.reply_text(
+        f'Рассылка #{broadcast_id} запущена: {recipients} получателей.\nОтменить: /broadcast_cancel {broadcast_id}'
+    )
+
+async def broadcast_cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_admin_chat(update):
+        return
+    if not context.args or not context.args[0].isdigit():
+        await update.message.reply_text('Пример: /broadcast_cancel 12')
+        return
+    if await cancel_broadcast(int(context.args[0]), int(datetime.now().timestamp())):
+        await update.message.reply_text(f'Рассылка #{context.args[0]} остановлена.')
+    else:
+        await update.message.reply_text(f'Рассылка #{context.args[0]} не выполняется.')
+
+async def set_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not context.args:
+        tz_name = await get_user_timezone(update.effective_user.id)
+        await update.message.reply_text(f'Ваш часовой пояс: {tz_name}.\nПример: /timezone Europe/Berlin')
+        return
+    tz_name = context.args[0]
+    try:
+        pytz.timezone(tz_name)
+    except pytz.UnknownTimeZoneError:
+        await update.message.reply_text(f'Неизвестный часовой пояс "{tz_name}". Пример: /timezone Asia/Yekaterinburg')
+        return
+    await set_user_timezone(update.effective_user.id, tz_name)
+    await update.message.reply_text(f'Часовой пояс установлен: {tz_name}. Время ежедневных подписок пересчитано.')
+
 async def add_fav(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not context.args:
         await update.message.reply_text('Пример: /addfav Париж')
         return
     city = ' '.join(context.args).strip()
-    if add_favorite_city(update.effective_user.id, city):
+    if await add_favorite_city(update.effective_user.id, city):
         await update.message.reply_text(f'Город "{city}" добавлен в избранное.')
     else:
         await update.message.reply_text(f'Город "{city}" уже в избранном.')
@@ -317,13 +2411,13 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     city = update.message.text
     if action == 'get_weather':
         weather_info = await get_weather(city, OPENWEATHER_API_KEY)
-        await update.message.reply_text(weather_info, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data='back_to_main')]]))
+        await update.message.reply_text(weather_info, reply_markup=BACK_TO_MAIN_MARKUP)
     elif action == 'get_forecast':
         forecast_info = await get_forecast(city, OPENWEATHER_API_KEY)
-        await update.message.reply_text(forecast_info, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data='back_to_main')]]))
+        await update.message.reply_text(forecast_info, reply_markup=BACK_TO_MAIN_MARKUP)
     elif action == 'get_hourly':
         hourly_info = await get_hourly_forecast(city, OPENWEATHER_API_KEY)
-        await update.message.reply_text(hourly_info, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data='back_to_main')]]))
+        await update.message.reply_text(hourly_info, reply_markup=BACK_TO_MAIN_MARKUP)
     
     context.user_data.pop('next_action', None)
 
@@ -348,20 +2442,14 @@ async def button_callback_handler(update: Update, context: ContextTypes.DEFAULT_
     elif data.startswith('weather_fav_'):
         city = data.replace('weather_fav_', '')
         weather_info = await get_weather(city, OPENWEATHER_API_KEY)
-        await query.edit_message_text(weather_info, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data='back_to_main')]]))
+        await query.edit_message_text(weather_info, reply_markup=BACK_TO_MAIN_MARKUP)
     elif data == 'back_to_main':
         await start(update, context)
 
 async def show_favorite_cities_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    fav_cities = get_favorite_cities(query.from_user.id)
-    if not fav_cities:
-        await query.edit_message_text('У вас нет избранных городов.', reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data='back_to_main')]]))
-        return
-    
-    keyboard = [[InlineKeyboardButton(city, callback_data=f'weather_fav_{city}')] for city in fav_cities]
-    keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data='back_to_main')])
-    await query.edit_message_text('Ваши избранные города:', reply_markup=InlineKeyboardMarkup(keyboard))
+    text, reply_markup = await user_menus.get(query.from_user.id, 'favorites', build_favorites_menu)
+    await query.edit_message_text(text, reply_markup=reply_markup)
 
 # --- Система подписок (ConversationHandler) ---
 
@@ -390,24 +2478,7 @@ async def sub_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def sub_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    user_id = query.from_user.id
-    subscriptions = get_user_subscriptions(user_id)
-    
-    text = "⚙️ Управление подписками"
-    keyboard = []
-    if subscriptions:
-        text += "\n\nВаши активные подписки:"
-        for sub in subscriptions:
-            sub_type_rus = "Ежедневный прогноз" if sub['forecast_type'] == 'daily' else "Оповещение о дожде"
-            button_text = f"{sub['city']} ({sub_type_rus})"
-            keyboard.append([InlineKeyboardButton(button_text, callback_data=f"sub_view_{sub['id']}")])
-    else:
-        text += "\n\nУ вас пока нет активных подписок."
-    
-    keyboard.append([InlineKeyboardButton("➕ Создать новую подписку", callback_data='sub_new')])
-    keyboard.append([InlineKeyboardButton("◀️ Назад в главное меню", callback_data='back_to_main_menu')])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    text, reply_markup = await user_menus.get(query.from_user.id, 'subscriptions', build_subscriptions_menu)
     if query.message.text != text:
         await query.edit_message_text(text, reply_markup=reply_markup)
     else:
@@ -422,26 +2493,7 @@ async def manage_subscriptions_menu(update: Update, context: ContextTypes.DEFAUL
     if query:
         await query.answer()
 
-    user_id = update.effective_user.id
-    subs = get_user_subscriptions(user_id)
-
-    text = "⚙️ <b>Управление подписками</b>\n\nЗдесь вы можете добавлять, просматривать и удалять свои подписки."
-    keyboard = [
-        [InlineKeyboardButton("➕ Добавить ежедневный прогноз", callback_data='sub_add_daily')],
-        [InlineKeyboardButton("🚨 Добавить оповещение о дожде", callback_data='sub_add_rain_alert')],
-    ]
-
-    if subs:
-        text += "\n\nВаши активные подписки:"
-        for sub in subs:
-            sub_type_rus = "Ежедневный прогноз" if sub['forecast_type'] == 'daily' else "Оповещение о дожде"
-            button_text = f"{sub['city']} ({sub_type_rus})"
-            keyboard.append([InlineKeyboardButton(button_text, callback_data=f"sub_view_{sub['id']}")])
-    else:
-        text += "\n\nУ вас пока нет активных подписок."
-    
-    keyboard.append([InlineKeyboardButton("◀️ Назад в главное меню", callback_data='back_to_main_menu')])
-    
+    text, reply_markup = await user_menus.get(update.effective_user.id, 'manage_subscriptions', build_manage_subscriptions_menu)
     try:
         await query.edit_message_text(text, reply_markup=reply_markup)
     except:
@@ -461,9 +2513,10 @@ async def feedback_receive(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 
     if ADMIN_CHAT_ID:
         try:
-            await context.bot.send_message(
-                chat_id=ADMIN_CHAT_ID,
-                text=f"Новое сообщение от {user_name} (ID: {user_id}):\n\n{feedback_text}",
+            await send_queue.send(
+                ADMIN_CHAT_ID,
+                f"Новое сообщение от {user_name} (ID: {user_id}):\n\n{feedback_text}",
+                priority=PRIORITY_INTERACTIVE,
                 reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Ответить", callback_data=f'admin_reply_{user_id}')]])
             )
             await update.message.reply_text("Спасибо! Ваше сообщение отправлено разработчику.")
@@ -493,111 +2546,528 @@ async def admin_reply_receive(update: Update, context: ContextTypes.DEFAULT_TYPE
     pass
 
 # --- Логика планировщика ---
-async def send_daily_forecast(context: ContextTypes.DEFAULT_TYPE):
-    job = context.job
-    user_id, city = job.data['user_id'], job.data['city']
-    weather_info = await get_weather(city, OPENWEATHER_API_KEY)
-    await context.bot.send_message(chat_id=user_id, text=weather_info)
-
-async def check_rain_alerts(context: ContextTypes.DEFAULT_TYPE):
-    job = context.job
-    user_id, city = job.data['user_id'], job.data['city']
-    sub_id = job.data['sub_id']
-    
-    lock_job_name = f"rain_lock_{sub_id}"
-    if context.application.job_queue.get_jobs_by_name(lock_job_name):
+# Ежедневные подписки обслуживает один диспетчер: раз в минуту он выбирает по индексу next_run_utc
+# подписки, время которых наступило, запрашивает погоду по каждому городу один раз,
+# ставит готовый текст в send_queue всем подписчикам этого города и переносит next_run_utc на следующий раз.
+# Если погоду по городу получить не удалось, его подписки не переносятся: следующий запуск попробует снова,
+# пока отправка не опоздает больше чем на DISPATCH_MAX_CATCHUP минут.
+_delivery_reports: set[asyncio.Task] = set()
+# Поставленные в очередь, но ещё не отправленные сообщения рассылки: future -> (id подписки, её время, ключ захвата)
+_undelivered_daily: dict[asyncio.Future, tuple[int, int, str]] = {}
+
+def _forget_daily_send(future: asyncio.Future):
+    # Отменённое при остановке сообщение не отправлено — его подписку вернёт reschedule_undelivered_daily
+    if not future.cancelled():
+        _undelivered_daily.pop(future, None)
+
+async def reschedule_undelivered_daily():
+    """При остановке возвращает подпискам с неотправленными сообщениями их время отправки: после перезапуска
+    диспетчер отправит их снова, если опоздание не превысит DISPATCH_MAX_CATCHUP минут."""
+    pending = list(_undelivered_daily.values())
+    _undelivered_daily.clear()
+    if not pending:
         return
+    await db.executemany('UPDATE subscriptions SET next_run_utc = ? WHERE id = ?', [(run, sub_id) for sub_id, run, _ in pending])
+    await claim_store.release({key for _, _, key in pending})
+    logger.warning('Daily dispatch interrupted by shutdown: rescheduled=%s', len(pending))
+
+async def render_daily_forecast(city: str) -> str:
+    """Текст рассылки; в отличие от get_weather ошибка не превращается в текст, а пробрасывается."""
+    return await current_text(await get_snapshot(OPENWEATHER_API_KEY, city=city, current=True))
+
+async def report_daily_delivery(minute: int, futures: list[asyncio.Future]):
+    results = await asyncio.gather(*futures, return_exceptions=True)
+    failed = sum(isinstance(result, Exception) for result in results)
+    logger.info('Daily dispatch: minute=%s sent=%s failed=%s', f'{datetime.fromtimestamp(minute):%H:%M}', len(results) - failed, failed)
+
+async def deliver_daily_subscriptions(minute: int, subs: list[dict]) -> tuple[int, int]:
+    """Ставит рассылку минуты в очередь отправки; возвращает (поставлено сообщений, городов без погоды)."""
+    by_city = {}
+    for sub in subs:
+        by_city.setdefault(normalize_city(sub['city']), []).append(sub)
+
+    # Каждый город за каждую минуту рассылает только тот процесс, который его захватил
+    keys = {city: f'daily:{minute}:{city}' for city in by_city}
+    claimed = await claim_store.claim_many(list(keys.values()))
+    by_city = {city: group for city, group in by_city.items() if keys[city] in claimed}
+
+    semaphore = asyncio.Semaphore(DISPATCH_CONCURRENCY)
+
+    async def render(city: str) -> str:
+        async with semaphore:
+            return await render_daily_forecast(city)
+
+    city_subs = list(by_city.items())
+    texts = await asyncio.gather(*(render(group[0]['city']) for _, group in city_subs), return_exceptions=True)
+    delivered, futures, unavailable = [], [], 0
+    for text, (city, group) in zip(texts, city_subs):
+        if isinstance(text, Exception):
+            unavailable += 1
+            logger.warning('Daily dispatch: no weather, will retry: minute=%s city=%s subscriptions=%s error=%s: %s',
+                           f'{datetime.fromtimestamp(minute):%H:%M}', group[0]['city'], len(group), type(text).__name__, text)
+            continue
+        # Отправку и соблюдение лимитов Telegram берёт на себя send_queue; диспетчер её не ждёт,
+        # иначе большая рассылка занимает его дольше минуты и следующие запуски пропускаются
+        for sub in group:
+            future = send_queue.send(sub['user_id'], text)
+            _undelivered_daily[future] = (sub['id'], sub['next_run_utc'], keys[city])
+            future.add_done_callback(_forget_daily_send)
+            futures.append(future)
+        delivered += group
+    await advance_daily_subscriptions(delivered, minute)
+    if futures:
+        task = asyncio.create_task(report_daily_delivery(minute, futures))
+        _delivery_reports.add(task)
+        task.add_done_callback(_delivery_reports.discard)
+    return len(futures), unavailable
+
+async def dispatch_daily_subscriptions(context: ContextTypes.DEFAULT_TYPE):
+    owm_source.set('daily')
+    now = int(datetime.now().timestamp())
+    # Отправки, опоздавшие больше чем на DISPATCH_MAX_CATCHUP минут (например, бот был выключен),
+    # не досылаются, а просто переносятся на следующий раз
+    stale_before = now - DISPATCH_MAX_CATCHUP * 60
+    # После простоя наступивших подписок может быть очень много: читаем и переносим их страницами
+    after = (0, 0)
+    while True:
+        page = await get_due_daily_subscriptions(now, after)
+        if not page:
+            break
+        after = (page[-1]['next_run_utc'], page[-1]['id'])
+        by_minute, stale = {}, []
+        for sub in page:
+            if sub['next_run_utc'] < stale_before:
+                stale.append(sub)
+            else:
+                by_minute.setdefault(sub['next_run_utc'] // 60 * 60, []).append(sub)
+
+        if stale:
+            await advance_daily_subscriptions(stale, now)
+        for minute, subs in sorted(by_minute.items()):
+            # Задержка фактической отправки относительно запланированной минуты
+            metrics.observe('weatherbot_scheduler_lag_seconds', datetime.now().timestamp() - minute, job='daily')
+            await deliver_daily_subscriptions(minute, subs)
+        if len(page) < DISPATCH_PAGE:
+            break
+
+# Оповещения о дожде проверяются одной задачей: прогноз запрашивается один раз на город,
+# а результат применяется ко всем подписчикам этого города.
+class RainAlertCooldowns:
+    """Паузы между оповещениями (sub_id -> unix-время окончания) в памяти с сохранением в rain_alert_state."""
+
+    def __init__(self):
+        self._until: dict[int, int] | None = None
+
+    async def load(self, now: int):
+        # В режиме нескольких процессов паузы могли выставить другие процессы — перечитываем каждый раз
+        if self._until is None or MULTI_WORKER:
+            self._until = await get_rain_cooldowns(now)
+
+    def is_cooling(self, sub_id: int, now: int) -> bool:
+        return self._until.get(sub_id, 0) > now
+
+    async def start(self, sub_ids: list[int], until: int):
+        if not sub_ids:
+            return
+        changed = {sub_id: until for sub_id in sub_ids}
+        self._until.update(changed)
+        await save_rain_cooldowns(changed)
+
+    def expire(self, now: int):
+        self._until = {sub_id: until for sub_id, until in self._until.items() if until > now}
+
+rain_cooldowns = RainAlertCooldowns()
 
+async def check_rain_alerts(context: ContextTypes.DEFAULT_TYPE):
+    owm_source.set('rain')
+    now = int(datetime.now().timestamp())
+    await rain_cooldowns.load(now)
+    rain_cooldowns.expire(now)
+
+    # Города, где все подписчики на паузе, не запрашиваем вовсе
+    by_city = {}
+    for sub in await get_active_subscriptions('alert_rain'):
+        if not rain_cooldowns.is_cooling(sub['id'], now):
+            by_city.setdefault(normalize_city(sub['city']), []).append(sub)
+
+    slot = now // RAIN_CHECK_INTERVAL
+    keys = {city: f'rain:{slot}:{city}' for city in by_city}
+    claimed = await claim_store.claim_many(list(keys.values()))
+    by_city = {city: group for city, group in by_city.items() if keys[city] in claimed}
+
+    semaphore = asyncio.Semaphore(DISPATCH_CONCURRENCY)
+
+    async def check_city(group: list[dict]) -> list[dict]:
+        async with semaphore:
+            try:
+                snapshot = await get_snapshot(OPENWEATHER_API_KEY, city=group[0]['city'], forecast=True)
+            except Exception as e:
+                logger.warning('Rain check failed: city=%s error=%s: %s', group[0]['city'], type(e).__name__, e)
+                return []
+        # Тот же /forecast, что и у прогнозов по запросу пользователя, — отдельный запрос /onecall не нужен
+        return group if snapshot.forecast.has_rain(now, now + RAIN_LOOKAHEAD_HOURS * 3600) else []
+
+    groups = await asyncio.gather(*(check_city(group) for group in by_city.values()))
+    alerted = [sub for group in groups for sub in group]
+    results = await asyncio.gather(
+        *(send_queue.send(sub['user_id'], f"❗️ Внимание! В городе {sub['city']} в ближайшее время ожидается дождь!")
+          for sub in alerted),
+        return_exceptions=True
+    )
+    delivered = [sub['id'] for sub, result in zip(alerted, results) if not isinstance(result, Exception)]
+    await rain_cooldowns.start(delivered, now + RAIN_ALERT_COOLDOWN)
+    if alerted:
+        logger.info('Rain alerts: cities=%s sent=%s failed=%s', len(by_city), len(delivered), len(alerted) - len(delivered))
+
+# Прогрев кэша: погода для городов ближайших рассылок загружается заранее и с ограниченной скоростью,
+# чтобы в момент рассылки все отправки брали её из памяти
+async def warm_cache(context: ContextTypes.DEFAULT_TYPE):
+    owm_source.set('warmup')
+    now = int(datetime.now().timestamp())
+    horizon = now + WARMUP_LEAD_MINUTES * 60
+    # Город -> (время, до которого данные должны оставаться свежими, нужен ли прогноз)
+    targets = {}
+    upcoming = await get_upcoming_daily_cities(horizon)
+    for city, first_run, _ in upcoming:
+        # С запасом в интервал диспетчера: рассылка начинается не позже чем через минуту после first_run
+        targets.setdefault(normalize_city(city), (city, max(first_run, now) + 60, False))
+    # Популярные города — только перед пиком: в остальное время их обновление тратило бы квоту без спроса
+    if sum(count for _, _, count in upcoming) >= WARMUP_PEAK_SUBSCRIPTIONS:
+        for city in popular_cities.top(WARMUP_POPULAR):
+            targets.setdefault(normalize_city(city), (city, horizon, True))
+
+    # Квота считается поминутно, а диспетчер рассылки запускается в начале следующей минуты: прогрев укладывается
+    # в текущую минуту и занимает не больше WARMUP_QUOTA_SHARE оставшейся фоновой квоты. Ближайшие рассылки — первыми
+    budget = min(int((60 - now % 60) * WARMUP_RATE), int(owm_quota.available('warmup') * WARMUP_QUOTA_SHARE))
+    fetched, tasks = 0, []
+    for city, ready_by, with_forecast in sorted(targets.values(), key=lambda target: target[1]):
+        if fetched >= budget:
+            break
+        spent = owm_quota.used('warmup')
+        try:
+            location = await resolve_city(city, OPENWEATHER_API_KEY)
+        except Exception as e:
+            logger.warning('Warm-up failed: city=%s error=%s: %s', city, type(e).__name__, e)
+            continue
+        # Новый город сначала геокодируется запросом к API — он тоже расходует бюджет
+        fetched += owm_quota.used('warmup') - spent
+        coords = {'lat': location['lat'], 'lon': location['lon']}
+        fetches = [('/data/2.5/weather', parse_current)] + ([('/data/2.5/forecast', Forecast.from_payload)] if with_forecast else [])
+        for path, parse in fetches:
+            if weather_cache.expires_in(owm_cache_key(path, coords)) >= ready_by - now:
+                continue
+            tasks.append(asyncio.ensure_future(owm_prefetch(path, OPENWEATHER_API_KEY, ready_by - now, parse, **coords)))
+            fetched += 1
+            await asyncio.sleep(1 / WARMUP_RATE)
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    failed = sum(isinstance(result, Exception) for result in results)
+    if tasks:
+        logger.info('Cache warm-up: cities=%s fetched=%s failed=%s', len(targets), len(tasks) - failed, failed)
+
+# Рассылки администратора: получатели читаются из БД страницами, сообщения уходят через send_queue
+# с низшим приоритетом, прогресс сохраняется каждые BROADCAST_CHECKPOINT_EVERY сообщений.
+# После перезапуска (или падения процесса) рассылка продолжается с контрольной точки.
+_broadcast_tasks: dict[int, asyncio.Task] = {}
+
+async def keep_broadcast_lease(broadcast_id: int, task: asyncio.Task):
+    """Каждые BROADCAST_LEASE / 3 секунд продлевает аренду; если рассылку отменили или забрали, останавливает task."""
+    while True:
+        await asyncio.sleep(BROADCAST_LEASE / 3)
+        try:
+            renewed = await renew_broadcast_lease(broadcast_id, int(datetime.now().timestamp()))
+        except Exception:
+            # Аренда действует ещё как минимум две трети срока — попробуем в следующий раз
+            logger.exception('Broadcast lease renewal failed: id=%s', broadcast_id)
+            continue
+        if not renewed:
+            logger.info('Broadcast lease lost: id=%s', broadcast_id)
+            task.cancel()
+            return
+
+def start_broadcast(broadcast_id: int):
+    task = asyncio.create_task(run_broadcast(broadcast_id))
+    _broadcast_tasks[broadcast_id] = task
+    task.add_done_callback(lambda _: _broadcast_tasks.pop(broadcast_id, None))
+
+async def run_broadcast(broadcast_id: int):
+    broadcast = await get_broadcast(broadcast_id)
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    cursor, sent, failed = broadcast['last_user_id'], 0, 0
+    # Аренда продлевается по таймеру, а не только в контрольных точках: сообщения PRIORITY_BULK
+    # стоят в очереди за плановыми рассылками, и без продления рассылку подхватил бы другой процесс
+    renewal = asyncio.create_task(keep_broadcast_lease(broadcast_id, asyncio.current_task()))
     try:
-        data = await get_one_call_data_by_city(city, OPENWEATHER_API_KEY)
-        hourly_forecast = data.get('hourly', [])
-        
-        for hour in hourly_forecast[:4]:
-            if 'rain' in hour.get('weather', [{}])[0].get('main', '').lower():
-                await context.bot.send_message(
-                    chat_id=user_id, 
-                    text=f"❗️ Внимание! В городе {city} в ближайшее время ожидается дождь!"
-                )
-                context.application.job_queue.run_once(lambda: None, 3600, name=lock_job_name)
+        while True:
+            page = await get_broadcast_recipients(broadcast['city'], cursor, BROADCAST_PAGE)
+            if not page:
                 break
-    except Exception:
-        pass
-
-async def get_one_call_data_by_city(city: str, api_key: str) -> dict:
-    url = f'https://api.openweathermap.org/data/2.5/weather?q={city}&appid={api_key}'
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url)
-        response.raise_for_status()
-        geodata = response.json()
-    lat, lon = geodata['coord']['lat'], geodata['coord']['lon']
-    return await get_one_call_data(lat, lon, api_key)
-
-async def schedule_subscription_jobs(application: Application, sub_id: int, user_id: int, sub_data: dict):
-    scheduler = application.job_queue
-    job_name = f"sub_{sub_id}"
-
-    if sub_data['forecast_type'] == 'daily':
-        moscow_tz = pytz.timezone('Europe/Moscow')
-        user_time = dt_time.fromisoformat(sub_data['time'])
-        
-        # Создаем объект datetime с сегодняшней датой и указанным временем
-        user_datetime = datetime.now()
-        user_datetime = user_datetime.replace(
-            hour=user_time.hour,
-            minute=user_time.minute,
-            second=0,
-            microsecond=0
-        )
-        
-        # Локализуем время в московском часовом поясе
-        user_datetime = moscow_tz.localize(user_datetime)
-        # Конвертируем в UTC, так как run_daily ожидает время в UTC
-        utc_time = user_datetime.astimezone(pytz.utc).time()
-        
-        days = tuple(json.loads(sub_data['days']))
-        scheduler.run_daily(
-            send_daily_forecast,
-            time=utc_time,
-            days=days,
-            chat_id=user_id,
-            user_id=user_id,
-            name=job_name,
-            data={'user_id': user_id, 'city': sub_data['city']}
-        )
-    elif sub_data['forecast_type'] == 'alert_rain':
-        scheduler.run_repeating(
-            check_rain_alerts,
-            interval=900, 
-            first=10,
-            name=job_name,
-            data={'user_id': user_id, 'city': sub_data['city'], 'sub_id': sub_id}
-        )
+            futures = [send_queue.send(user_id, broadcast['text'], priority=PRIORITY_BULK) for user_id in page]
+            batch_sent = batch_failed = 0
+            try:
+                for done, (user_id, future) in enumerate(zip(page, futures), start=1):
+                    try:
+                        await future
+                        batch_sent += 1
+                    except Exception:
+                        batch_failed += 1
+                    if done % BROADCAST_CHECKPOINT_EVERY and done != len(page):
+                        continue
+                    # Фьючерсы ждём по порядку user_id, поэтому всем до user_id включительно сообщение уже ушло
+                    active = await checkpoint_broadcast(broadcast_id, user_id, batch_sent, batch_failed, int(datetime.now().timestamp()))
+                    sent, failed = sent + batch_sent, failed + batch_failed
+                    batch_sent = batch_failed = 0
+                    if not active:
+                        logger.info('Broadcast stopped: id=%s sent=%s', broadcast_id, sent)
+                        return
+            finally:
+                # Остановка или отмена: ещё не отправленные сообщения страницы убираем из очереди
+                for future in futures:
+                    future.cancel()
+            cursor = page[-1]
+    finally:
+        renewal.cancel()
+
+    await finish_broadcast(broadcast_id, int(datetime.now().timestamp()))
+    broadcast = await get_broadcast(broadcast_id)
+    elapsed = loop.time() - started
+    report = (
+        f"Рассылка #{broadcast_id} завершена: доставлено {broadcast['sent']}, ошибок {broadcast['failed']}.\n"
+        f"Этот запуск: {sent + failed} сообщений за {elapsed:.0f} с ({(sent + failed) / max(elapsed, 0.001):.1f} в секунду)."
+    )
+    logger.info('Broadcast finished: id=%s sent=%s failed=%s run_messages=%s elapsed=%.1f',
+                broadcast_id, broadcast['sent'], broadcast['failed'], sent + failed, elapsed)
+    if ADMIN_CHAT_ID:
+        try:
+            await send_queue.send(ADMIN_CHAT_ID, report, priority=PRIORITY_INTERACTIVE)
+        except Exception as e:
+            logger.warning('Failed to send broadcast report: id=%s error=%s: %s', broadcast_id, type(e).__name__, e)
+
+async def resume_broadcasts(context: ContextTypes.DEFAULT_TYPE):
+    now = int(datetime.now().timestamp())
+    for broadcast_id in await get_running_broadcasts():
+        if broadcast_id not in _broadcast_tasks and await claim_broadcast(broadcast_id, now):
+            logger.info('Resuming broadcast: id=%s', broadcast_id)
+            start_broadcast(broadcast_id)
+
+async def compact_database(context: ContextTypes.DEFAULT_TYPE):
+    now = int(datetime.now().timestamp())
+    if not await claim_store.claim_many([f'compact:{datetime.now():%Y-%m-%d}']):
+        return
+    purged = await purge_inactive_subscriptions(now - SUBSCRIPTION_RETENTION_DAYS * 86400)
+    expired = await purge_rain_cooldowns(now)
+    claims = await claim_store.purge(now - JOB_CLAIM_RETENTION)
+    await db.execute('PRAGMA optimize')
+    logger.info('Compaction: subscriptions=%s rain_pauses=%s job_claims=%s', purged, expired, claims)
 
-async def reschedule_all_jobs(application: Application):
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM subscriptions WHERE is_active = 1')
-        all_subs = [dict(row) for row in cursor.fetchall()]
+async def flush_weather_history(context: ContextTypes.DEFAULT_TYPE):
+    await weather_history.flush()
 
-    for sub in all_subs:
-        await schedule_subscription_jobs(application, sub['id'], sub['user_id'], sub)
-    print(f"Rescheduled {len(all_subs)} jobs.")
+async def compact_weather_history(context: ContextTypes.DEFAULT_TYPE):
+    if not await claim_store.claim_many([f'history:{datetime.now():%Y-%m-%d %H}']):
+        return
+    await weather_history.flush()
+    stats = await weather_history.compact(int(datetime.now().timestamp()))
+    if any(stats.values()):
+        logger.info('Weather history compaction: packed=%s downsampled=%s expired=%s', stats['packed'], stats['downsampled'], stats['expired'])
+
+async def post_init(application: Application):
+    get_http_client()
+    send_queue.start(application.bot)
+    application.job_queue.run_repeating(
+        dispatch_daily_subscriptions,
+        interval=60,
+        first=60 - datetime.now().second,
+        name='daily_dispatcher'
+    )
+    application.job_queue.run_repeating(check_rain_alerts, interval=RAIN_CHECK_INTERVAL, first=10, name='rain_alerts')
+    application.job_queue.run_repeating(compact_database, interval=86400, first=3600, name='db_compaction')
+    application.job_queue.run_repeating(flush_weather_history, interval=HISTORY_FLUSH_INTERVAL, first=HISTORY_FLUSH_INTERVAL, name='history_flush')
+    application.job_queue.run_repeating(compact_weather_history, interval=3600, first=600, name='history_compaction')
+    application.job_queue.run_repeating(resume_broadcasts, interval=BROADCAST_LEASE // 2, first=5, name='broadcast_resume')
+    # Прогрев — в середине минуты, между запусками диспетчера рассылки
+    application.job_queue.run_repeating(warm_cache, interval=WARMUP_INTERVAL, first=(30 - datetime.now().second) % 60 or 60, name='cache_warmup')
+
+async def post_shutdown(application: Application):
+    tasks = list(_broadcast_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await release_broadcasts()
+    await weather_history.close()
+    # Ежедневные подписки переносятся, как только сообщения поставлены в очередь: досылаем их,
+    # а не успевшие уйти возвращаем в расписание, иначе они пропадут
+    if not await send_queue.drain(SEND_DRAIN_TIMEOUT):
+        logger.warning('Send queue not drained: timeout=%s queued=%s', SEND_DRAIN_TIMEOUT, send_queue.stats()['queued'])
+    await send_queue.stop()
+    await reschedule_undelivered_daily()
+    await close_http_client()
+    await db.close()
 
 async def location_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    latitude = update.message.location.latitude
-    longitude = update.message.location.longitude
-    weather_info = await get_weather_by_coords(latitude, longitude, OPENWEATHER_API_KEY)
-    await update.message.reply_text(weather_info, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data='back_to_main')]]))
-
-# --- Главная функция --- 
-async def main() -> None:
-    init_db()
-    print("Бот запущен и готов к работе. Для остановки нажмите Ctrl+C")
+    place = await snap_location(update.message.location.latitude, update.message.location.longitude)
+    weather_info = await get_weather_by_coords(place['lat'], place['lon'], OPENWEATHER_API_KEY, place['canonical_name'])
+    await update.message.reply_text(weather_info, reply_markup=BACK_TO_MAIN_MARKUP)
+
+# --- HTTP-сервер для вебхука ---
+class WebhookServer:
+    """Минимальный HTTP/1.1-сервер на asyncio: принимает обновления Telegram (если задан path), отвечает на /health и /metrics."""
+
+    REASONS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 413: 'Payload Too Large',
+               503: 'Service Unavailable'}
+
+    def __init__(self, application: Application, host: str, port: int, path: str, secret: str):
+        self.application = application
+        self.host = host
+        self.port = port
+        self.secret = secret
+        self._server = None
+        self._connections = 0
+        # (метод, путь) -> async def handler(headers, body) -> (статус, тип содержимого, тело)
+        self.routes = {
+            ('GET', '/health'): self._handle_health,
+        }
+        if path:
+            self.routes[('POST', path)] = self._handle_update
+        if metrics.enabled:
+            self.routes[('GET', '/metrics')] = self._handle_metrics
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        logger.info('HTTP server listening: host=%s port=%s', self.host, self.port)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._connections += 1
+        try:
+            if self._connections > WEBHOOK_MAX_CONNECTIONS:
+                await self._respond(writer, 503, 'application/json', b'{}', keep_alive=False)
+                return
+            while True:
+                # Простаивающее соединение закрываем; начатый запрос должен прийти целиком за WEBHOOK_READ_TIMEOUT
+                request_line = await asyncio.wait_for(reader.readline(), WEBHOOK_IDLE_TIMEOUT)
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = await asyncio.wait_for(self._read_headers(reader), WEBHOOK_READ_TIMEOUT)
+
+                length = int(headers.get('content-length') or 0)
+                if length > WEBHOOK_MAX_BODY:
+                    await self._respond(writer, 413, 'application/json', b'{}', keep_alive=False)
+                    break
+                body = await asyncio.wait_for(reader.readexactly(length), WEBHOOK_READ_TIMEOUT) if length else b''
+
+                handler = self.routes.get((method, target.split('?', 1)[0]))
+                if handler is None:
+                    status, content_type, payload = 404, 'application/json', b'{}'
+                else:
+                    status, content_type, payload = await handler(headers, body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                await self._respond(writer, status, content_type, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError):
+            pass
+        finally:
+            self._connections -= 1
+            writer.close()
+
+    async def _read_headers(self, reader: asyncio.StreamReader) -> dict:
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                return headers
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+    async def _respond(self, writer: asyncio.StreamWriter, status: int, content_type: str, payload: bytes, keep_alive: bool):
+        head = (
+            f'HTTP/1.1 {status} {self.REASONS.get(status, "")}\r\n'
+            f'Content-Type: {content_type}\r\n'
+            f'Content-Length: {len(payload)}\r\n'
+            f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'
+        )
+        writer.write(head.encode('latin-1') + payload)
+        await writer.drain()
 
-    persistence = PicklePersistence(filepath=PERSISTENCE_PATH)
-    
-    application = Application.builder().token(TOKEN).persistence(persistence).post_init(reschedule_all_jobs).build()
+    async def _handle_update(self, headers: dict, body: bytes):
+        token = headers.get('x-telegram-bot-api-secret-token', '')
+        if not hmac.compare_digest(token.encode(), self.secret.encode()):
+            return 403, 'application/json', b'{}'
+        try:
+            data = json.loads(body)
+            # Update.de_json ждёт объект: на [1, 2] он падает с AttributeError, а на null возвращает None
+            if not isinstance(data, dict):
+                raise ValueError('update must be a JSON object')
+            update = Update.de_json(data, self.application.bot)
+        except (ValueError, TypeError, KeyError, AttributeError):
+            return 400, 'application/json', b'{}'
+        # Обработкой занимается Application (параллельно, см. CONCURRENT_UPDATES); Telegram сразу получает 200
+        await self.application.update_queue.put(update)
+        return 200, 'application/json', b'{}'
+
+    async def _handle_health(self, headers: dict, body: bytes):
+        payload = {'status': 'ok', 'update_queue': self.application.update_queue.qsize()}
+        return 200, 'application/json', json.dumps(payload).encode()
+
+    async def _handle_metrics(self, headers: dict, body: bytes):
+        return 200, 'text/plain; version=0.0.4', metrics.render().encode()
+
+# --- Сборка приложения ---
+class SharedStateApplication(Application):
+    """Application для режима MULTI_WORKER: состояние диалогов читается из БД перед каждым обновлением,
+    а всё изменённое обработкой (user_data, chat_data, диалоги) записывается сразу после неё."""
+
+    async def process_update(self, update: object) -> None:
+        if isinstance(update, Update):
+            await self._load_conversation_states(update)
+        await super().process_update(update)
+        await self.update_persistence()
+
+    async def _load_conversation_states(self, update: Update):
+        # ConversationHandler держит состояния в памяти и читает их из persistence только в initialize;
+        # в PTB 20 для этого нет публичного API, поэтому обновляем его словарь без пометки на запись
+        for handlers in self.handlers.values():
+            for handler in handlers:
+                if not (isinstance(handler, ConversationHandler) and handler.persistent):
+                    continue
+                try:
+                    key = handler._get_key(update)
+                except RuntimeError:
+                    continue
+                state = await self.persistence.get_conversation_state(handler.name, key)
+                if state is None:
+                    handler._conversations.data.pop(key, None)
+                else:
+                    handler._conversations.update_no_track({key: state})
+
+def check_worker_config():
+    """MULTI_WORKER работает только через вебхук: при polling процессы мешают друг другу в getUpdates,
+    а вебхук с разными секретами принимал бы обновления только последний зарегистрировавший его процесс."""
+    if not MULTI_WORKER:
+        return
+    if not WEBHOOK_URL:
+        raise SystemExit('MULTI_WORKER=1 requires webhook mode: set WEBHOOK_URL.')
+    if not os.getenv('WEBHOOK_SECRET'):
+        raise SystemExit('MULTI_WORKER=1 requires WEBHOOK_SECRET shared by all worker processes.')
+
+def build_application(persistence: BasePersistence, bot=None) -> Application:
+    """Создаёт Application со всеми хендлерами; bot передаётся вместо токена в benchmark.py."""
+    builder = (
+        Application.builder()
+        .application_class(SharedStateApplication if MULTI_WORKER else Application)
+        .persistence(persistence)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    application = (builder.bot(bot) if bot is not None else builder.token(TOKEN)).build()
 
     # --- Хендлеры для подписок ---
     sub_handler = ConversationHandler(
@@ -637,9 +3107,15 @@ async def main() -> None:
         persistent=True, name="feedback_conversation"
     )
 
+    # Группа -1 обрабатывается раньше остальных: флуд и повторы отсекаются до хендлеров
+    application.add_handler(TypeHandler(Update, guard_updates), group=-1)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("setcity", set_city))
     application.add_handler(CommandHandler("addfav", add_fav))
+    application.add_handler(CommandHandler("timezone", set_timezone))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("broadcast", broadcast_command))
+    application.add_handler(CommandHandler("broadcast_cancel", broadcast_cancel_command))
     
     application.add_handler(sub_handler)
     application.add_handler(feedback_handler)
@@ -648,9 +3124,64 @@ async def main() -> None:
     application.add_handler(MessageHandler(filters.LOCATION, location_handler))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_handler))
 
+    if metrics.enabled:
+        for handlers in application.handlers.values():
+            instrument_handlers(handlers)
+    return application
+
+# --- Главная функция --- 
+async def main() -> None:
+    logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    # httpx пишет в INFO каждый запрос — это дублирует метрики и засоряет лог
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    check_worker_config()
+    init_db()
+
+    persistence = SQLitePersistence(shared=MULTI_WORKER)
+    await persistence.import_pickle(PERSISTENCE_PATH)
+
+    application = build_application(persistence)
+
+    # post_init и post_shutdown вызываются вручную: Application делает это сам только в run_polling/run_webhook
     await application.initialize()
+    await post_init(application)
     await application.start()
-    await application.updater.start_polling()
+    webhook_server = None
+    if WEBHOOK_URL:
+        webhook_server = WebhookServer(application, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET)
+        await webhook_server.start()
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=100,
+        )
+    else:
+        await application.updater.start_polling()
+        if metrics.enabled:
+            webhook_server = WebhookServer(application, WEBHOOK_LISTEN, METRICS_PORT, None, '')
+            await webhook_server.start()
+    # Heroku и systemd останавливают процесс сигналом SIGTERM: без обработчика процесс завершится сразу,
+    # не сохранив persistence, историю погоды и не освободив аренду рассылки
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows: остаётся KeyboardInterrupt по Ctrl+C
+            pass
+    logger.info('Bot started: mode=%s worker_id=%s', 'webhook' if WEBHOOK_URL else 'polling', WORKER_ID)
+    try:
+        await stop.wait()
+    finally:
+        logger.info('Bot stopping: worker_id=%s', WORKER_ID)
+        if webhook_server is not None:
+            await webhook_server.stop()
+        if not WEBHOOK_URL:
+            await application.updater.stop()
+        await application.stop()
+        await application.shutdown()
+        await post_shutdown(application)
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file